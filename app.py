@@ -24,6 +24,12 @@ from tornado.options import define, options
 import settings
 from tornado_utils.routes import route
 from utils.git import get_git_revision
+from apps.main.user_cache import UserCache
+from apps.main.passwords import PasswordService
+from apps.main.attempts import AttemptLimiter
+from apps.main.config import UNDOER_GUID
+from apps.main.models import get_or_create_undoer
+from apps.main.counters import reconcile_total_no_events
 
 ################################################################################
 # original
@@ -40,6 +46,8 @@ define("debug", default=True, help="run in debug mode", type=bool)
 define("port", default=8080, help="run on the given port", type=int)
 define("database_name", default=settings.DATABASE_NAME, help="mongodb database name")
 define("prefork", default=False, help="pre-fork across all CPUs", type=bool)
+define("xheaders", default=False, type=bool,
+       help="use the client IP from the X-Real-Ip header of a proxy in front")
 define("showurls", default=False, help="Show all routed URLs", type=bool)
 define("dont_combine", default=True, help="Don't combine static resources", type=bool)
 define("dont_embed_static_url", default=True,
@@ -50,7 +58,8 @@ class Application(tornado.web.Application):
     def __init__(self,
                  database_name=None,
                  xsrf_cookies=True,
-                 optimize_static_content=None):
+                 optimize_static_content=None,
+                 cache_users=True):
         ui_modules_map = {}
         for app_name in settings.APPS:
             # XXX consider replacing this with use of tornado.util.import_object
@@ -109,7 +118,9 @@ class Application(tornado.web.Application):
                                       "static", "compiler.jar"),
             YUI_LOCATION=os.path.join(os.path.dirname(__file__),
                                       "static", "yuicompressor-2.4.2.jar"),
-            UNDOER_GUID=u'UNDOER', # must be a unicode string
+            UNDOER_GUID=UNDOER_GUID,
+            stats_backend=settings.STATS_BACKEND,
+            background_reports=settings.BACKGROUND_REPORTS,
             cdn_prefix=cdn_prefix,
         )
         tornado.web.Application.__init__(self, handlers, **app_settings)
@@ -120,6 +131,16 @@ class Application(tornado.web.Application):
         self.redis = redis.client.Redis(settings.REDIS_HOST,
                                         settings.REDIS_PORT)
 
+        if cache_users:
+            self.user_cache = UserCache(self.redis)
+        else:
+            self.user_cache = None
+
+        self.password_service = PasswordService(
+          workers=settings.PASSWORD_WORKERS,
+          log_rounds=settings.PASSWORD_LOG_ROUNDS)
+        self.attempt_limiter = AttemptLimiter(self.redis)
+
         model_classes = []
         for app_name in settings.APPS:
             _models = __import__('apps.%s' % app_name, globals(), locals(),
@@ -136,6 +157,22 @@ class Application(tornado.web.Application):
 
         self.con.register(model_classes)
 
+        self.setup_undoer()
+
+    def setup_undoer(self):
+        """Deleting and undeleting events needs the special undoer user.
+        Look it up (or create it) once and remember its ID."""
+        undoer = get_or_create_undoer(self.con[self.database_name],
+                                      self.settings['UNDOER_GUID'])
+        self.settings['UNDOER_ID'] = undoer._id
+
+    def reconcile_counters(self):
+        """correct any drift in the counters that are maintained as events
+        are added and deleted"""
+        reconcile_total_no_events(self.con[self.database_name],
+                                  self.redis,
+                                  self.settings['UNDOER_ID'])
+
 for app_name in settings.APPS:
     __import__('apps.%s' % app_name, globals(), locals(), ['handlers'], -1)
 
@@ -153,7 +190,9 @@ def main(): # pragma: no cover
     if os.path.isfile('static_index.html'):
         import warnings
         warnings.warn("Running with static_index.html")
-    http_server = tornado.httpserver.HTTPServer(Application())
+    application = Application()
+    http_server = tornado.httpserver.HTTPServer(application,
+                                                xheaders=options.xheaders)
     print "Starting tornado on port", options.port
     if options.prefork:
         print "\tpre-forking"
@@ -0,0 +1,19 @@
+# Built and checked by ./bin/ensure_indexes.py
+import datetime
+from pymongo import ASCENDING
+from bson.objectid import ObjectId
+from models import EmailReminder
+
+# (model, key, options)
+INDEXES = (
+  (EmailReminder, [('_next_send_date', ASCENDING)], {}),
+  (EmailReminder, [('user', ASCENDING)], {}),
+)
+
+def get_query_shapes():
+    """return (model, spec, sort) as used by the handlers"""
+    now = datetime.datetime.utcnow()
+    return (
+      (EmailReminder, {'_next_send_date': {'$lte': now}}, None),
+      (EmailReminder, {'user': ObjectId(), 'weekdays': u'Monday'}, None),
+    )
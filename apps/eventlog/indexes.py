@@ -1,15 +1,19 @@
+# Built and checked by ./bin/ensure_indexes.py
 from pymongo import ASCENDING, DESCENDING
+from bson.objectid import ObjectId
 from models import EventLog
-from mongokit import Connection
-con = Connection()
-con.register([EventLog])
-db = con.worklog
 
-def run():
-    collection = db.EventLog.collection
-    collection.ensure_index([('add_date',DESCENDING)])
-    test()
+# (model, key, options)
+INDEXES = (
+  (EventLog, [('add_date', DESCENDING)], {}),
+  (EventLog, [('user', ASCENDING)], {}),
+  (EventLog, [('action', ASCENDING)], {}),
+)
 
-def test():
-    curs = db.EventLog.find().sort('add_date', DESCENDING).explain()['cursor']
-    assert 'BtreeCursor' in curs
\ No newline at end of file
+def get_query_shapes():
+    """return (model, spec, sort) as used by the handlers"""
+    return (
+      (EventLog, {}, [('add_date', DESCENDING)]),
+      (EventLog, {'user': ObjectId()}, [('add_date', DESCENDING)]),
+      (EventLog, {'action': 1}, None),
+    )
@@ -148,6 +148,7 @@ class GithubLoadHandler(GithubPullHandler):
                 event.description = description
                 event.all_day = False
                 event.save()
+                self.on_event_added(event, user)
 
             self.write(line)
 
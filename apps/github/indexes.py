@@ -0,0 +1,16 @@
+# Built and checked by ./bin/ensure_indexes.py
+from pymongo import ASCENDING
+from models import GitHubRepo
+
+# (model, key, options)
+INDEXES = (
+  (GitHubRepo, [('username', ASCENDING),
+                ('repo', ASCENDING),
+                ('branch', ASCENDING)], {}),
+)
+
+def get_query_shapes():
+    """return (model, spec, sort) as used by the handlers"""
+    return (
+      (GitHubRepo, {'username': u'', 'repo': u'', 'branch': u''}, None),
+    )
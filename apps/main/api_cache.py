@@ -0,0 +1,35 @@
+class EventsJSONCache(object):
+    """Cache of the JSON bodies of /api/events.json keyed by their ETag.
+
+    An entry can never be stale because the ETag changes with the versions
+    of the users in it but without anything else old entries would hang
+    around until they expire. So every key is also added to a set per user
+    whose events are in it and when that user's version is bumped all of
+    their entries are deleted at once.
+    """
+
+    KEY = 'api_event_json:%s'
+    USER_KEYS = 'api_event_json_keys:%s'
+
+    def __init__(self, redis, ttl=60 * 60 * 12):
+        self.redis = redis
+        self.ttl = ttl
+
+    def get(self, etag):
+        return self.redis.get(self.KEY % etag.strip('"'))
+
+    def set(self, etag, body, user_ids):
+        key = self.KEY % etag.strip('"')
+        pipe = self.redis.pipeline()
+        pipe.setex(key, body, self.ttl)
+        for user_id in user_ids:
+            pipe.sadd(self.USER_KEYS % user_id, key)
+            # the set never needs to outlive the entries in it
+            pipe.expire(self.USER_KEYS % user_id, self.ttl)
+        pipe.execute()
+
+    def invalidate(self, user_id):
+        """delete every entry that has events of this user"""
+        keys = self.redis.smembers(self.USER_KEYS % user_id)
+        if keys:
+            self.redis.delete(self.USER_KEYS % user_id, *keys)
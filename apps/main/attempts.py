@@ -0,0 +1,84 @@
+class AttemptLimiter(object):
+    """Counts suspicious attempts (failed logins, checking if emails are
+    taken) per client IP and per email address in Redis and works out how
+    long to hold back the response.
+
+    The first few attempts within the window aren't delayed at all; after
+    that the delay doubles for every attempt up to `max_delay` seconds.
+    """
+
+    KEY = 'attempts:%s'
+
+    def __init__(self, redis, window=60 * 15, free_attempts=3,
+                 base_delay=0.5, max_delay=10):
+        self.redis = redis
+        self.window = window
+        self.free_attempts = free_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def _email_key(self, email):
+        email = email.strip().lower()
+        if isinstance(email, unicode):
+            email = email.encode('utf8')
+        return self.KEY % ('email:%s' % email)
+
+    def _keys(self, ip, email):
+        keys = [self.KEY % ('ip:%s' % ip)]
+        if email:
+            keys.append(self._email_key(email))
+        return keys
+
+    def record(self, ip, email=None):
+        """count another attempt and return how many seconds to delay"""
+        pipe = self.redis.pipeline()
+        for key in self._keys(ip, email):
+            pipe.incr(key)
+            pipe.expire(key, self.window)
+        attempts = max(pipe.execute()[::2])
+        return self.get_delay(attempts)
+
+    def record_lookup(self, ip, email, found):
+        """count a lookup of whether an email is taken and return how many
+        seconds to delay. Only lookups of emails nobody has are counted,
+        and only once per IP and email, so that it's guessing many
+        different emails from one IP that gets slow and not checking your
+        own a couple of times."""
+        if found:
+            return 0
+        email = email.strip().lower()
+        if isinstance(email, unicode):
+            email = email.encode('utf8')
+        pair_key = self.KEY % ('lookup:%s:%s' % (ip, email))
+        ip_key = self.KEY % ('lookup:%s' % ip)
+        if self.redis.set(pair_key, 1, nx=True, ex=self.window):
+            # the pipeline is a MULTI so the counter always gets its expiry
+            pipe = self.redis.pipeline()
+            pipe.incr(ip_key)
+            pipe.expire(ip_key, self.window)
+            attempts = pipe.execute()[0]
+        else:
+            attempts = int(self.redis.get(ip_key) or 0)
+        return self.get_delay(attempts)
+
+    def get_delay(self, attempts):
+        over = attempts - self.free_attempts
+        if over <= 0:
+            return 0
+        return min(self.base_delay * 2 ** (over - 1), self.max_delay)
+
+    def reset(self, email, ip=None):
+        """forget the attempts on an email, e.g. after a successful login or
+        signup, and the email lookups from the IP. The failed logins from
+        the IP are not forgiven or else logging in to your own account
+        would reset them."""
+        keys = [self._email_key(email)]
+        if ip:
+            keys.append(self.KEY % ('lookup:%s' % ip))
+        self.redis.delete(*keys)
+
+    def clear(self):
+        """forget all attempts. Slow, only meant for tests."""
+        keys = self.redis.keys(self.KEY % '*')
+        if keys:
+            self.redis.delete(*keys)
@@ -7,6 +7,17 @@ TAG_COLOR_SERIES = ("#EAA228", "#c5b47f", "#579575", "#839557", "#958c12",
 # This applies when it's not an all_day event and the date is the same
 MINIMUM_DAY_SECONDS = 60 * 30
 
+# Streamed responses, like long ranges of events, are flushed every time
+# this many bytes have been written
+STREAM_FLUSH_SIZE = 64 * 1024
+
+# The special user that deleted events are chown'ed to until they're cleaned up
+UNDOER_GUID = u'UNDOER' # must be a unicode string
+
+# The default upper bounds of the bins of the histogram of the number of
+# events per user on /stats/
+NO_EVENTS_BINS = (1, 5, 10, 25, 50, 100, 200, 400)
+
 API_CHANGELOG = (
   ("1.1", "Validation in place to prevent end date less than start date"),
   ("1.0", "Initial API launched"),
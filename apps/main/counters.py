@@ -0,0 +1,48 @@
+"""The total number of events shown on every page is kept as a counter in
+Redis that is changed every time an event is created, deleted or restored.
+
+Counting the events collection is expensive so it's only ever done by the
+reconciler, which ./bin/reconcile_counters.py runs from cron to correct any
+drift and to put the counter back if it's missing. Until then a missing
+counter is left alone and not changed.
+"""
+
+TOTAL_NO_EVENTS_KEY = 'total_no_events'
+RECONCILE_LOCK_KEY = 'total_no_events:reconciling'
+
+# change the counter by ARGV[1] but only if it's there
+_INCRBY_IF_EXISTS = """
+if redis.call('exists', KEYS[1]) == 1 then
+  return redis.call('incrby', KEYS[1], ARGV[1])
+end
+return nil
+"""
+
+
+def count_total_no_events(db, undoer_id):
+    search = {'user.$id': {'$ne': undoer_id}}
+    return db.Event.collection.find(search).count()
+
+
+def change_total_no_events(redis, amount):
+    """add amount to the counter and return it, or return None and leave
+    it to the reconciler if there's no counter"""
+    return redis.eval(_INCRBY_IF_EXISTS, 1, TOTAL_NO_EVENTS_KEY, amount)
+
+
+def reconcile_total_no_events(db, redis, undoer_id):
+    """set the counter to the real count and return it, or return None if
+    another process is already reconciling.
+
+    Events added or deleted whilst we're counting are lost until the next
+    time but that's better than adjusting the counter by a difference
+    worked out from a read that might be stale by then.
+    """
+    if not redis.set(RECONCILE_LOCK_KEY, 1, nx=True, ex=60):
+        return None
+    try:
+        count = count_total_no_events(db, undoer_id)
+        redis.set(TOTAL_NO_EVENTS_KEY, count)
+    finally:
+        redis.delete(RECONCILE_LOCK_KEY)
+    return count
@@ -0,0 +1,59 @@
+"""Read-only views of raw event documents for the endpoints that only read
+a handful of fields from lots of events (calendar feeds, stats, exports).
+
+The events are fetched with a field projection and every document is
+turned into an EventRow which, thanks to __slots__, is a lot smaller than
+the dict it was decoded into. It still supports event['start'] and
+event.get('description') so code that used to get the raw dicts doesn't
+need to change.
+"""
+
+# the fields each endpoint needs ('_id' is always included)
+CALENDAR_FIELDS = ('title', 'start', 'end', 'all_day', 'tags',
+                   'external_url', 'description')
+SHARED_CALENDAR_FIELDS = CALENDAR_FIELDS + ('user',)
+STATS_FIELDS = ('start', 'end', 'all_day', 'tags')
+EXPORT_FIELDS = ('title', 'start', 'end', 'all_day', 'tags', 'description')
+DAY_FIELDS = ('title', 'start', 'end', 'all_day', 'external_url',
+              'description')
+
+
+class EventRow(object):
+    __slots__ = ('_id', 'user', 'title', 'start', 'end', 'all_day', 'tags',
+                 'external_url', 'description')
+
+    def __init__(self, doc):
+        get = doc.get
+        self._id = get('_id')
+        self.user = get('user')
+        self.title = get('title')
+        self.start = get('start')
+        self.end = get('end')
+        self.all_day = get('all_day')
+        self.tags = get('tags')
+        self.external_url = get('external_url')
+        self.description = get('description')
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def get(self, key, default=None):
+        value = getattr(self, key, None)
+        if value is None:
+            return default
+        return value
+
+    def __repr__(self):
+        return '<EventRow %s %r>' % (self._id, self.title)
+
+
+def find_event_rows(collection, search, fields, sort=None):
+    """yield an EventRow for every event matching the search"""
+    cursor = collection.find(search, fields=list(fields))
+    if sort:
+        cursor = cursor.sort(sort)
+    for doc in cursor:
+        yield EventRow(doc)
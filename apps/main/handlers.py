@@ -6,10 +6,9 @@ from hashlib import md5
 from cStringIO import StringIO
 from urlparse import urlparse
 from urllib import quote as urllib_quote
-from pprint import pprint
-from collections import defaultdict
+from pprint import pprint, pformat
 from bson.objectid import ObjectId, InvalidId
-from time import mktime, sleep, time
+from time import mktime, time
 import datetime
 import os.path
 import re
@@ -17,21 +16,33 @@ import logging
 
 # tornado
 import tornado.auth
+import tornado.ioloop
 import tornado.web
 
 # app
 from tornado_utils.routes import route, route_redirect
 from models import *
-from utils.datatoxml import dict_to_xml
+from utils.datatoxml import dict_to_xml, iter_dict_to_xml
 from utils.send_mail import send_email
 from utils.decorators import login_required
 from utils import parse_datetime, niceboolean, \
   DatetimeParseError, valid_email, random_string, \
   all_hash_tags, all_atsign_tags, generate_random_color, \
-  stats, title_to_tags
+  title_to_tags
 from tornado_utils.timesince import smartertimesince
 from ui_modules import EventPreview
 from config import *
+from counters import TOTAL_NO_EVENTS_KEY, change_total_no_events
+from tags import TagIndex
+from event_rows import find_event_rows, CALENDAR_FIELDS, \
+  SHARED_CALENDAR_FIELDS, STATS_FIELDS, EXPORT_FIELDS
+from serializers import encode_events_data, iter_encode_events_data
+from versions import EventsVersions
+from stats import get_time_spent, get_interval_edges, lump_time_spent
+from rollups import DailyRollups
+from reports import ReportQueue, run_report, \
+  DATE_FORMAT as REPORT_DATE_FORMAT
+from api_cache import EventsJSONCache
 from apps.eventlog import log_event, actions, contexts
 
 
@@ -60,6 +71,14 @@ class HTTPSMixin(object):
 
 class BaseHandler(tornado.web.RequestHandler, HTTPSMixin):
 
+    def initialize(self):
+        # A handler instance only ever lives for one request so these act
+        # as a request-scoped identity cache. A page render asks for the
+        # current user and its settings many times over.
+        self._users_by_guid = {}
+        self._user_settings = {}
+        self._identity_lookups_saved = 0
+
     def static_url(self, path):
         self.require_setting("static_path", "static_url")
         if not hasattr(BaseHandler, "_static_timestamps"):
@@ -111,8 +130,13 @@ class BaseHandler(tornado.web.RequestHandler, HTTPSMixin):
         else:
             log_method = logging.error
         request_time = 1000.0 * self.request.request_time()
-        log_method("%d %s %.2fms", self._status_code,
-                   self._request_summary(), request_time)
+        if self._identity_lookups_saved:
+            log_method("%d %s %.2fms (%d user lookups saved)",
+                       self._status_code, self._request_summary(),
+                       request_time, self._identity_lookups_saved)
+        else:
+            log_method("%d %s %.2fms", self._status_code,
+                       self._request_summary(), request_time)
 
 
     def _email_exception(self, exception): # pragma: no cover
@@ -170,17 +194,103 @@ class BaseHandler(tornado.web.RequestHandler, HTTPSMixin):
     def redis(self):
         return self.application.redis
 
+    @property
+    def user_cache(self):
+        return self.application.user_cache
+
     def get_current_user(self):
         # the 'user' cookie is for securely logged in people
         guid = self.get_secure_cookie("user")
         if guid:
-            return self.db.User.one({'guid': guid})
+            return self.get_user_by_guid(guid)
 
         # the 'guid' cookie is for people who have posted something but not
         # logged in
         guid = self.get_secure_cookie("guid")
         if guid:
-            return self.db.User.one({'guid': guid})
+            return self.get_user_by_guid(guid)
+
+    def get_user_by_guid(self, guid):
+        """return the User by this guid (or None) but only ever ask the
+        database once per request"""
+        if guid in self._users_by_guid:
+            self._identity_lookups_saved += 1
+            return self._users_by_guid[guid]
+
+        user = None
+        if self.user_cache is not None:
+            doc = self.user_cache.get(guid)
+            if doc is not None:
+                user = self.db.User(doc)
+        if user is None:
+            user = self.db.User.one({'guid': guid})
+            if user is not None and self.user_cache is not None:
+                self.user_cache.set(guid, user)
+        self._users_by_guid[guid] = user
+        return user
+
+    def get_user_for_update(self, user):
+        """return the user from the database and not the user cache, which
+        might be stale, so it can be changed and saved"""
+        if self.user_cache is None:
+            return user
+        return self.db.User.one({'_id': user['_id']})
+
+    def invalidate_user_cache(self, user):
+        """must be called every time a user document is changed"""
+        self._users_by_guid.pop(user['guid'], None)
+        if self.user_cache is not None:
+            self.user_cache.invalidate(user['guid'])
+        # the name of the user is in the events feeds of everyone they share with
+        self.bump_events_version(user)
+
+    @property
+    def password_service(self):
+        return self.application.password_service
+
+    @property
+    def attempt_limiter(self):
+        return self.application.attempt_limiter
+
+    def delay(self, seconds, callback):
+        """call back after a number of seconds without blocking the IOLoop"""
+        if seconds:
+            self.get_io_loop().add_timeout(time() + seconds,
+                                           self.async_callback(callback))
+        else:
+            callback()
+
+    def _on_password_job(self, callback, result):
+        if result is None:
+            raise tornado.web.HTTPError(500, "Unable to process password")
+        callback(result)
+
+    def set_user_password(self, user, raw_password, callback):
+        """encrypt the password in the password service, set it on the
+        user (without saving) and call back"""
+        def on_encrypted(password):
+            user.password = password
+            callback()
+        self.password_service.encrypt(raw_password, self.get_io_loop(),
+          self.async_callback(self._on_password_job, on_encrypted))
+
+    def check_user_password(self, user, raw_password, callback):
+        """call back with True or False. If the password was correct but
+        encrypted with an old work factor it's re-encrypted and saved first."""
+        def on_saved():
+            user.save()
+            self.invalidate_user_cache(user)
+            callback(True)
+
+        def on_checked(correct):
+            if correct and self.password_service.needs_rehash(user.password):
+                self.set_user_password(user, raw_password, on_saved)
+            else:
+                callback(correct)
+
+        self.password_service.check(raw_password, user.password,
+          self.get_io_loop(),
+          self.async_callback(self._on_password_job, on_checked))
 
     # shortcut where the user parameter is not optional
     def get_user_settings(self, user, fast=False):
@@ -192,11 +302,24 @@ class BaseHandler(tornado.web.RequestHandler, HTTPSMixin):
 
         if not user:
             raise ValueError("Can't get settings when there is no user")
+        # A full document can be used where the raw dict was asked for but
+        # not the other way around. Also, if the full document has been
+        # changed during this request it's the one that is up to date.
+        cache_keys = [(user['_id'], False)]
+        if fast:
+            cache_keys.append((user['_id'], True))
+        for cache_key in cache_keys:
+            if cache_key in self._user_settings:
+                self._identity_lookups_saved += 1
+                return self._user_settings[cache_key]
+
         _search = {'user': user['_id']}
         if fast:
-            return self.db.UserSettings.collection.one(_search) # skip mongokit
+            user_settings = self.db.UserSettings.collection.one(_search) # skip mongokit
         else:
-            return self.db.UserSettings.one(_search)
+            user_settings = self.db.UserSettings.one(_search)
+        self._user_settings[(user['_id'], fast)] = user_settings
+        return user_settings
 
     def create_user_settings(self, user, **default_settings):
         user_settings = self.db.UserSettings()
@@ -204,6 +327,8 @@ class BaseHandler(tornado.web.RequestHandler, HTTPSMixin):
         for key in default_settings:
             setattr(user_settings, key, default_settings[key])
         user_settings.save()
+        self._user_settings.pop((user._id, True), None)
+        self._user_settings[(user._id, False)] = user_settings
         return user_settings
 
     def get_cdn_prefix(self):
@@ -234,6 +359,33 @@ class BaseHandler(tornado.web.RequestHandler, HTTPSMixin):
         self.set_header("Content-Type", "text/plain; charset=UTF-8") # doesn;t seem to work
         self.write(str_)
 
+    # true while write_chunks() is writing a response in the background
+    writing_chunks = False
+
+    def write_chunks(self, chunks, flush_size=STREAM_FLUSH_SIZE):
+        """write the chunks and whenever there's more than flush_size bytes
+        waiting flush them and carry on once they've been sent, so that a
+        big response is never in memory all at once. Finishes the response
+        after the last one. Only for @tornado.web.asynchronous handlers."""
+        self.writing_chunks = True
+        chunks = iter(chunks)
+        waiting = 0
+        for chunk in chunks:
+            self.write(chunk)
+            waiting += len(chunk)
+            if waiting >= flush_size:
+                self.flush(callback=self.async_callback(self.write_chunks,
+                                                        chunks, flush_size))
+                return
+        self.writing_chunks = False
+        self.finish()
+
+    def finish_unless_writing_chunks(self):
+        """finish an asynchronous response unless it's already finished or
+        write_chunks() will finish it"""
+        if not self._finished and not self.writing_chunks:
+            self.finish()
+
 
     def transform_fullcalendar_event(self, item, serialize=False, **kwargs):
         data = dict(title=item['title'],
@@ -263,56 +415,68 @@ class BaseHandler(tornado.web.RequestHandler, HTTPSMixin):
                 data[key] = mktime(value.timetuple())
         return data
 
-    def reset_tags_cache(self, user):
-        redis_key = 'all_available_tags:%s' % user['_id']
-        self.redis.delete(redis_key)
+    @property
+    def tag_index(self):
+        return TagIndex(self.db, self.redis)
 
     def case_correct_tags(self, tags, user):
         # the new correct case for these tags is per the parameter 'tags'
         # We need to change all other tags that are spelled with a different
         # case to this style
-        base_search = {
-          'user.$id': user._id,
-        }
-        base_search_slim = {
-          'user': user._id,
-        }
-
-        def get_checked_tags(event_tags, new_tag):
-            checked_tags = []
-            for t in event_tags:
-                if t != tag and t.lower() == tag.lower():
-                    checked_tags.append(tag)
-                else:
-                    checked_tags.append(t)
-            return checked_tags
-
-        for tag in tags:
-            search = dict(base_search,
-                          tags=re.compile(re.escape(tag), re.I))
-
-            for event in self.db.Event.collection.find(search):
-                checked_tags = get_checked_tags(event['tags'], tag)
-                if event['tags'] != checked_tags:
-                    event['tags'] = checked_tags
-                    # because 'event' is just a dict, we need to turn it into an object
-                    # before we can save it
-                    event_obj = self.db.Event(event)
-                    event_obj.save()
-
-            search = dict(base_search_slim,
-                          tags=re.compile(re.escape(tag), re.I))
-
-            for share in self.db.Share.collection.find(search):
-                checked_tags = get_checked_tags(share['tags'], tag)
-                if share['tags'] != checked_tags:
-                    share['tags'] = checked_tags
-                    obj = self.db.Share(share)
-                    obj.save()
+        renamed = self.tag_index.case_correct(user['_id'], tags)
+        if renamed:
+            self.bump_events_version(user)
+            for tag in renamed:
+                self.daily_rollups.rename_tag(user['_id'], tag)
+
+    @property
+    def daily_rollups(self):
+        return DailyRollups(self.db, self.redis)
+
+    def get_report(self, name, **params):
+        """return the data of one of the reports in reports.py or None if
+        it's being worked out in the background"""
+        if self.application.settings.get('background_reports'):
+            return ReportQueue(self.redis).get(name, params)
+        return run_report(self.db, self.redis, name, params)
+
+    @property
+    def events_versions(self):
+        return EventsVersions(self.redis)
+
+    @property
+    def api_events_cache(self):
+        return EventsJSONCache(self.redis, ttl=API_EVENTS_CACHE_TIME)
+
+    def bump_events_version(self, user):
+        self.events_versions.bump_user(user['_id'])
+        self.api_events_cache.invalidate(user['_id'])
+
+    def bump_share_version(self, share):
+        self.events_versions.bump_share(share['_id'])
+        # cached entries are indexed by the owners of the shares in them
+        self.api_events_cache.invalidate(share['user'])
+
+    def get_events_etag(self, user, shares, *extra):
+        """return the ETag of the events feed of the user and the shares
+        (a list from share_keys_to_share_objects()) without looking at any
+        events"""
+        return self.events_versions.get_etag(user and user['_id'] or None,
+                                             shares, *extra)
+
+    def not_modified(self, etag):
+        """set the ETag header and return true if the client already has
+        this version in which case the status is set to 304"""
+        self.set_header('Etag', etag)
+        if_none_match = self.request.headers.get('If-None-Match', '')
+        if if_none_match.strip() == '*' or \
+          etag in [x.strip() for x in if_none_match.split(',')]:
+            self.set_status(304)
+            return True
+        return False
 
     def find_user(self, email):
-        return self.db.User.one(dict(email=\
-         re.compile(re.escape(email), re.I)))
+        return self.db.User.find_one(dict(email_lower=email.strip().lower()))
 
     def has_user(self, email):
         return bool(self.find_user(email))
@@ -363,35 +527,48 @@ class BaseHandler(tornado.web.RequestHandler, HTTPSMixin):
 
         return options
 
-    def get_total_no_events(self, refresh=False):
-        redis_key = 'total_no_events'
-        if not refresh and self.redis.exists(redis_key):
-            return self.redis.get(redis_key)
-
-        total_no_events = self._get_total_no_events()
-        self.redis.setex(redis_key, total_no_events, 60)
-        return total_no_events
+    def get_total_no_events(self):
+        total_no_events = self.redis.get(TOTAL_NO_EVENTS_KEY)
+        if total_no_events is None:
+            # Never count all events whilst serving a page. It's put back
+            # by ./bin/reconcile_counters.py
+            return 0
+        return int(total_no_events)
 
     def incr_total_no_events(self):
-        redis_key = 'total_no_events'
-        if self.redis.exists(redis_key):
-            self.redis.incr(redis_key)
-        else:
-            self.get_total_no_events(refresh=True)
+        change_total_no_events(self.redis, 1)
 
     def decr_total_no_events(self):
-        redis_key = 'total_no_events'
-        if self.redis.exists(redis_key):
-            self.redis.decr(redis_key)
-        else:
-            self.get_total_no_events(refresh=True)
+        change_total_no_events(self.redis, -1)
 
-    def _get_total_no_events(self):
-        search = dict()
-        undoer = self.get_undoer_user()
-        if undoer:
-            search['user.$id'] = {'$ne': undoer._id}
-        return self.db.Event.collection.find(search).count()
+    def on_event_added(self, event, user):
+        """called every time an event has been created or restored"""
+        self.incr_total_no_events()
+        self.tag_index.add(user['_id'], event['tags'])
+        self.daily_rollups.add(user['_id'], event)
+        self.bump_events_version(user)
+
+    def on_event_removed(self, event, user):
+        """called every time an event of the user has been deleted (i.e.
+        chown'ed to the undoer)"""
+        self.decr_total_no_events()
+        self.tag_index.remove(user['_id'], event['tags'])
+        self.daily_rollups.remove(user['_id'], event)
+        self.bump_events_version(user)
+
+    def on_event_edited(self, event, user, previous):
+        """called every time an event has been edited, moved or resized.
+        `previous` is a copy of the event from before it was changed."""
+        self.tag_index.change(user['_id'], previous['tags'], event['tags'])
+        self.daily_rollups.change(user['_id'], previous, event)
+        self.bump_events_version(user)
+
+    def get_io_loop(self):
+        """return the IOLoop this request is being served on"""
+        try:
+            return self.request.connection.stream.io_loop
+        except AttributeError:
+            return tornado.ioloop.IOLoop.instance()
 
     def share_keys_to_share_objects(self, shares):
         if not shares:
@@ -399,33 +576,83 @@ class BaseHandler(tornado.web.RequestHandler, HTTPSMixin):
         keys = [x for x in shares.split(',') if x]
         return self.db.Share.collection.find({'key':{'$in':keys}})
 
+    SHARE_COLORS = ('#5C8D87', '#994499', '#6633CC', '#B08B59', '#DD4477',
+                    '#22AA99', '#668CB3', '#DD5511', '#D6AE00', '#668CD9',
+                    '#3640AD')
+
+    def get_shared_events(self, shares, start, end):
+        """return the events, as (event, extra) pairs like get_events_data(),
+        and the sharers of the shares (a list from
+        share_keys_to_share_objects()).
+
+        The owners of all the shares are fetched in one query and all their
+        events in one more. The events are then grouped per share, in the
+        order of the shares, in memory.
+        """
+        if not shares:
+            return [], []
+
+        owners = {}
+        for owner in self.db.User.collection.find(
+          {'_id': {'$in': [x['user'] for x in shares]}}):
+            owners[owner['_id']] = owner
+        shares = [x for x in shares if x['user'] in owners]
+
+        clauses = []
+        for share in shares:
+            clause = {'user.$id': share['user'],
+                      'start': {'$gte': start},
+                      'end': {'$lt': end}}
+            if share['tags']:
+                clause['tags'] = {'$in': share['tags']}
+            clauses.append(clause)
+        found = []
+        if clauses:
+            found = list(find_event_rows(self.db.Event.collection,
+                                         {'$or': clauses},
+                                         SHARED_CALENDAR_FIELDS))
+
+        events = []
+        sharers = []
+        colors = iter(self.SHARE_COLORS)
+        for share in shares:
+            owner = owners[share['user']]
+            className = 'share-%s' % owner['_id']
+            full_name = u"%s %s" % (owner['first_name'], owner['last_name'])
+            full_name = full_name.strip()
+            if not full_name:
+                full_name = owner['email']
+            color = colors.next()
+            sharers.append(dict(className=className,
+                                full_name=full_name,
+                                key=share['key'],
+                                color=color,
+                                ))
+
+            share_tags = set(share['tags'])
+            for event in found:
+                if event['user'].id != owner['_id']:
+                    continue
+                if share_tags and not share_tags.intersection(event['tags']):
+                    continue
+                events.append((event, dict(className=className,
+                                           editable=False,
+                                           color=color)))
+        return events, sharers
+
     def get_all_available_tags(self, user, refresh=False):
-        redis_key = 'all_available_tags:%s' % user['_id']
         if refresh:
-            return self._get_all_available_tags(user, redis_key)
-        if self.redis.exists(redis_key):
-            return self.redis.smembers(redis_key)
-        return self._get_all_available_tags(user, redis_key)
-
-    def _get_all_available_tags(self, user, redis_key):
-        tags = set()
-        search = {'user.$id': user['_id'],
-                  'tags': {'$ne': []}}
-        for event in self.db.Event.collection.find(search):
-            for tag in event['tags']:
-                tags.add(tag)
-        for tag in tags:
-            self.redis.sadd(redis_key, tag)
-        return tags
+            self.tag_index.rebuild(user['_id'])
+        return self.tag_index.get_tags(user['_id'])
 
-    def get_undoer_user(self, create_if_necessary=False):
-        guid = self.application.settings['UNDOER_GUID']
-        undoer = self.db.User.one(dict(guid=guid))
-        if undoer is None:
-            undoer = self.db.User()
-            undoer.guid = guid
-            undoer.save()
-        return undoer
+    def get_undoer_id(self):
+        return self.application.settings['UNDOER_ID']
+
+    def get_undoer_user(self):
+        # The undoer was looked up (or created) when the application started
+        # so there's no need to go to the database just to chown to it.
+        return self.db.User(dict(_id=self.get_undoer_id(),
+                                 guid=self.application.settings['UNDOER_GUID']))
 
 @route('/xsrf.json$')
 class XSRFHandler(BaseHandler):
@@ -433,6 +660,21 @@ class XSRFHandler(BaseHandler):
         self.write_json(dict(xsrf=self.xsrf_token))
 
 
+@route('/cache/stats\.json$')
+class CacheStatsHandler(BaseHandler):
+    """hit and miss counters of the caches in this process"""
+
+    @login_required
+    def get(self):
+        user = self.get_current_user()
+        if user.email not in self.application.settings['admin_emails']:
+            raise tornado.web.HTTPError(403, "Not available to you")
+        data = dict()
+        if self.user_cache is not None:
+            data['user_cache'] = self.user_cache.get_stats()
+        self.write_json(data)
+
+
 class APIHandlerMixin(object):
 
     def check_guid(self):
@@ -442,7 +684,7 @@ class APIHandlerMixin(object):
                 guid = self.get_secure_cookie('guid', value=guid)
                 #if guid.startswith('"') and guid.endswith('"'):
                 #    guid = guid[1:-1]
-            user = self.db[User.__collection__].one({'guid':guid})
+            user = self.get_user_by_guid(guid)
             if user:
                 return user
             else:
@@ -540,20 +782,37 @@ class SplashHandler(BaseHandler):
 @route(r'/events(\.json|\.js|\.xml|\.txt|/)?')
 class EventsHandler(BaseHandler):
 
+    @tornado.web.asynchronous
     def get(self, format=None):
+        # big responses are streamed by write_events_data()
+        self.get_events(format)
+        self.finish_unless_writing_chunks()
+
+    def get_events(self, format=None):
         user = self.get_current_user()
-        shares = self.get_secure_cookie('shares')
+        # looked up once for both the ETag and the events
+        shares = list(self.share_keys_to_share_objects(
+          self.get_secure_cookie('shares')))
+        etag = self.get_events_etag(user, shares, format, self.request.uri,
+                                    self.get_secure_cookie('hidden_shares'))
+        if self.not_modified(etag):
+            return
         data = self.get_events_data(user, shares,
                            include_tags=self.get_argument('include_tags', None),
                            include_hidden_shares=\
-                             self.get_argument('include_hidden_shares', None))
+                             self.get_argument('include_hidden_shares', None),
+                           stream=True)
         self.write_events_data(data, format)
 
 
     def get_events_data(self, user, shares, include_tags=False,
-                        include_hidden_shares=False):
-        events = list()
-        sharers = list()
+                        include_hidden_shares=False, stream=False):
+        # (event, extra) pairs where extra is None or the extra keyword
+        # arguments for transform_fullcalendar_event()
+        # If stream is true data['events'] is a generator that reads the
+        # events from the cursor as it goes instead of a list. Then the
+        # tags of the events, if asked for, are only added to data once
+        # all of the events have been read.
         data = dict()
 
         if include_tags == 'all':
@@ -588,57 +847,28 @@ class EventsHandler(BaseHandler):
         search['start'] = {'$gte': start}
         search['end'] = {'$lt': end}
 
+        rows = []
         if user:
             search['user.$id'] = user['_id']
-            for event in self.db.Event.collection.find(search):
-                events.append(self.transform_fullcalendar_event(event, True))
-                if include_tags and include_tags != 'all':
-                    tags.update(event['tags'])
+            rows = find_event_rows(self.db.Event.collection, search,
+                                   CALENDAR_FIELDS)
 
-        _share_colors = '#5C8D87,#994499,#6633CC,#B08B59,#DD4477,#22AA99,'\
-                        '#668CB3,#DD5511,#D6AE00,#668CD9,#3640AD'.split(',')
-        _share_colors = iter(_share_colors)
-        for share in self.share_keys_to_share_objects(shares):
-            share_user = self.db.User.collection.one(dict(_id=share['user']))
-            search['user.$id'] = share_user['_id']
-            if share['tags']:
-                search['tags'] = {'$in': share['tags']}
-            className = 'share-%s' % share_user['_id']
-            full_name = u"%s %s" % (share_user['first_name'], share_user['last_name'])
-            full_name = full_name.strip()
-            if not full_name:
-                full_name = share_user['email']
-            _share_color = _share_colors.next()
-            sharers.append(dict(className=className,
-                                full_name=full_name,
-                                key=share['key'],
-                                color=_share_color,
-                                ))
+        shared_events, sharers = self.get_shared_events(shares, start, end)
 
-            for event in self.db.Event.collection.find(search):
-                events.append(
-                  self.transform_fullcalendar_event(
-                    event,
-                    True,
-                    className=className,
-                    editable=False,
-                    color=_share_color
-                    ))
-
-        data['events'] = events
-
-        if include_tags:
-            tags = list(tags)
-            tags.sort(lambda x, y: cmp(x.lower(), y.lower()))
-            if tags:
-                # if the user prefers to start his tags with a # instead of an @
-                # then we need to find that out by interrogating the user settings.b
-                user_settings = self.get_current_user_settings(user, fast=True)
-                if user_settings and user_settings['hash_tags']:
-                    tags = ['#%s' % x for x in tags]
-                else:
-                    tags = ['@%s' % x for x in tags]
-            data['tags'] = tags
+        def iter_events():
+            for event in rows:
+                if include_tags and include_tags != 'all':
+                    tags.update(event['tags'])
+                yield event, None
+            for pair in shared_events:
+                yield pair
+            if include_tags:
+                data['tags'] = self.format_tags(user, tags)
+
+        if stream:
+            data['events'] = iter_events()
+        else:
+            data['events'] = list(iter_events())
 
         if include_hidden_shares:
             data['hidden_shares'] = hidden_shares
@@ -649,22 +879,59 @@ class EventsHandler(BaseHandler):
 
         return data
 
+    def format_tags(self, user, tags):
+        tags = list(tags)
+        tags.sort(lambda x, y: cmp(x.lower(), y.lower()))
+        if tags:
+            # if the user prefers to start his tags with a # instead of an @
+            # then we need to find that out by interrogating the user settings.b
+            user_settings = self.get_current_user_settings(user, fast=True)
+            if user_settings and user_settings['hash_tags']:
+                tags = ['#%s' % x for x in tags]
+            else:
+                tags = ['@%s' % x for x in tags]
+        return tags
+
+    def transform_events_data(self, data, stream=False):
+        """turn the (event, extra) pairs from get_events_data() into
+        fullcalendar dicts. If stream is true they're turned into a generator
+        that transforms them one at a time."""
+        events = (self.transform_fullcalendar_event(event, True,
+                                                    **(extra or {}))
+                  for event, extra in data['events'])
+        if stream:
+            data['events'] = events
+        else:
+            data['events'] = list(events)
+        return data
+
+    def iter_events_txt(self, data):
+        yield 'ENTRIES\n'
+        for event in data['events']:
+            yield pformat(event) + '\n\n'
+        if 'tags' in data:
+            yield 'TAGS\n'
+            yield '\n'.join(data['tags'])
+            yield '\n'
+
     def write_events_data(self, data, format):
+        """write the events data from get_events_data(), which can be
+        streamed, a bit at a time with write_chunks()"""
         if format in ('.json', '.js', None):
-            self.write_json(data, javascript=format=='.js')
-        elif format == '.xml':
-            self.write_xml(data)
+            if format == '.js':
+                self.set_header("Content-Type", "text/javascript; charset=UTF-8")
+            else:
+                self.set_header("Content-Type", "application/json; charset=UTF-8")
+            self.write_chunks(iter_encode_events_data(data))
+            return
+
+        self.transform_events_data(data, stream=True)
+        if format == '.xml':
+            self.set_header("Content-Type", "text/xml; charset=UTF-8")
+            self.write_chunks(iter_dict_to_xml(data, first=('events',)))
         elif format == '.txt':
-            out = StringIO()
-            out.write('ENTRIES\n')
-            for event in data['events']:
-                pprint(event, out)
-                out.write("\n")
-            if 'tags' in data:
-                out.write('TAGS\n')
-                out.write('\n'.join(data['tags']))
-                out.write("\n")
-            self.write_txt(out.getvalue())
+            self.set_header("Content-Type", "text/plain; charset=UTF-8")
+            self.write_chunks(self.iter_events_txt(data))
 
     def get_event_url(self, event):
         url = '/#'
@@ -782,16 +1049,17 @@ class EventsHandler(BaseHandler):
                 else:
                     user_settings.hash_tags = True
                     user_settings.save()
+                # the tags in the events feed change prefix
+                self.bump_events_version(user)
             else:
                 # the user might have hash_tags on already
                 # if that's the case and this one was with @ signs then change back
                 if hash_tags_prev and all_atsign_tags(tags, title):
                     user_settings.hash_tags = False
                     user_settings.save()
+                    self.bump_events_version(user)
 
         self.case_correct_tags(tags, user)
-        self.reset_tags_cache(user)
-        self.incr_total_no_events()
 
         for event in self.db.Event.find({
             'user.$id': user._id,
@@ -816,6 +1084,7 @@ class EventsHandler(BaseHandler):
             assert isinstance(external_url, unicode), type(external_url)
             event.external_url = external_url.strip()
         event.save()
+        self.on_event_added(event, user)
 
         return event, True
 
@@ -826,8 +1095,7 @@ class EventsHandler(BaseHandler):
                       tags=['%s%s' % (tag_prefix, x) for x in event.tags],
                       )
         if format == '.xml':
-            self.set_header("Content-Type", "text/xml; charset=UTF-8")
-            self.write(dict_to_xml(result))
+            self.write_xml(result)
         else:
             # default is json
             self.set_header("Content-Type", "application/json")
@@ -848,10 +1116,13 @@ class APIVersionHandler(APIHandlerMixin, BaseHandler):
             self.write_txt(unicode(data['version']))
 
 
+# seconds
+API_EVENTS_CACHE_TIME = 60 * 60 * 12
+
 @route(r'/api/events(\.json|\.js|\.xml|\.txt|/)?')
 class APIEventsHandler(APIHandlerMixin, EventsHandler):
 
-    def get(self, format=None):
+    def get_events(self, format=None):
         user = self.check_guid()
         if not user:
             return
@@ -871,32 +1142,42 @@ class APIEventsHandler(APIHandlerMixin, EventsHandler):
             return self.write("end timestamp not supplied")
 
         shares = self.get_argument('shares', u'')#self.get_secure_cookie('shares')
+        # looked up once for the ETag, the events and the cache
+        shares = list(self.share_keys_to_share_objects(shares))
 
-        redis_key = None
+        etag = self.get_events_etag(user, shares, format, self.request.uri)
+        if self.not_modified(etag):
+            return
+
+        cache = None
         if not self.get_argument('refresh', False) and format == '.json':
-            # then we can aggressively cache for a short time
-            redis_key = 'api_event_json:%s:%s:%s:%s' % (
-              user['_id'],
-              shares,
-              start,
-              end
-            )
-            data = self.redis.get(redis_key)
+            # the ETag changes as soon as any of the events might have and
+            # the entries are deleted when they do so this can be cached
+            # for as long as we like
+            cache = self.api_events_cache
+            data = cache.get(etag)
             if data is not None:
                 self.set_header("Content-Type",
                                 "application/json; charset=UTF-8")
                 self.write(data)
                 return
 
+        # the cached JSON has to be built in full anyway
         data = self.get_events_data(user, shares,
-            include_tags=self.get_argument('include_tags', None))
-
-        if redis_key is not None:
-            # caching for a very short time because it's hard to invalid a
-            # piece of cache data like this
-            self.redis.setex(redis_key, tornado.escape.json_encode(data), 30)
+            include_tags=self.get_argument('include_tags', None),
+            stream=cache is None)
+
+        if cache is not None:
+            body = encode_events_data(data)
+            user_ids = [user['_id']]
+            user_ids.extend(share['user'] for share in shares)
+            cache.set(etag, body, user_ids)
+            self.set_header("Content-Type", "application/json; charset=UTF-8")
+            self.write(body)
+            return
 
         if format == '.js':
+            self.transform_events_data(data)
             # pack the dict into a tuple instead.
             _events = []
             for event in data['events']:
@@ -910,6 +1191,7 @@ class APIEventsHandler(APIHandlerMixin, EventsHandler):
                   event.get('description', u''),
                 ))
             data['events'] = _events
+            return self.write_json(data, javascript=True)
         self.write_events_data(data, format)
 
 
@@ -942,7 +1224,7 @@ class APIEventsHandler(APIHandlerMixin, EventsHandler):
         #    return self.write("date or (start and end) not supplied")
 
         guid = self.get_argument('guid')
-        user = self.db.User.one({'guid': guid})
+        user = self.get_user_by_guid(guid)
 
         description = self.get_argument("description", None)
         external_url = self.get_argument("external_url", None)
@@ -1005,7 +1287,7 @@ class BaseEventHandler(BaseHandler):
         if not event:
             raise tornado.web.HTTPError(404, "Can't find the event")
 
-        if event.user == user:
+        if event.user._id == user['_id']:
             pass
         elif shares:
             # Find out if for any of the shares we have access to the owner of
@@ -1095,8 +1377,7 @@ class EditEventHandler(BaseEventHandler):
             raise tornado.web.HTTPError(404, "Invalid ID")
 
         if action == 'undodelete':
-            undoer = self.get_undoer_user()
-            search['user.$id'] = undoer._id
+            search['user.$id'] = self.get_undoer_id()
 
         event = self.db.Event.one(search)
         if not event:
@@ -1109,9 +1390,12 @@ class EditEventHandler(BaseEventHandler):
             elif not event.all_day and days and not minutes:
                 return self.write_json(dict(error=\
               "Can't resize an hourly event in days"))
+            previous = dict(event)
             event.end += datetime.timedelta(days=days, minutes=minutes)
             event.save()
+            self.on_event_edited(event, user, previous)
         elif action == 'move':
+            previous = dict(event)
             event.start += datetime.timedelta(days=days, minutes=minutes)
             event.end += datetime.timedelta(days=days, minutes=minutes)
             if event.all_day and not all_day:
@@ -1125,7 +1409,9 @@ class EditEventHandler(BaseEventHandler):
                     event.end += datetime.timedelta(hours=2)#seconds=MINIMUM_DAY_SECONDS)
             event.all_day = all_day
             event.save()
+            self.on_event_edited(event, user, previous)
         elif action == 'edit':
+            previous = dict(event)
             tags = title_to_tags(title)
             event.title = title
             event.external_url = external_url
@@ -1135,12 +1421,12 @@ class EditEventHandler(BaseEventHandler):
                 # NEED MIGRATION SCRIPTS!
                 del event['url']
             event.save()
+            self.on_event_edited(event, user, previous)
         elif action == 'delete':
             # we never actually delete. instead we chown the event to belong to
             # the special "undoer" user
-            undoer = self.get_undoer_user(create_if_necessary=True)
-            event.chown(undoer, save=True)
-            self.decr_total_no_events()
+            event.chown(self.get_undoer_user(), save=True)
+            self.on_event_removed(event, user)
             log_event(self.db, user, event,
                       actions.ACTION_DELETE,
                       contexts.CONTEXT_CALENDAR)
@@ -1149,7 +1435,7 @@ class EditEventHandler(BaseEventHandler):
 
         elif action == 'undodelete':
             event.chown(user, save=True)
-            self.incr_total_no_events()
+            self.on_event_added(event, user)
             log_event(self.db, user, event, actions.ACTION_RESTORE,
                       contexts.CONTEXT_CALENDAR)
         else:
@@ -1188,8 +1474,6 @@ class EventStatsHandler(BaseHandler):
         if not user:
             return dict(hours_spent=[], days_spent=[])
 
-        days_spent = defaultdict(float)
-        hours_spent = defaultdict(float)
         start = self.get_argument('start', None)
         end = self.get_argument('end', None)
 
@@ -1200,21 +1484,13 @@ class EventStatsHandler(BaseHandler):
         if end:
             end = parse_datetime(end)
             search['end'] = {'$lt': end}
-        for entry in self.db.Event.collection.find(search):
-            if entry['all_day']:
-                days = 1 + (entry['end'] - entry['start']).days
-                if entry['tags']:
-                    for tag in entry['tags']:
-                        days_spent[tag] += days
-                else:
-                    days_spent[u''] += days
-            else:
-                hours = (entry['end'] - entry['start']).seconds / 60.0 / 60
-                if entry['tags']:
-                    for tag in entry['tags']:
-                        hours_spent[tag] += round(hours, 1)
-                else:
-                    hours_spent[u''] += round(hours, 1)
+        backend = self.application.settings['stats_backend']
+        if backend == 'rollups':
+            days_spent, hours_spent = self.daily_rollups.time_spent(
+              user['_id'], start, end)
+        else:
+            days_spent, hours_spent = get_time_spent(
+              self.db.Event.collection, search, backend=backend)
 
         _has_untagged_events = False
 
@@ -1312,9 +1588,7 @@ class UserSettingsHandler(BaseHandler):
                     default[key] = getattr(user_settings, key, False)
                 default['first_hour'] = getattr(user_settings, 'first_hour', 8)
             else:
-                user_settings = self.db.UserSettings()
-                user_settings.user = user._id
-                user_settings.save()
+                user_settings = self.create_user_settings(user)
 
         if format == '.js':
             self.set_header("Content-Type", "text/javascript; charset=UTF-8")
@@ -1337,9 +1611,7 @@ class UserSettingsHandler(BaseHandler):
             disable_sound = user_settings.disable_sound
             offline_mode = getattr(user_settings, 'offline_mode', False)
         else:
-            user_settings = self.db.UserSettings()
-            user_settings.user = user._id
-            user_settings.save()
+            user_settings = self.create_user_settings(user)
 
         for key in ('monday_first', 'hide_weekend', 'disable_sound',
                     'offline_mode', 'ampm_format'):
@@ -1442,6 +1714,7 @@ class EditSharingHandler(SharingHandler):
 
         share.tags = tags
         share.save()
+        self.bump_share_version(share)
 
         self.write("OK")
 
@@ -1480,7 +1753,7 @@ class SharingAddHandler(BaseHandler):
 class AccountHandler(BaseHandler):
     def get(self):
         if self.get_secure_cookie('user'):
-            user = self.db.User.one(dict(guid=self.get_secure_cookie('user')))
+            user = self.get_user_by_guid(self.get_secure_cookie('user'))
             if not user:
                 return self.write("Error. User does not exist")
             options = dict(
@@ -1503,16 +1776,17 @@ class AccountHandler(BaseHandler):
             raise tornado.web.HTTPError(400, "Not a valid email address")
 
         guid = self.get_secure_cookie('user')
-        user = self.db.User.one(dict(guid=guid))
+        user = self.get_user_for_update(self.get_user_by_guid(guid))
 
         existing_user = self.find_user(email)
-        if existing_user and existing_user != user:
+        if existing_user and existing_user._id != user._id:
             raise tornado.web.HTTPError(400, "Email address already used by someone else")
 
         user.email = email
         user.first_name = first_name
         user.last_name = last_name
         user.save()
+        self.invalidate_user_cache(user)
 
         self.redirect('/')
 
@@ -1598,6 +1872,7 @@ class RecoverForgottenPasswordHandler(ForgottenPasswordHandler):
         options['error'] = error
         self.render("user/recover_forgotten.html", **options)
 
+    @tornado.web.asynchronous
     def post(self, user_id, days, hash):
         if not self.hash_is_valid(user_id, days, hash):
             raise tornado.web.HTTPError(400, "invalid hash")
@@ -1610,8 +1885,12 @@ class RecoverForgottenPasswordHandler(ForgottenPasswordHandler):
         if not user:
             raise tornado.web.HTTPError(400, "invalid hash")
 
-        user.set_password(new_password)
+        self.set_user_password(user, new_password,
+                               lambda: self._on_password_set(user))
+
+    def _on_password_set(self, user):
         user.save()
+        self.invalidate_user_cache(user)
 
         #self.set_secure_cookie("guid", str(user.guid), expires_days=100)
         self.set_secure_cookie("user", str(user.guid), expires_days=100)
@@ -1670,20 +1949,27 @@ class BaseAuthHandler(BaseHandler):
 @route('/user/signup/')
 class SignupHandler(BaseAuthHandler):
 
+    @tornado.web.asynchronous
     def get(self):
         if self.get_argument('validate_email', None):
-            # some delay to make brute-force testing boring
-            sleep(0.5) # XXX This needs to be converted into an async call!
-
             email = self.get_argument('validate_email').strip()
-            if self.has_user(email):
+            found = self.has_user(email)
+            if found:
                 result = dict(error='taken')
             else:
                 result = dict(ok=True)
-            self.write_json(result)
+            # some delay to make guessing email addresses boring
+            seconds = self.attempt_limiter.record_lookup(
+              self.request.remote_ip, email, found)
+            self.delay(seconds, lambda: self.finish_json(result))
         else:
             raise tornado.web.HTTPError(404, "Nothing to check")
 
+    def finish_json(self, struct):
+        self.write_json(struct)
+        self.finish()
+
+    @tornado.web.asynchronous
     def post(self):
         email = self.get_argument('email')
         password = self.get_argument('password')
@@ -1691,27 +1977,34 @@ class SignupHandler(BaseAuthHandler):
         last_name = self.get_argument('last_name', u'')
 
         if not email:
-            return self.write("Error. No email provided")
+            return self.finish("Error. No email provided")
         elif not valid_email(email):
             raise tornado.web.HTTPError(400, "Not a valid email address")
         if not password:
-            return self.write("Error. No password provided")
+            return self.finish("Error. No password provided")
 
         if self.has_user(email):
-            return self.write("Error. Email already taken")
+            return self.finish("Error. Email already taken")
 
         if len(password) < 4:
-            return self.write("Error. Password too short")
+            return self.finish("Error. Password too short")
 
         user = self.get_current_user()
-        if not user:
+        if user:
+            user = self.get_user_for_update(user)
+        else:
             user = self.db.User()
             user.save()
         user.email = email
-        user.set_password(password)
         user.first_name = first_name
         user.last_name = last_name
+        self.set_user_password(user, password,
+                               lambda: self._on_password_set(user))
+
+    def _on_password_set(self, user):
         user.save()
+        self.invalidate_user_cache(user)
+        self.attempt_limiter.reset(user.email, self.request.remote_ip)
 
         self.notify_about_new_user(user)
 
@@ -1762,29 +2055,38 @@ class AuthLoginHandler(BaseAuthHandler):
             url += '?next=%s' % urllib_quote(next)
         self.redirect(url + '#forcelogin')
 
-    def check_credentials(self, email, password):
-        user = self.find_user(email)
-        if not user:
-            # The reason for this sleep is that if a hacker tries every single
+    def check_credentials(self, email, password, callback):
+        """call back with the user and None or None and a CredentialsError"""
+        def fail(message):
+            # The reason for this delay is that if a hacker tries every single
             # brute-force email address he can think of he would be able to
             # get quick responses and test many passwords. Try to put some break
             # on that.
-            sleep(0.5)
-            raise CredentialsError("No user by that email address")
+            seconds = self.attempt_limiter.record(self.request.remote_ip, email)
+            self.delay(seconds,
+                       lambda: callback(None, CredentialsError(message)))
 
-        if not user.check_password(password):
-            raise CredentialsError("Incorrect password")
-
-        return user
+        user = self.find_user(email)
+        if not user:
+            return fail("No user by that email address")
 
+        def on_checked(correct):
+            if correct:
+                self.attempt_limiter.reset(email, self.request.remote_ip)
+                callback(user, None)
+            else:
+                fail("Incorrect password")
+        self.check_user_password(user, password, on_checked)
 
+    @tornado.web.asynchronous
     def post(self):
         email = self.get_argument('email')
         password = self.get_argument('password')
-        try:
-            user = self.check_credentials(email, password)
-        except CredentialsError, msg:
-            return self.write("Error: %s" % msg)
+        self.check_credentials(email, password, self._on_credentials)
+
+    def _on_credentials(self, user, error):
+        if error:
+            return self.finish("Error: %s" % error)
 
         self.set_secure_cookie("user", str(user.guid), expires_days=100)
 
@@ -1817,10 +2119,7 @@ class GoogleAuthHandler(BaseAuthHandler, tornado.auth.GoogleMixin):
         last_name = user.get('last_name')
         email = user['email']
 
-        user = self.db.User.one(dict(email=email))
-        if user is None:
-            user = self.db.User.one(dict(email=re.compile(re.escape(email), re.I)))
-
+        user = self.find_user(email)
 
         if user:
             needs_save = False
@@ -1832,6 +2131,7 @@ class GoogleAuthHandler(BaseAuthHandler, tornado.auth.GoogleMixin):
                 needs_save = True
             if needs_save:
                 user.save()
+                self.invalidate_user_cache(user)
         else:
             # create a new account
             user = self.db.User()
@@ -2180,7 +2480,8 @@ class ExportHandler(ReportHandler):
         search['start'] = {'$gte': start}
         search['end'] = {'$lte': end}
         search['user.$id'] = user['_id']
-        return self.db.Event.collection.find(search).sort('start')
+        return find_event_rows(self.db.Event.collection, search,
+                               EXPORT_FIELDS, sort='start')
 
 
 @route(r'/report(\.xls|\.json|\.js|\.xml|\.txt)?', name='report_data')
@@ -2218,6 +2519,9 @@ class ReportDataHandler(EventStatsHandler):
           * tags
         Each is a list. tags[0] might be 'Project X' and data[0] is the its data.
         The data is of tuples like this: (date, count)
+
+        The interval is something like '1 day', '2 weeks', '1 month' or
+        '1 quarter'.
         """
         user = self.get_current_user()
         if not user:
@@ -2226,56 +2530,36 @@ class ReportDataHandler(EventStatsHandler):
         search['user.$id'] = user._id
         search['all_day'] = niceboolean(self.get_argument('all_day', False))
 
-        #if self.get_argument('start', None):
         start = parse_datetime(self.get_argument('start'))
         start = datetime.datetime(start.year, start.month, start.day, 0,0,0)
-        search['start'] = {'$gte': start}
-        #if self.get_argument('end', None):
         end = parse_datetime(self.get_argument('end'))
-        search['end'] = {'$lte': end}
+        try:
+            edges = get_interval_edges(start, end, interval)
+        except ValueError:
+            raise tornado.web.HTTPError(400, "Invalid interval %r" % interval)
 
-        last_date = end
+        # one scan for the events in any of the intervals and the tags of
+        # all the events in the range
+        search['start'] = {'$gte': start, '$lte': max(end, edges[-1])}
         tags = {}
-        date = start#first_date
-        for entry in self.db[Event.__collection__].find(search):
-            for tag in entry['tags']:
-                if tag not in tags:
-                    tags[tag] = []
-
+        def collect_tags(events):
+            for entry in events:
+                if entry['end'] <= end:
+                    for tag in entry['tags']:
+                        if tag not in tags:
+                            tags[tag] = []
+                yield entry
+        lumps = lump_time_spent(
+          collect_tags(find_event_rows(self.db.Event.collection, search,
+                                       STATS_FIELDS)),
+          edges)
         tags[''] = []
-        if 'start' in search:
-            search.pop('start')
-        if 'end' in search:
-            search.pop('end')
 
-        if interval == '1 week':
-            interval = datetime.timedelta(days=7)
-        else:
-            raise NotImplementedError(interval)
         ticks = []
-        tick = 1
-        while date < last_date:
-            this_search = dict(search,
-                               start={'$gte':date},
-                               end={'$lt': date + interval})
-            _found = defaultdict(float)
-            for entry in self.db[Event.__collection__].find(this_search):
-                if search['all_day']:
-                    d = (entry['end'] - entry['start']).days + 1
-                else:
-                    d = (entry['end'] - entry['start']).seconds / 3600.0
-
-                these_tags = entry['tags'] and entry['tags'] or ['']
-
-                for tag in these_tags:
-                    _found[tag] += d
-
+        for tick, found in enumerate(lumps):
             for t in tags.keys():
-                tags[t].append(_found.get(t, 0))
-
-            date += interval
-            ticks.append(tick)
-            tick += 1
+                tags[t].append(found.get(t, 0))
+            ticks.append(tick + 1)
 
         all_tags = []
         all_data = []
@@ -2312,205 +2596,45 @@ class GeneralStatisticsHandler(BaseHandler): # pragma: no cover
 class StatisticsDataHandler(BaseHandler): # pragma: no cover
 
     def get(self, report_name):
-
-        data = dict()
-        search = dict()
-
         start = parse_datetime(self.get_argument('start'))
         start = datetime.datetime(start.year, start.month, start.day, 0,0,0)
-        #search['start'] = {'$gte': start}
         end = parse_datetime(self.get_argument('end'))
         end = datetime.datetime(end.year, end.month, end.day, 0,0,0)
-        #search['end'] = {'$lte': end}
-
-        interval = None
-        if self.get_argument('interval', None):
-            interval = self.get_argument('interval')
-
-        #cumulative = None
-        #if self.get_argument('cumulative', None):
-        #    cumulative = self.get_argument('cumulative')
-
-        if not interval:
-            interval = '1 month'
-        if interval == '1 week':
-            interval = datetime.timedelta(days=7)
-        elif interval == '1 month':
-            from dateutil.relativedelta import relativedelta
-            interval = relativedelta(months=1)
-        elif interval == '1 day':
-            interval = datetime.timedelta(days=1)
-        else:
-            raise NotImplementedError(interval)
-
-        if report_name =='users':#in ('cum-users', 'new-users'):
-
-            cum_w_email = []
-            new_w_email = []
-            cum_wo_email = []
-            new_wo_email = []
-
-            date = start
-            cum_w_email_count = cum_wo_email_count = 0
-            while date < end:
-                this_search = dict(add_date={'$gte':date, '$lt':date + interval})
-                date_serialized = date.strftime('%Y-%m-%d')#mktime(date.timetuple())
-                this_count = self.db[User.__collection__]\
-                  .find(dict(this_search, email={'$ne':None})).count()
-
-                new_w_email.append((date_serialized, this_count))
-                cum_w_email.append((date_serialized, this_count + cum_w_email_count))
-                cum_w_email_count += this_count
-
-                this_count = self.db[User.__collection__]\
-                  .find(dict(this_search, email=None)).count()
-
-                new_wo_email.append((date_serialized, this_count))
-                cum_wo_email.append((date_serialized, this_count + cum_wo_email_count))
-                cum_wo_email_count += this_count
-
-                date += interval
-
-            data = dict(cum_w_email=cum_w_email,
-                        new_w_email=new_w_email,
-                        cum_wo_email=cum_wo_email,
-                        new_wo_email=new_wo_email,
-                        )
-        elif report_name == 'events':
-
-            cum = []
-            new = []
-
-            date = start
-            cum_count = 0
-            while date < end:
-                this_search = dict(add_date={'$gte':date, '$lt':date + interval})
-                date_serialized = date.strftime('%Y-%m-%d')#mktime(date.timetuple())
-                this_count = self.db[Event.__collection__]\
-                  .find(this_search).count()
-
-                new.append((date_serialized, this_count))
-                cum.append((date_serialized, this_count + cum_count))
-                cum_count += this_count
-
-                date += interval
-
-            data = dict(cum=cum,
-                        new=new,
-                        )
+        dates = dict(start=start.strftime(REPORT_DATE_FORMAT),
+                     end=end.strftime(REPORT_DATE_FORMAT))
 
+        if report_name in ('users', 'events'):
+            interval = self.get_argument('interval', None) or '1 month'
+            try:
+                get_interval_edges(start, end, interval)
+            except ValueError:
+                raise tornado.web.HTTPError(400, "Invalid interval %r" % interval)
+            data = self.get_report('stats_%s' % report_name,
+                                   interval=interval, **dates)
         elif report_name == 'numbers':
-            # misc numbers
-            numbers = self._get_numbers(start, end)
-            data['numbers'] = numbers
-
+            data = self.get_report('stats_numbers', **dates)
         elif report_name in ('no_events','no_events_anonymous'):
-            ranges = dict()
-            _prev = 0
-            for i in (0, 1, 5, 10, 25, 50, 100, 200, 400):
-                ranges[(_prev, i)] = 0
-                _prev = i
-            if report_name == 'no_events_anonymous':
-                _search = dict(email=None)
-            else:
-                _search = dict(email={'$ne':None})
-            for user in self.db.User.find(_search):
-                c = self.db[Event.__collection__].find({'user.$id': user._id}).count()
-                if c == 0:
-                    ranges[(0,0)] += 1
-                elif c == 1:
-                    ranges[(0,1)] += 1
-                else:
-                    for (f, t) in ranges:
-                        if c > f and c <= t:
-                            ranges[(f,t)] += 1
-                            break
-
-            data['numbers'] = []
-            data['labels'] = []
-            for (f, t) in sorted(ranges.keys()):
-                data['numbers'].append([ranges[(f,t)]])
-                if t == 1:
-                    label = "1"
-                elif t:
-                    label = "%s - %s" % (f, t-1)
-                else:
-                    label = "0"
-                data['labels'].append(dict(label=label))
-
-
+            # the upper bounds of the bins, e.g. ?bins=1,5,10
+            try:
+                bins = [int(x) for x in
+                        self.get_argument('bins', '').split(',') if x.strip()]
+            except ValueError:
+                raise tornado.web.HTTPError(400, "Invalid bins")
+            bins = [0] + sorted(set(x for x in bins or NO_EVENTS_BINS
+                                    if x > 0))
+            data = self.get_report('stats_no_events', bins=bins,
+                      anonymous=report_name == 'no_events_anonymous')
         elif report_name == 'usersettings':
-            #data['lines'] = list()
-            trues = list()
-            falses = list()
-            data['labels'] = list()
-
-            counts = {}
-            _translations = {
-              'hash_tags': "Tag with #",
-              'ampm_format': "AM/PM format",
-            }
-            total_count = self.db.UserSettings.collection.find().count()
-            for key in UserSettings.get_bool_keys():
-                if key in ('offline_mode'):
-                    # skip these
-                    continue
-                count_true = self.db.UserSettings.collection.find({key:True}).count()
-                p = int(100. * count_true / total_count)
-                try:
-                    label = _translations[key]
-                except KeyError:
-                    label = key.replace('_',' ').capitalize()
-                data['labels'].append(label)
-                trues.append(p)
-                falses.append(100 - p)
-
-            data['lines'] = [trues, falses]
-
+            data = self.get_report('stats_usersettings')
         else:
             raise tornado.web.HTTPError(404, report_name)
 
+        if data is None:
+            # stats.js asks again in a little while
+            self.set_status(202)
+            data = dict(pending=True)
         self.write_json(data)
 
-    def _get_numbers(self, start, end):
-        data = list()
-
-        # No. users
-        _search = {'add_date': {'$gte':start, '$lt':end}}
-        c = self.db[User.__collection__].find(_search).count()
-        #data.append(dict(number=c,
-        #                 label=u"sers"))
-
-        # No. users without email address
-        wo_search = dict(_search, email=None)
-        c2 = self.db[User.__collection__].find(wo_search).count()
-        data.append(dict(number=c-c2,
-                         label=u"Users with email address"))
-        data.append(dict(number=c2,
-                         label=u"Users without email address"))
-
-        c = self.db[Event.__collection__].find(_search).count()
-        data.append(dict(number=c,
-                         label=u"Events"))
-        diff = end - start
-        days = diff.days
-
-        data.append(dict(number='%.1f' % (c/float(days)),
-                         label=u"Events per day"))
-        if days > 28:
-            weeks = days / 7
-            data.append(dict(number='%.1f' % (c/float(weeks)),
-                             label=u"Events per week"))
-        if days > 90:
-            months = days/ 30
-            data.append(dict(number='%.1f' % (c/float(months)),
-                             label=u"Events per month"))
-
-        data.append(dict(number=self.db.EmailReminder.find(_search).count(),
-                         label=u"Email reminders set up"))
-
-        return data
-
 route_redirect('/features$', '/features/')
 @route('/features/$')
 class FeatureRequestsHandler(BaseHandler):
@@ -2804,53 +2928,33 @@ class PowerusersTop10Handler(PowerusersHandler): #pragma: no cover
         if user.email not in self.application.settings['admin_emails']:
             raise tornado.web.HTTPError(403, "Not available to you")
 
-        counts = defaultdict(int)
         days_since = int(self.get_argument('days_since', 20))
         options['days_since'] = days_since
-        since = datetime.datetime.now() - datetime.timedelta(days=days_since)
+        top = self.get_report('powerusers_top10', days_since=days_since)
+        if top is None:
+            options['power_users'] = None
+            return self.render('powerusers/top-10.html', **options)
 
-        for event in self.db[Event.__collection__].find({'start':{'$gte': since}}):
-            counts[event['user'].id] += 1
-
-        keeps = []
-        for key, count in counts.iteritems():
-            if count > 10:
-                user = self.db.User.one({'_id': key})
-                if user.email:# and user.email != 'peterbe@gmail.com':
-                    keeps.append((count, user))
-
-        keeps.sort()
-        keeps.reverse()
-        keeps = keeps[:10]
+        users = dict((x._id, x) for x in self.db.User.find(
+          {'_id': {'$in': [ObjectId(x['user']) for x in top]}}))
         options['power_users'] = []
         _today = datetime.datetime.now()
         index = 0
-        for count, user in keeps:
+        for entry in top:
+            user = users.get(ObjectId(entry['user']))
+            if not user:
+                continue
             index += 1
-            options['power_users'].append(dict(count=count,
+            options['power_users'].append(dict(count=entry['count'],
                                                index=index,
                                                user=user,
-                                               stats=self._get_usage_stats(user, since),
+                                               stats=entry['stats'],
                                                member_since=user.add_date.strftime('%d %b %Y'),
                                                age=smartertimesince(user.add_date, _today)
                                                ))
 
         return self.render('powerusers/top-10.html', **options)
 
-    def _get_usage_stats(self, user, since):
-        date = datetime.datetime(since.year, since.month, since.day, 0,0,0)
-        today = datetime.datetime.now()
-        counts = []
-        while date < today:
-            count = self.db[Event.__collection__].find(
-              {'user.$id': user._id,
-               'start':{'$gte':date, '$lt':date + datetime.timedelta(days=1)}}
-               ).count()
-            counts.append(count)
-            date += datetime.timedelta(days=1)
-
-        return dict(stats([float(x) for x in counts]), counts=counts)
-
 @route('/powerusers/(.*?)')
 class PoweruserHandler(PowerusersHandler): #pragma: no cover
 
@@ -2868,49 +2972,13 @@ class PoweruserHandler(PowerusersHandler): #pragma: no cover
             assert email, "%r missing" % full_name
             user = self.db.User.one({'email': email})
             options['user'] = user
-            options.update(self._extend_user_stats(user))
+            user_stats = self.get_report('poweruser', user_id=str(user._id))
+            options['pending'] = user_stats is None
+            options.update(user_stats or {})
             return self.render(filename, **options)
 
         raise tornado.web.HTTPError(404, "Unknown page")
 
-    def _extend_user_stats(self, user):
-        stats = {}
-        #stats['no_events'] = self.db.Event.find({'user.$id': user._id}).count()
-
-        days = (datetime.datetime.today() - user.add_date).days
-        if days > 90:
-            stats['membership_length'] = "about %s months" % (days/30)
-        else:
-            stats['membership_length'] = "%s days" % days
-
-        index = 0
-        for m in self.db[User.__collection__].find().sort('add_date', 1):
-            index += 1
-            if m['_id'] == user._id:
-                break
-        stats['member_no'] = index
-
-        total_days = total_hours = 0.0
-        count_all_day = count_in_day = 0
-        tags = set()
-        for entry in self.db[Event.__collection__].find({'user.$id': user._id}):
-            if entry['all_day']:
-                total_days += 1 + (entry['end'] - entry['start']).days
-                count_all_day += 1
-            else:
-                total_hours += (entry['end'] - entry['start']).seconds / 60.0 / 60
-                count_in_day += 1
-            tags.update([x.lower() for x in entry['tags']])
-
-        stats['no_tags'] = len(tags)
-        stats['total_hours'] = '%.1f' % total_hours
-        stats['total_days'] = int(total_days)
-        stats['prefers_all_day_events'] = count_all_day > count_in_day
-        stats['no_events'] = count_all_day + count_in_day
-        stats['events_per_week'] = '%.1f' % (stats['no_events'] / (days/7.0))
-
-        return stats
-
 @route('/testsound')
 class TestSoundHandler(BaseHandler):
     def get(self):
@@ -1,14 +1,67 @@
-# WORK IN PROGRESS
-#
-# Intention here is to write the indexes that need to be created and
-# make it possible to execute this script some how from the command
-# line.
-#
-# This file has been created as an intermediate of commenting out
-# indexes from the models.py
+# The indexes of the main app. They're built by ./bin/ensure_indexes.py which
+# also checks that the query shapes from get_query_shapes() are served by an
+# index.
+import datetime
+from pymongo import ASCENDING, DESCENDING
+from bson.objectid import ObjectId
+from models import User, UserSettings, Event, Share, FeatureRequest, \
+  FeatureRequestComment, DailyRollup
 
+# (model, key, options)
+INDEXES = (
+  (User, [('guid', ASCENDING)], {'unique': True}),
+  (User, [('email', ASCENDING)], {}),
+  (User, [('email_lower', ASCENDING)], {}),
+  (User, [('add_date', ASCENDING)], {}),
+  (UserSettings, [('user', ASCENDING)], {}),
+  (Event, [('user.$id', ASCENDING),
+           ('start', ASCENDING),
+           ('end', ASCENDING)], {}),
+  (Event, [('user.$id', ASCENDING),
+           ('add_date', DESCENDING)], {}),
+  (Event, [('external_url', ASCENDING)], {}),
+  (Event, [('add_date', ASCENDING)], {}),
+  (Event, [('start', ASCENDING)], {}),
+  (Share, [('key', ASCENDING)], {'unique': True}),
+  (Share, [('user', ASCENDING)], {}),
+  (FeatureRequest, [('vote_weight', DESCENDING)], {}),
+  (FeatureRequestComment, [('feature_request.$id', ASCENDING)], {}),
+  (FeatureRequestComment, [('user', ASCENDING)], {}),
+  (DailyRollup, [('user', ASCENDING),
+                 ('day', ASCENDING),
+                 ('tag', ASCENDING)], {'unique': True}),
+)
 
-import pymongo
-
-# SEE apps/eventlog/indexes.py for a good start
-# It's being called from ./bin/ensure_indexes.py
+def get_query_shapes():
+    """return (model, spec, sort) as used by the handlers"""
+    now = datetime.datetime.now()
+    return (
+      (User, {'guid': u''}, None),
+      (User, {'email_lower': u''}, None),
+      (User, {'add_date': {'$lt': now}}, None),
+      (UserSettings, {'user': ObjectId()}, None),
+      (Event, {'user.$id': ObjectId(),
+               'start': {'$gte': now},
+               'end': {'$lt': now}}, None),
+      (Event, {'user.$id': ObjectId(), 'all_day': False,
+               'start': {'$gte': now, '$lte': now}}, None),
+      (Event, {'user.$id': ObjectId(),
+               'start': {'$gte': now, '$lt': now}}, None),
+      (Event, {'user.$id': ObjectId(), 'tags': {'$ne': []}}, None),
+      (Event, {'user.$id': ObjectId()}, [('start', ASCENDING)]),
+      (Event, {'user.$id': ObjectId(), 'external_url': u''}, None),
+      (Event, {'user.$id': ObjectId(), 'start': {'$lt': now}},
+       [('add_date', DESCENDING)]),
+      (Event, {'external_url': u'', 'title': u'', 'start': now}, None),
+      (Event, {'add_date': {'$gte': now, '$lt': now}}, None),
+      (Event, {'start': {'$gte': now}}, None),
+      (Share, {'key': {'$in': [u'']}}, None),
+      (Share, {'user': ObjectId()}, None),
+      (FeatureRequest, {}, [('vote_weight', DESCENDING)]),
+      (FeatureRequestComment, {'feature_request.$id': ObjectId(),
+                               'user': ObjectId()}, None),
+      (DailyRollup, {'user': ObjectId(),
+                     'day': {'$gte': now, '$lt': now}}, None),
+      (DailyRollup, {'user': ObjectId(), 'day': now, 'tag': u''}, None),
+      (DailyRollup, {'user': ObjectId(), 'tag': {'$regex': u'^x$'}}, None),
+    )
@@ -0,0 +1,23 @@
+from apps.main.models import User, connection
+import settings
+
+db = connection[settings.DATABASE_NAME]
+collection = db.User.collection
+
+c = 0
+seen = {}
+for each in collection.find({'email_lower': {'$exists': False}},
+                            fields=['email']):
+    email_lower = None
+    if each.get('email'):
+        email_lower = each['email'].strip().lower()
+        if email_lower in seen:
+            print "WARNING! Same email", repr(each['email']), \
+              "used by", each['_id'], "and", seen[email_lower]
+        seen[email_lower] = each['_id']
+    collection.update({'_id': each['_id']},
+                      {'$set': {'email_lower': email_lower}})
+    c += 1
+
+collection.ensure_index('email_lower', background=True)
+print "Fixed", c
@@ -3,7 +3,8 @@ import uuid
 import datetime
 from bson.objectid import ObjectId
 from mongokit import Connection, Document, ValidationError
-from utils import encrypt_password
+from utils import encrypt_password, check_encrypted_password
+from config import UNDOER_GUID
 
 from mongokit import Connection
 connection = Connection()
@@ -32,6 +33,7 @@ class User(BaseDocument):
       'guid': unicode,
       'username': unicode,
       'email': unicode,
+      'email_lower': unicode,
       'password': unicode,
       'first_name': unicode,
       'last_name': unicode,
@@ -45,25 +47,33 @@ class User(BaseDocument):
       'premium': False,
     }
 
-    def set_password(self, raw_password):
-        if isinstance(raw_password, unicode):
-            raw_password = raw_password.encode('utf8')
-        self.password = encrypt_password(raw_password)
+    def validate(self, *args, **kwargs):
+        # kept in sync with 'email' so lookups by email can be exact
+        if self['email']:
+            self['email_lower'] = self['email'].strip().lower()
+        else:
+            self['email_lower'] = None
+        super(User, self).validate(*args, **kwargs)
+
+    def set_password(self, raw_password, log_rounds=10):
+        self.password = encrypt_password(raw_password, log_rounds=log_rounds)
 
     def check_password(self, raw_password):
         """
         Returns a boolean of whether the raw_password was correct. Handles
         encryption formats behind the scenes.
         """
-        if '$bcrypt$' in self.password:
-            import bcrypt
-            password = self.password
-            hashed = password.split('$bcrypt$')[-1].encode('utf8')
-            if isinstance(raw_password, unicode):
-                raw_password = raw_password.encode('utf8')
-            return hashed == bcrypt.hashpw(raw_password, hashed)
-        else:
-            raise NotImplementedError("No checking clear text passwords")
+        return check_encrypted_password(raw_password, self.password)
+
+
+def get_or_create_undoer(db, guid=UNDOER_GUID):
+    """return the special user that deleted events belong to"""
+    undoer = db.User.one(dict(guid=guid))
+    if undoer is None:
+        undoer = db.User()
+        undoer.guid = guid
+        undoer.save()
+    return undoer
 
 
 @register
@@ -97,11 +107,7 @@ class UserSettings(BaseDocument):
       'first_hour': lambda x: 0 <= int(x) < 24
     }
 
-    #indexes = [
-    #  {'fields': 'user.$id',
-    #   'check': False,
-    #   'unique': True},
-    #]
+    # indexes are in indexes.py
 
     @property
     def user(self):
@@ -129,9 +135,7 @@ class Event(BaseDocument):
     use_autorefs = True
     required_fields = ['user', 'title', 'all_day', 'start', 'end']
 
-    #indexes = [
-    #  {'fields': ['user.$id', 'start', 'end'], 'check':False},
-    #]
+    # indexes are in indexes.py
 
     validators = {
       'title': lambda x: x.strip()
@@ -147,6 +151,24 @@ class Event(BaseDocument):
         if save:
             self.save()
 
+@register
+class DailyRollup(Document):
+    """the time spent on one tag by one user on the events that start on
+    one day. Maintained by rollups.DailyRollups."""
+    __collection__ = 'daily_rollups'
+    structure = {
+      'user': ObjectId,
+      'day': datetime.datetime,
+      'tag': unicode,
+      # days of the all day events
+      'days': int,
+      # hours of the other events, rounded to one decimal each, times ten
+      'tenths': int,
+      # the end of the event that ends last
+      'latest_end': datetime.datetime,
+    }
+    use_dot_notation = True
+
 @register
 class Share(BaseDocument):
     __collection__ = 'shares'
@@ -162,10 +184,7 @@ class Share(BaseDocument):
 
     required_fields = ['user']
 
-    #indexes = [
-    #  {'fields': ['user.$id'], 'check':False},
-    #  {'fields': ['key'], 'unique': True},
-    #]
+    # indexes are in indexes.py
 
     @classmethod
     def generate_new_key(cls, collection, min_length=6):
@@ -0,0 +1,56 @@
+import logging
+import threading
+from functools import partial
+from Queue import Queue
+from utils import encrypt_password, check_encrypted_password, get_log_rounds
+
+
+class PasswordService(object):
+    """Runs bcrypt in a fixed number of worker threads so that hashing and
+    checking passwords doesn't block the IOLoop. py-bcrypt releases the GIL
+    whilst it's hashing so the IOLoop keeps serving other requests.
+
+    The callbacks are called on the IOLoop that is passed in, with None if
+    bcrypt failed.
+    """
+
+    def __init__(self, workers=2, log_rounds=10):
+        self.workers = workers
+        self.log_rounds = log_rounds
+        self._jobs = Queue()
+        self._threads = []
+
+    def _start(self):
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            func, args, callback, io_loop = self._jobs.get()
+            result = None
+            try:
+                result = func(*args)
+            except Exception:
+                logging.error("Password job failed", exc_info=True)
+            io_loop.add_callback(partial(callback, result))
+
+    def _submit(self, io_loop, callback, func, *args):
+        if not self._threads:
+            self._start()
+        self._jobs.put((func, args, callback, io_loop))
+
+    def encrypt(self, raw_password, io_loop, callback):
+        """call back with the encrypted password"""
+        self._submit(io_loop, callback, encrypt_password, raw_password,
+                     self.log_rounds)
+
+    def check(self, raw_password, encrypted, io_loop, callback):
+        """call back with True or False"""
+        self._submit(io_loop, callback, check_encrypted_password,
+                     raw_password, encrypted)
+
+    def needs_rehash(self, encrypted):
+        return get_log_rounds(encrypted) != self.log_rounds
@@ -0,0 +1,328 @@
+"""Reports that are too slow to work out while a request waits for them.
+
+The admin statistics and the power users pages ask for a report with
+ReportQueue.get() which returns the data of the last time it was worked out
+and, if there's none or it's too old, puts a job on a Redis list. The jobs
+are done by ./bin/run_report_worker.py which stores the data for the next
+request. Until there's any data the pages say that it's being worked out.
+
+Reports are functions of (db, redis, **params) that return something JSON
+serializable. They're registered in REPORTS.
+"""
+
+import time
+import datetime
+from hashlib import sha1
+from collections import defaultdict
+from bson.objectid import ObjectId
+from tornado.escape import json_encode, json_decode
+from utils import stats
+from models import User, UserSettings, Event
+from stats import get_interval_edges
+from sitestats import SiteStats, count_events_per_user, day_number, EPOCH
+from apps.emailreminders.models import EmailReminder
+
+DATE_FORMAT = '%Y-%m-%d'
+
+
+def _parse_date(value):
+    return datetime.datetime.strptime(value, DATE_FORMAT)
+
+
+def _interval_counts(db, redis, report, start, end, interval):
+    start, end = _parse_date(start), _parse_date(end)
+    edges = get_interval_edges(start, end, interval)
+    counts = SiteStats(db, redis).get_interval_counts(report, edges)
+    return [(date.strftime(DATE_FORMAT), count)
+            for date, count in zip(edges, counts)]
+
+
+def stats_users(db, redis, start, end, interval):
+    cum_w_email = []
+    new_w_email = []
+    cum_wo_email = []
+    new_wo_email = []
+
+    cum_w_email_count = cum_wo_email_count = 0
+    for date, (w_count, wo_count) in _interval_counts(db, redis, 'users',
+                                                      start, end, interval):
+        new_w_email.append((date, w_count))
+        cum_w_email.append((date, w_count + cum_w_email_count))
+        cum_w_email_count += w_count
+
+        new_wo_email.append((date, wo_count))
+        cum_wo_email.append((date, wo_count + cum_wo_email_count))
+        cum_wo_email_count += wo_count
+
+    return dict(cum_w_email=cum_w_email,
+                new_w_email=new_w_email,
+                cum_wo_email=cum_wo_email,
+                new_wo_email=new_wo_email,
+                )
+
+
+def stats_events(db, redis, start, end, interval):
+    cum = []
+    new = []
+
+    cum_count = 0
+    for date, (this_count,) in _interval_counts(db, redis, 'events',
+                                                start, end, interval):
+        new.append((date, this_count))
+        cum.append((date, this_count + cum_count))
+        cum_count += this_count
+
+    return dict(cum=cum,
+                new=new,
+                )
+
+
+def stats_numbers(db, redis, start, end):
+    start, end = _parse_date(start), _parse_date(end)
+    site_stats = SiteStats(db, redis)
+    data = list()
+
+    _search = {'add_date': {'$gte':start, '$lt':end}}
+    # No. users with and without email address
+    (c1, c2), = site_stats.get_interval_counts('users', [start, end])
+    data.append(dict(number=c1,
+                     label=u"Users with email address"))
+    data.append(dict(number=c2,
+                     label=u"Users without email address"))
+
+    (c,), = site_stats.get_interval_counts('events', [start, end])
+    data.append(dict(number=c,
+                     label=u"Events"))
+    diff = end - start
+    days = diff.days
+
+    data.append(dict(number='%.1f' % (c/float(days)),
+                     label=u"Events per day"))
+    if days > 28:
+        weeks = days / 7
+        data.append(dict(number='%.1f' % (c/float(weeks)),
+                         label=u"Events per week"))
+    if days > 90:
+        months = days/ 30
+        data.append(dict(number='%.1f' % (c/float(months)),
+                         label=u"Events per month"))
+
+    data.append(dict(number=db[EmailReminder.__collection__]
+                            .find(_search).count(),
+                     label=u"Email reminders set up"))
+
+    return dict(numbers=data)
+
+
+def stats_no_events(db, redis, bins, anonymous=False):
+    """the number of users per range of number of events. bins are the
+    upper bounds of the ranges starting with 0."""
+    ranges = dict()
+    _prev = 0
+    for i in bins:
+        ranges[(_prev, i)] = 0
+        _prev = i
+    if anonymous:
+        _search = dict(email=None)
+    else:
+        _search = dict(email={'$ne':None})
+    no_events = count_events_per_user(db)
+    for user in db[User.__collection__].find(_search, fields=['_id']):
+        c = no_events.get(user['_id'], 0)
+        if c == 0:
+            ranges[(0,0)] += 1
+        else:
+            for (f, t) in ranges:
+                if c > f and c <= t:
+                    ranges[(f,t)] += 1
+                    break
+
+    data = dict(numbers=[], labels=[])
+    for (f, t) in sorted(ranges.keys()):
+        data['numbers'].append([ranges[(f,t)]])
+        if t == 1:
+            label = "1"
+        elif t:
+            label = "%s - %s" % (f, t-1)
+        else:
+            label = "0"
+        data['labels'].append(dict(label=label))
+    return data
+
+
+def stats_usersettings(db, redis):
+    trues = list()
+    falses = list()
+    data = dict(labels=list())
+
+    _translations = {
+      'hash_tags': "Tag with #",
+      'ampm_format': "AM/PM format",
+    }
+    collection = db[UserSettings.__collection__]
+    total_count = collection.find().count()
+    for key in UserSettings.get_bool_keys():
+        if key in ('offline_mode'):
+            # skip these
+            continue
+        count_true = collection.find({key:True}).count()
+        p = int(100. * count_true / total_count)
+        try:
+            label = _translations[key]
+        except KeyError:
+            label = key.replace('_',' ').capitalize()
+        data['labels'].append(label)
+        trues.append(p)
+        falses.append(100 - p)
+
+    data['lines'] = [trues, falses]
+    return data
+
+
+def powerusers_top10(db, redis, days_since):
+    """the 10 users with an email address with the most (and more than 10)
+    events in the last `days_since` days, most first, with the number of
+    events of every day since"""
+    now = datetime.datetime.now()
+    since = now - datetime.timedelta(days=days_since)
+    days = range(day_number(since), day_number(now) + 1)
+
+    # the totals of all users first and then the days of only the top 10
+    counts = count_events_per_user(db, {'start': {'$gte': since}})
+    candidates = [(count, user_id) for (user_id, count) in counts.items()
+                  if count > 10]
+    candidates.sort()
+    candidates.reverse()
+    top_ids = []
+    while candidates and len(top_ids) < 10:
+        batch, candidates = candidates[:100], candidates[100:]
+        with_email = set(x['_id'] for x in db[User.__collection__].find(
+          {'_id': {'$in': [x for __, x in batch]},
+           'email': {'$nin': [None, u'']}}, fields=['_id']))
+        top_ids.extend(x for __, x in batch if x in with_email)
+    top_ids = top_ids[:10]
+
+    daily_counts = defaultdict(lambda: defaultdict(int))
+    search = {'user.$id': {'$in': top_ids},
+              'start': {'$gte': EPOCH + datetime.timedelta(days=days[0])}}
+    for event in db[Event.__collection__].find(search, fields=['user', 'start']):
+        daily_counts[event['user'].id][day_number(event['start'])] += 1
+
+    top = []
+    for user_id in top_ids:
+        per_day = [daily_counts[user_id][x] for x in days]
+        top.append(dict(user=str(user_id),
+                        count=counts[user_id],
+                        stats=dict(stats([float(x) for x in per_day]),
+                                   counts=per_day)))
+    return top
+
+
+def poweruser(db, redis, user_id):
+    user = db[User.__collection__].find_one({'_id': ObjectId(user_id)},
+                                            fields=['add_date'])
+    stats = {}
+
+    days = (datetime.datetime.today() - user['add_date']).days
+    if days > 90:
+        stats['membership_length'] = "about %s months" % (days/30)
+    else:
+        stats['membership_length'] = "%s days" % days
+
+    stats['member_no'] = 1 + db[User.__collection__].find(
+      {'add_date': {'$lt': user['add_date']}}).count()
+
+    total_days = total_hours = 0.0
+    count_all_day = count_in_day = 0
+    tags = set()
+    for entry in db[Event.__collection__].find({'user.$id': user['_id']}):
+        if entry['all_day']:
+            total_days += 1 + (entry['end'] - entry['start']).days
+            count_all_day += 1
+        else:
+            total_hours += (entry['end'] - entry['start']).seconds / 60.0 / 60
+            count_in_day += 1
+        tags.update([x.lower() for x in entry['tags']])
+
+    stats['no_tags'] = len(tags)
+    stats['total_hours'] = '%.1f' % total_hours
+    stats['total_days'] = int(total_days)
+    stats['prefers_all_day_events'] = count_all_day > count_in_day
+    stats['no_events'] = count_all_day + count_in_day
+    stats['events_per_week'] = '%.1f' % (stats['no_events'] / (days/7.0))
+
+    return stats
+
+
+# name: (function, seconds after which it's worked out again)
+REPORTS = {
+  'stats_users': (stats_users, 60 * 10),
+  'stats_events': (stats_events, 60 * 10),
+  'stats_numbers': (stats_numbers, 60 * 10),
+  'stats_no_events': (stats_no_events, 60 * 60),
+  'stats_usersettings': (stats_usersettings, 60 * 60),
+  'powerusers_top10': (powerusers_top10, 60 * 60),
+  'poweruser': (poweruser, 60 * 60 * 24),
+}
+
+
+def run_report(db, redis, name, params):
+    function, __ = REPORTS[name]
+    return function(db, redis, **params)
+
+
+class ReportQueue(object):
+
+    QUEUE_KEY = 'report_jobs'
+    DATA_KEY = 'report:%s'
+    QUEUED_KEY = 'report_queued:%s'
+    # data that isn't asked for in this long is forgotten
+    DATA_TIME = 60 * 60 * 24 * 7
+    # if a job hasn't been done in this long, say because the worker died,
+    # it can be queued again
+    QUEUED_TIME = 60 * 10
+
+    def __init__(self, redis):
+        self.redis = redis
+
+    def _job_id(self, name, params):
+        return sha1(json_encode([name, sorted(params.items())])).hexdigest()
+
+    def get(self, name, params):
+        """return the last data of the report or None if it has never been
+        worked out. Queues a job unless it's recent enough."""
+        __, max_age = REPORTS[name]
+        job_id = self._job_id(name, params)
+        stored = self.redis.get(self.DATA_KEY % job_id)
+        if stored is not None:
+            stored = json_decode(stored)
+        if stored is None or time.time() - stored['time'] > max_age:
+            self.enqueue(name, params)
+        return stored and stored['data']
+
+    def enqueue(self, name, params):
+        job_id = self._job_id(name, params)
+        if not self.redis.set(self.QUEUED_KEY % job_id, 1,
+                              nx=True, ex=self.QUEUED_TIME):
+            # already in the queue
+            return False
+        self.redis.rpush(self.QUEUE_KEY, json_encode(dict(id=job_id,
+                                                          name=name,
+                                                          params=params)))
+        return True
+
+    def work(self, db, timeout=0):
+        """wait up to timeout seconds (0 is forever) for a job, do it and
+        return it or None if there wasn't one"""
+        popped = self.redis.blpop(self.QUEUE_KEY, timeout)
+        if popped is None:
+            return None
+        job = json_decode(popped[1])
+        try:
+            data = run_report(db, self.redis, job['name'], job['params'])
+            self.redis.setex(self.DATA_KEY % job['id'],
+                             json_encode(dict(time=time.time(), data=data)),
+                             self.DATA_TIME)
+        finally:
+            self.redis.delete(self.QUEUED_KEY % job['id'])
+        return job
@@ -0,0 +1,222 @@
+import re
+import datetime
+from collections import defaultdict
+from event_rows import find_event_rows, STATS_FIELDS
+from stats import python_time_spent
+from models import DailyRollup
+
+
+def _day(dt):
+    return datetime.datetime(dt.year, dt.month, dt.day)
+
+
+def _amounts(event):
+    """return the (tag, days, tenths) the event adds to its day"""
+    if event['all_day']:
+        days, tenths = 1 + (event['end'] - event['start']).days, 0
+    else:
+        hours = (event['end'] - event['start']).seconds / 60.0 / 60
+        days, tenths = 0, int(round(round(hours, 1) * 10))
+    return [(tag, days, tenths) for tag in (event['tags'] or [u''])]
+
+
+class DailyRollups(object):
+    """The days and hours spent per user, day and tag in the daily_rollups
+    collection so that the time spent over any range can be added up from
+    one document per day and tag instead of every event.
+
+    The events are counted on the day they start. An event that starts in
+    a range but ends after it isn't counted by the stats so every day also
+    knows when its last event ends and days where that's after the end of
+    the range are added up from the events instead. Same for the first day
+    if the range doesn't start at midnight. Either way the numbers are the
+    same as stats.python_time_spent()'s.
+
+    A user's rollups are built from their events the first time they're
+    needed and after that they're kept up to date by the event hooks in
+    BaseHandler. That a user's rollups are built is a Redis key that only
+    gets set once they've all been written and that is versioned so that
+    changing what's in the rollups gets them all rebuilt.
+
+    Only /events/stats.json and /report.json without an interval use the
+    rollups. The lumped stats add up unrounded hours per interval, and the
+    power users and smartphone pages count events, not time, so they read
+    the events.
+    """
+
+    VERSION = 1
+    BUILT_KEY = 'daily_rollups_built:%s:%s'
+    # rebuilt every now and then in case any change was missed
+    BUILT_TIME = 60 * 60 * 24 * 7
+
+    def __init__(self, db, redis):
+        self.db = db
+        self.redis = redis
+        self.collection = db[DailyRollup.__collection__]
+
+    def _built_key(self, user_id):
+        return self.BUILT_KEY % (self.VERSION, user_id)
+
+    def is_built(self, user_id):
+        return self.redis.exists(self._built_key(user_id))
+
+    def rebuild(self, user_id):
+        # until it's done the hooks leave the rollups alone
+        self.redis.delete(self._built_key(user_id))
+        rollups = {}
+        for event in find_event_rows(self.db.Event.collection,
+                                     {'user.$id': user_id},
+                                     STATS_FIELDS):
+            day = _day(event['start'])
+            for tag, days, tenths in _amounts(event):
+                key = (day, tag)
+                if key not in rollups:
+                    rollups[key] = dict(user=user_id, day=day, tag=tag,
+                                        days=0, tenths=0,
+                                        latest_end=event['end'])
+                rollup = rollups[key]
+                rollup['days'] += days
+                rollup['tenths'] += tenths
+                rollup['latest_end'] = max(rollup['latest_end'], event['end'])
+
+        self.collection.remove({'user': user_id})
+        if rollups:
+            self.collection.insert(rollups.values())
+        self.redis.setex(self._built_key(user_id), 1, self.BUILT_TIME)
+
+    def _latest_ends(self, user_id, day):
+        """return tag -> when the last of the user's events of the day ends"""
+        latest = {}
+        for event in self.db.Event.collection.find(
+          {'user.$id': user_id,
+           'start': {'$gte': day, '$lt': day + datetime.timedelta(days=1)}},
+          fields=['end', 'tags']):
+            for tag in event['tags'] or [u'']:
+                if tag not in latest or event['end'] > latest[tag]:
+                    latest[tag] = event['end']
+        return latest
+
+    def _update(self, user_id, changes):
+        """apply (event, sign) changes in one bulk write. The events must
+        already be saved the way they are now."""
+        amounts = defaultdict(lambda: [0, 0])
+        ends = {}
+        shrunk = defaultdict(set)
+        for event, sign in changes:
+            day = _day(event['start'])
+            for tag, days, tenths in _amounts(event):
+                amount = amounts[(day, tag)]
+                amount[0] += sign * days
+                amount[1] += sign * tenths
+                if sign > 0:
+                    ends[(day, tag)] = max(ends.get((day, tag), event['end']),
+                                           event['end'])
+                else:
+                    shrunk[day].add(tag)
+
+        bulk = self.collection.initialize_ordered_bulk_op()
+        for (day, tag), (days, tenths) in amounts.items():
+            if not days and not tenths and (day, tag) not in ends:
+                continue
+            update = {'$inc': {'days': days, 'tenths': tenths}}
+            if (day, tag) in ends:
+                update['$max'] = {'latest_end': ends[(day, tag)]}
+            bulk.find({'user': user_id, 'day': day, 'tag': tag})\
+              .upsert().update_one(update)
+        # the latest end of the days that lost an event is worked out again
+        # and the rollups of tags that day has no events of any more go
+        for day, tags in shrunk.items():
+            latest = self._latest_ends(user_id, day)
+            for tag in tags:
+                spec = {'user': user_id, 'day': day, 'tag': tag}
+                if tag in latest:
+                    bulk.find(spec).update_one(
+                      {'$set': {'latest_end': latest[tag]}})
+                else:
+                    bulk.find(spec).remove()
+        bulk.execute()
+
+    def add(self, user_id, event):
+        """count an event that has been created or restored"""
+        if self.is_built(user_id):
+            self._update(user_id, [(event, 1)])
+
+    def remove(self, user_id, event):
+        """stop counting an event that has been deleted"""
+        if self.is_built(user_id):
+            self._update(user_id, [(event, -1)])
+
+    def change(self, user_id, previous, event):
+        """count an event that has been edited, moved or resized the way it
+        is now instead of the way it was (previous)"""
+        if not self.is_built(user_id):
+            return
+        if [previous[x] for x in STATS_FIELDS] == \
+           [event[x] for x in STATS_FIELDS]:
+            return
+        self._update(user_id, [(previous, -1), (event, 1)])
+
+    def rename_tag(self, user_id, tag):
+        """merge the rollups of any other case of the tag into the ones of
+        this case, like TagIndex.case_correct() does with the events"""
+        if not self.is_built(user_id):
+            return
+        spec = {'user': user_id,
+                'tag': {'$regex': u'^(?!%s$)(?i:%s)$' % (re.escape(tag),
+                                                         re.escape(tag))}}
+        rollups = list(self.collection.find(spec))
+        if not rollups:
+            return
+        bulk = self.collection.initialize_ordered_bulk_op()
+        for rollup in rollups:
+            target = {'user': user_id, 'day': rollup['day'], 'tag': tag}
+            bulk.find(target).upsert().update_one(
+              {'$inc': {'days': rollup['days'], 'tenths': rollup['tenths']},
+               '$max': {'latest_end': rollup['latest_end']}})
+            bulk.find({'_id': rollup['_id']}).remove_one()
+        bulk.execute()
+
+    def time_spent(self, user_id, start=None, end=None):
+        """return (days_spent, hours_spent) like the backends in stats.py do
+        for the user's events where start >= `start` and end < `end`"""
+        if not self.is_built(user_id):
+            self.rebuild(user_id)
+        spec = {'user': user_id}
+        if start:
+            spec['day'] = {'$gte': _day(start)}
+        if end:
+            spec.setdefault('day', {})['$lt'] = end
+        rollups = list(self.collection.find(spec))
+
+        exceptions = set()
+        for rollup in rollups:
+            if start and rollup['day'] < start:
+                exceptions.add(rollup['day'])
+            elif end and rollup['latest_end'] >= end:
+                exceptions.add(rollup['day'])
+
+        days_spent = defaultdict(float)
+        tenths_spent = defaultdict(int)
+        for rollup in rollups:
+            if rollup['day'] in exceptions:
+                continue
+            if rollup['days']:
+                days_spent[rollup['tag']] += rollup['days']
+            if rollup['tenths']:
+                tenths_spent[rollup['tag']] += rollup['tenths']
+        hours_spent = defaultdict(float)
+        for tag, tenths in tenths_spent.items():
+            hours_spent[tag] = tenths / 10.0
+
+        for day in exceptions:
+            search = {'user.$id': user_id,
+                      'start': {'$gte': max(day, start or day),
+                                '$lt': day + datetime.timedelta(days=1)}}
+            if end:
+                search['end'] = {'$lt': end}
+            days, hours = python_time_spent(self.db.Event.collection, search)
+            for tag, value in days.items():
+                days_spent[tag] += value
+            for tag, value in hours.items():
+                hours_spent[tag] += value
+        return days_spent, hours_spent
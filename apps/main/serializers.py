@@ -0,0 +1,94 @@
+"""Fast JSON encoding of the event lists on /events.json.
+
+Encoding the events the normal way means building a dict per event,
+converting every datetime with mktime() and then encoding the whole
+structure. Here the JSON for each event is written straight from the
+event row and the timestamps come from an EpochCache.
+
+The output decodes to exactly what tornado.escape.json_encode() of the
+dicts from BaseHandler.transform_fullcalendar_event() decodes to. Only the
+order of the keys may be different.
+"""
+
+import datetime
+from time import mktime
+from simplejson.encoder import encode_basestring_ascii
+from tornado.escape import json_encode
+
+
+class EpochCache(object):
+    """Same as mktime(dt.timetuple()) but mktime() is only called once per
+    distinct hour, i.e. at most 744 times for a month view no matter how
+    many events there are.
+
+    In the hour that repeats when the clocks go back mktime() itself can
+    return either offset, depending on what it was called with before.
+    """
+
+    def __init__(self):
+        self._hours = {}
+
+    def __call__(self, dt):
+        if not isinstance(dt, datetime.datetime):
+            return mktime(dt.timetuple())
+        key = (dt.year, dt.month, dt.day, dt.hour)
+        try:
+            base = self._hours[key]
+        except KeyError:
+            # -1 for tm_isdst like datetime.timetuple() does
+            base = self._hours[key] = mktime(key + (0, 0, 0, 0, -1))
+        return base + dt.minute * 60 + dt.second
+
+
+def _string(value):
+    return encode_basestring_ascii(value).replace('</', '<\\/')
+
+
+def encode_event(event, epoch, className=None, editable=None, color=None):
+    """return the JSON of one (serialized) fullcalendar event"""
+    parts = ['{"title": ', _string(event['title']),
+             ', "start": ', repr(epoch(event['start'])),
+             ', "end": ', repr(epoch(event['end'])),
+             ', "allDay": ', event['all_day'] and 'true' or 'false',
+             ', "id": "', str(event['_id']), '"']
+    if className is not None:
+        parts.extend((', "className": ', _string(className)))
+    if editable is not None:
+        parts.extend((', "editable": ', editable and 'true' or 'false'))
+    if color is not None:
+        parts.extend((', "color": ', _string(color)))
+    if event.get('external_url'):
+        parts.extend((', "external_url": ', _string(event['external_url'])))
+    if event.get('description'):
+        parts.extend((', "description": ', _string(event['description'])))
+    parts.append('}')
+    return ''.join(parts)
+
+
+def iter_encode_events_data(data, epoch=None):
+    """yield the JSON of the events data one event at a time where
+    data['events'] is a list, or any iterable, of (event, extra) pairs and
+    extra is None or a dict of keyword arguments for encode_event().
+
+    The other keys of data are only looked at once all the events have been
+    encoded so the events iterable can still add to them."""
+    if epoch is None:
+        epoch = EpochCache()
+    yield '{"events": ['
+    separator = ''
+    for event, extra in data['events']:
+        if extra:
+            yield separator + encode_event(event, epoch, **extra)
+        else:
+            yield separator + encode_event(event, epoch)
+        separator = ', '
+    yield ']'
+    for key, value in data.items():
+        if key != 'events':
+            yield ', %s: %s' % (_string(key), json_encode(value))
+    yield '}'
+
+
+def encode_events_data(data, epoch=None):
+    """return the JSON of the events data, see iter_encode_events_data()"""
+    return ''.join(iter_encode_events_data(data, epoch))
@@ -0,0 +1,150 @@
+"""Numbers for the charts on /stats/.
+
+Every day is counted with one map-reduce over the range instead of one
+count() per interval. Days that are over can't get any new users or events
+so their counts are kept in Redis and only the days that have never been
+counted, or aren't over yet, are counted again.
+
+The number of events of every user is also counted with one map-reduce
+instead of one count() per user. That has a result per user so it's
+written to a collection rather than returned inline.
+"""
+
+import datetime
+from bson.code import Code
+from bson.objectid import ObjectId
+from models import User, Event
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+def day_number(dt):
+    """return the number of the day of the datetime since 1970-01-01, which
+    is also what the map functions emit"""
+    return (dt - EPOCH).days
+
+def _map(value):
+    # dates are stored as UTC so this is the same day as day_number()
+    return Code("""
+    function () {
+      emit(Math.floor(this.add_date.getTime() / 86400000), %s);
+    }
+    """ % value)
+
+_reduce = Code("""
+function (key, values) {
+  var total = {};
+  values.forEach(function (value) {
+    for (var field in value) {
+      total[field] = (total[field] || 0) + value[field];
+    }
+  });
+  return total;
+}
+""")
+
+_map_user = Code("""
+function () {
+  emit(this.user.$id, 1);
+}
+""")
+
+_reduce_sum = Code("""
+function (key, values) {
+  var total = 0;
+  for (var i = 0; i < values.length; i++) {
+    total += values[i];
+  }
+  return total;
+}
+""")
+
+def count_events_per_user(db, search=None):
+    """return a dict of user ID -> number of events for every user that has
+    any events (that match the search)"""
+    # there's a result per user which is too many to return inline so
+    # they go in a collection of their own for this call
+    out = 'tmp_events_per_user_%s' % ObjectId()
+    try:
+        results = db[Event.__collection__].map_reduce(_map_user, _reduce_sum,
+                                                      out, query=search or {})
+        counts = {}
+        for result in results.find():
+            counts[result['_id']] = int(result['value'])
+        return counts
+    finally:
+        db.drop_collection(out)
+
+# name: (collection, map function, fields of the counts)
+REPORTS = {
+  'users': (User.__collection__,
+            _map('this.email == null ? {w: 0, wo: 1} : {w: 1, wo: 0}'),
+            ('w', 'wo')),
+  'events': (Event.__collection__,
+             _map('{n: 1}'),
+             ('n',)),
+}
+
+
+class SiteStats(object):
+
+    KEY = 'site_stats:%s'
+    # counts of days that are over are recounted this long after they were
+    # last cached in case things like users adding email addresses have
+    # changed them after all
+    CACHE_TIME = 60 * 60 * 24
+
+    def __init__(self, db, redis):
+        self.db = db
+        self.redis = redis
+
+    def get_daily_counts(self, report, start, end):
+        """return a dict of day number -> tuple of counts (in the order of
+        the report's fields) for every day from start up to, but not
+        including, end. start and end must be midnights."""
+        collection_name, map_, fields = REPORTS[report]
+        key = self.KEY % report
+        days = range(day_number(start), day_number(end))
+        today = day_number(datetime.datetime.now())
+        closed = [x for x in days if x < today]
+
+        counts = {}
+        if closed:
+            for day, cached in zip(closed, self.redis.hmget(key, closed)):
+                if cached is not None:
+                    counts[day] = tuple(int(x) for x in cached.split(','))
+
+        missing = [x for x in days if x not in counts]
+        if not missing:
+            return counts
+        search = {'add_date': {
+          '$gte': EPOCH + datetime.timedelta(days=missing[0]),
+          '$lt': EPOCH + datetime.timedelta(days=missing[-1] + 1)}}
+        found = {}
+        for result in self.db[collection_name].inline_map_reduce(
+          map_, _reduce, query=search):
+            found[int(result['_id'])] = tuple(int(result['value'][x])
+                                              for x in fields)
+        zeros = (0,) * len(fields)
+        to_cache = {}
+        for day in missing:
+            counts[day] = found.get(day, zeros)
+            if day < today:
+                to_cache[day] = ','.join(str(x) for x in counts[day])
+        if to_cache:
+            self.redis.hmset(key, to_cache)
+            self.redis.expire(key, self.CACHE_TIME)
+        return counts
+
+    def get_interval_counts(self, report, edges):
+        """return a list of the sums of the daily counts of each interval
+        between the edges (midnights)"""
+        counts = self.get_daily_counts(report, edges[0], edges[-1])
+        width = len(REPORTS[report][2])
+        totals = []
+        for start, end in zip(edges, edges[1:]):
+            total = [0] * width
+            for day in range(day_number(start), day_number(end)):
+                for i, count in enumerate(counts[day]):
+                    total[i] += count
+            totals.append(tuple(total))
+        return totals
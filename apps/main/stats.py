@@ -0,0 +1,146 @@
+"""The days and hours spent per tag on /events/stats.json.
+
+There are two ways of adding them up which give the same numbers:
+
+ * 'python' reads every event and adds them up in Python. It's the
+   reference implementation.
+ * 'mapreduce' lets MongoDB count the events per tag and duration so that
+   only one document per distinct (tag, duration) comes back, no matter how
+   many events there are.
+
+Both return (days_spent, hours_spent) as dicts of tag -> number where
+untagged events are under the tag u''.
+
+The lumped stats on /report.json, the time spent per tag per interval, are
+added up with lump_time_spent() in one pass over the events.
+"""
+
+import re
+import bisect
+import calendar
+import datetime
+from collections import defaultdict
+from bson.code import Code
+from event_rows import find_event_rows, STATS_FIELDS
+
+
+def python_time_spent(collection, search):
+    days_spent = defaultdict(float)
+    hours_spent = defaultdict(float)
+    for entry in find_event_rows(collection, search, STATS_FIELDS):
+        tags = entry['tags'] or [u'']
+        if entry['all_day']:
+            days = 1 + (entry['end'] - entry['start']).days
+            for tag in tags:
+                days_spent[tag] += days
+        else:
+            hours = (entry['end'] - entry['start']).seconds / 60.0 / 60
+            for tag in tags:
+                hours_spent[tag] += round(hours, 1)
+    return days_spent, hours_spent
+
+
+# emits the same days and seconds as timedelta.days and timedelta.seconds
+# in Python
+_map = Code("""
+function () {
+  var diff = this.end - this.start;
+  var days = Math.floor(diff / 86400000);
+  var seconds = Math.floor((diff - days * 86400000) / 1000);
+  var tags = this.tags && this.tags.length ? this.tags : [''];
+  for (var i = 0; i < tags.length; i++) {
+    if (this.all_day) {
+      emit({tag: tags[i], all_day: true, days: days}, 1);
+    } else {
+      emit({tag: tags[i], all_day: false, seconds: seconds}, 1);
+    }
+  }
+}
+""")
+
+_reduce = Code("""
+function (key, values) {
+  var total = 0;
+  for (var i = 0; i < values.length; i++) {
+    total += values[i];
+  }
+  return total;
+}
+""")
+
+
+def mapreduce_time_spent(collection, search):
+    days_spent = defaultdict(float)
+    hours_spent = defaultdict(float)
+    for result in collection.inline_map_reduce(_map, _reduce, query=search):
+        key = result['_id']
+        count = int(result['value'])
+        if key['all_day']:
+            days_spent[key['tag']] += (1 + int(key['days'])) * count
+        else:
+            hours = int(key['seconds']) / 60.0 / 60
+            hours_spent[key['tag']] += round(hours, 1) * count
+    return days_spent, hours_spent
+
+
+BACKENDS = {
+  'python': python_time_spent,
+  'mapreduce': mapreduce_time_spent,
+}
+
+
+def get_time_spent(collection, search, backend='mapreduce'):
+    return BACKENDS[backend](collection, search)
+
+
+_INTERVAL_REGEX = re.compile(r'^\s*(\d*)\s*(day|week|month|quarter)s?\s*$')
+
+def _add_months(date, months):
+    month = date.month - 1 + months
+    year = date.year + month // 12
+    month = month % 12 + 1
+    day = min(date.day, calendar.monthrange(year, month)[1])
+    return date.replace(year=year, month=month, day=day)
+
+
+def get_interval_edges(start, end, interval):
+    """return the edges of the intervals, like '1 week' or '3 months', that
+    cover start to end. The first is start and the last is at or after end.
+    Raises ValueError if the interval isn't understood."""
+    match = _INTERVAL_REGEX.match(interval)
+    if not match:
+        raise ValueError(interval)
+    number, unit = match.groups()
+    number = int(number or 1)
+    if not number:
+        raise ValueError(interval)
+    edges = [start]
+    while edges[-1] < end:
+        i = len(edges) * number
+        if unit == 'day':
+            edges.append(start + datetime.timedelta(days=i))
+        elif unit == 'week':
+            edges.append(start + datetime.timedelta(days=7 * i))
+        elif unit == 'month':
+            edges.append(_add_months(start, i))
+        else:
+            edges.append(_add_months(start, 3 * i))
+    return edges
+
+
+def lump_time_spent(events, edges):
+    """return a list of tag -> amount dicts, one for each interval between
+    the edges, of the events that start and end in it. The amount is days
+    for all day events and (unrounded) hours for the others."""
+    lumps = [defaultdict(float) for __ in edges[1:]]
+    for event in events:
+        i = bisect.bisect_right(edges, event['start']) - 1
+        if i < 0 or i >= len(lumps) or event['end'] >= edges[i + 1]:
+            continue
+        if event['all_day']:
+            amount = (event['end'] - event['start']).days + 1
+        else:
+            amount = (event['end'] - event['start']).seconds / 3600.0
+        for tag in event['tags'] or ['']:
+            lumps[i][tag] += amount
+    return lumps
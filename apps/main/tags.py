@@ -0,0 +1,163 @@
+import re
+from collections import defaultdict
+
+
+class TagIndex(object):
+    """Per user index of the tags used on events. For every tag, keyed by
+    its lowercase, it knows the case it's spelled with and how many events
+    use it. That means the case of the tags of a new event can be corrected
+    without searching through all of the user's events.
+
+    It's kept in two Redis hashes per user, plus a set of all the tags in
+    their canonical case and a set of the tags that some events spell in
+    another case, which get renamed the next time the tag is corrected. The
+    index is built from the events collection the first time it's needed
+    and after that it's kept up to date by the event hooks in BaseHandler.
+    """
+
+    CASE_KEY = 'tags_case:%s'
+    COUNT_KEY = 'tags_count:%s'
+    TAGS_KEY = 'all_available_tags:%s'
+    MIXED_KEY = 'tags_mixed:%s'
+    # field in the case hash that marks the index as built, even if the user
+    # has no tags at all
+    BUILT = ''
+
+    def __init__(self, db, redis):
+        self.db = db
+        self.redis = redis
+
+    def is_built(self, user_id):
+        return self.redis.hexists(self.CASE_KEY % user_id, self.BUILT)
+
+    def rebuild(self, user_id):
+        spellings = defaultdict(lambda: defaultdict(int))
+        search = {'user.$id': user_id, 'tags': {'$ne': []}}
+        for event in self.db.Event.collection.find(search, fields=['tags']):
+            for tag in event['tags']:
+                spellings[tag.lower()][tag] += 1
+
+        cases = {self.BUILT: ''}
+        counts = {}
+        mixed = []
+        for key, tags in spellings.items():
+            # events from before there was an index might spell the same tag
+            # differently so settle for the most common spelling. They're
+            # not renamed here because this can happen on a GET.
+            cases[key] = max(tags, key=tags.get)
+            counts[key] = sum(tags.values())
+            if len(tags) > 1:
+                mixed.append(key)
+
+        pipe = self.redis.pipeline()
+        pipe.delete(self.CASE_KEY % user_id, self.COUNT_KEY % user_id,
+                    self.TAGS_KEY % user_id, self.MIXED_KEY % user_id)
+        pipe.hmset(self.CASE_KEY % user_id, cases)
+        if counts:
+            pipe.hmset(self.COUNT_KEY % user_id, counts)
+        for key in counts:
+            pipe.sadd(self.TAGS_KEY % user_id, cases[key])
+        for key in mixed:
+            pipe.sadd(self.MIXED_KEY % user_id, key)
+        pipe.execute()
+
+    def get_tags(self, user_id):
+        """return all the tags the user's events use"""
+        if not self.is_built(user_id):
+            self.rebuild(user_id)
+        return set(x.decode('utf8')
+                   for x in self.redis.smembers(self.TAGS_KEY % user_id))
+
+    def _rename(self, user_id, tag):
+        """spell the tag like this on all the user's events and shares,
+        whatever case they spell it with now"""
+        # any case but this one
+        spec = {'$regex': u'^(?!%s$)(?i:%s)$' % (re.escape(tag),
+                                                 re.escape(tag))}
+        key = tag.lower()
+        # tags.$ would only rename the first one of each document so they're
+        # rewritten in full, unless they've been changed since
+        for collection, search in ((self.db.Event.collection,
+                                    {'user.$id': user_id, 'tags': spec}),
+                                   (self.db.Share.collection,
+                                    {'user': user_id, 'tags': spec})):
+            for document in collection.find(search, fields=['tags']):
+                tags = [x.lower() == key and tag or x
+                        for x in document['tags']]
+                collection.update({'_id': document['_id'],
+                                   'tags': document['tags']},
+                                  {'$set': {'tags': tags}})
+
+    def case_correct(self, user_id, tags):
+        """make the case of these tags the case used on all the user's events
+        and shares. Returns the tags that had to be renamed."""
+        if not tags:
+            return []
+        if not self.is_built(user_id):
+            self.rebuild(user_id)
+        keys = [tag.lower() for tag in tags]
+        pipe = self.redis.pipeline()
+        pipe.hmget(self.CASE_KEY % user_id, keys)
+        for key in keys:
+            pipe.sismember(self.MIXED_KEY % user_id, key)
+        results = pipe.execute()
+        renamed = []
+        for tag, key, canonical, mixed in zip(tags, keys, results[0],
+                                              results[1:]):
+            if canonical is not None:
+                canonical = canonical.decode('utf8')
+                if canonical == tag and not mixed:
+                    continue
+                self._rename(user_id, tag)
+                renamed.append(tag)
+                self.redis.srem(self.MIXED_KEY % user_id, key)
+                if self.redis.srem(self.TAGS_KEY % user_id, canonical):
+                    self.redis.sadd(self.TAGS_KEY % user_id, tag)
+            self.redis.hset(self.CASE_KEY % user_id, key, tag)
+        return renamed
+
+    def add(self, user_id, tags):
+        """count the tags of an event that has been created, restored or
+        edited. The way they're spelled becomes the canonical case."""
+        if not tags or not self.is_built(user_id):
+            # they'll be counted when the index is built
+            return
+        pipe = self.redis.pipeline()
+        for tag in tags:
+            pipe.hincrby(self.COUNT_KEY % user_id, tag.lower(), 1)
+            pipe.hget(self.CASE_KEY % user_id, tag.lower())
+            pipe.hset(self.CASE_KEY % user_id, tag.lower(), tag)
+        results = pipe.execute()
+        for tag, count, previous in zip(tags, results[::3], results[1::3]):
+            if previous is not None:
+                previous = previous.decode('utf8')
+            if previous == tag and count > 1:
+                continue
+            if previous is not None and previous != tag:
+                self.redis.srem(self.TAGS_KEY % user_id, previous)
+                if count > 1:
+                    # other events still spell it the old way
+                    self.redis.sadd(self.MIXED_KEY % user_id, tag.lower())
+            self.redis.sadd(self.TAGS_KEY % user_id, tag)
+
+    def remove(self, user_id, tags):
+        """stop counting the tags of an event that has been deleted"""
+        if not tags or not self.is_built(user_id):
+            return
+        pipe = self.redis.pipeline()
+        for tag in tags:
+            pipe.hincrby(self.COUNT_KEY % user_id, tag.lower(), -1)
+            pipe.hget(self.CASE_KEY % user_id, tag.lower())
+        results = pipe.execute()
+        for tag, count, canonical in zip(tags, results[::2], results[1::2]):
+            if count <= 0:
+                self.redis.hdel(self.COUNT_KEY % user_id, tag.lower())
+                self.redis.hdel(self.CASE_KEY % user_id, tag.lower())
+                self.redis.srem(self.MIXED_KEY % user_id, tag.lower())
+                if canonical is not None:
+                    self.redis.srem(self.TAGS_KEY % user_id, canonical)
+
+    def change(self, user_id, old_tags, new_tags):
+        """the tags of an event have been edited"""
+        self.remove(user_id, [x for x in old_tags if x not in new_tags])
+        self.add(user_id, [x for x in new_tags if x not in old_tags])
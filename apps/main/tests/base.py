@@ -41,7 +41,11 @@ class BaseHTTPTestCase(AsyncHTTPTestCase, LogTrapTestCase, HTTPClientMixin):
         if not self._once:
             self._once = True
             self._emptyCollections()
+            # the undoer user is created when the application starts
+            self._app.setup_undoer()
 
+        # all test requests come from the same IP
+        self._app.attempt_limiter.clear()
         self._app.settings['email_backend'] = 'utils.send_mail.backends.locmem.EmailBackend'
         self._app.settings['email_exceptions'] = False
         self.client = TestClient(self)
@@ -62,9 +66,12 @@ class BaseHTTPTestCase(AsyncHTTPTestCase, LogTrapTestCase, HTTPClientMixin):
         return self._app.con[self._app.database_name]
 
     def get_app(self):
+        # the tests change users directly in the database all the time
+        # so the shared user cache would only get in the way
         return app.Application(database_name='test',
                                xsrf_cookies=False,
-                               optimize_static_content=False)
+                               optimize_static_content=False,
+                               cache_users=False)
 
     def decode_cookie_value(self, key, cookie_value):
         try:
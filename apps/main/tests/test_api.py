@@ -422,3 +422,68 @@ class APITestCase(base.BaseHTTPTestCase):
                     )
         response = self.post('/api/events/', data)
         self.assertEqual(response.code, 400)
+
+    def test_cached_events_invalidated_on_change(self):
+        peter = self.get_db().users.User()
+        assert peter.guid
+        peter.save()
+
+        today = datetime.date.today()
+        week = datetime.timedelta(days=7)
+        data = dict(guid=peter.guid,
+                    start=int(mktime((today - week).timetuple())),
+                    end=int(mktime((today + week).timetuple())))
+        response = self.get('/api/events.json', data)
+        self.assertEqual(response.code, 200)
+        self.assertEqual(json.loads(response.body)['events'], [])
+
+        redis = self._app.redis
+        user_keys = 'api_event_json_keys:%s' % peter._id
+        keys = redis.smembers(user_keys)
+        self.assertEqual(len(keys), 1)
+        key = list(keys)[0]
+        self.assertTrue(redis.get(key))
+
+        response = self.post('/api/events/', dict(guid=peter.guid,
+                                                  title="Cached?",
+                                                  date=mktime(today.timetuple())))
+        self.assertEqual(response.code, 201)
+        self.assertFalse(redis.get(key))
+        self.assertFalse(redis.smembers(user_keys))
+
+        response = self.get('/api/events.json', data)
+        self.assertEqual(response.code, 200)
+        struct = json.loads(response.body)
+        self.assertEqual(len(struct['events']), 1)
+        self.assertEqual(struct['events'][0]['title'], u"Cached?")
+
+    def test_streaming_big_responses(self):
+        from apps.main.config import STREAM_FLUSH_SIZE
+        peter = self.get_db().users.User()
+        peter.save()
+
+        today = datetime.datetime.today()
+        today = datetime.datetime(today.year, today.month, today.day)
+        for i in range(300):
+            event = self.get_db().events.Event()
+            event.user = peter
+            event.title = u"Event %s %s" % (i, u"x" * 300)
+            event.all_day = True
+            event.start = event.end = today
+            event.save()
+
+        data = dict(guid=peter.guid,
+                    start=int(mktime((today - datetime.timedelta(days=1))
+                                     .timetuple())),
+                    end=int(mktime((today + datetime.timedelta(days=1))
+                                   .timetuple())))
+        response = self.get('/api/events.json', dict(data, refresh=True))
+        self.assertEqual(response.code, 200)
+        self.assertTrue(len(response.body) > STREAM_FLUSH_SIZE * 1.5)
+        struct = json.loads(response.body)
+        self.assertEqual(len(struct['events']), 300)
+
+        response = self.get('/api/events.xml', data)
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.body.count('<allDay>true</allDay>'), 300)
+        self.assertTrue(response.body.rstrip().endswith('</Result>'))
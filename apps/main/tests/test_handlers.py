@@ -6,10 +6,13 @@ import re
 import datetime
 import simplejson as json
 
+import app
 from base import BaseHTTPTestCase
-from utils import encrypt_password
+from utils import encrypt_password, get_log_rounds
 import utils.send_mail as mail
 from apps.main.config import MINIMUM_DAY_SECONDS
+from apps.main.counters import TOTAL_NO_EVENTS_KEY, RECONCILE_LOCK_KEY
+from apps.main.user_cache import invalidate_user
 from tornado_utils.http_test_client import TestClient
 
 
@@ -635,6 +638,43 @@ class ApplicationTestCase(BaseHTTPTestCase):
         struct = json.loads(response.body)
         self.assertEqual(struct['events'][0]['title'], event2.title)
 
+    def test_events_etag(self):
+        today = datetime.date.today()
+        data = {'title': "Foo",
+                'date': mktime(today.timetuple()),
+                'all_day': 'yes'}
+        response = self.client.post('/events/', data)
+        self.assertEqual(response.code, 200)
+        event_id = json.loads(response.body)['event']['id']
+
+        week = datetime.timedelta(days=7)
+        data = dict(start=mktime((today - week).timetuple()),
+                    end=mktime((today + week).timetuple()))
+        response = self.client.get('/events.json', data)
+        self.assertEqual(response.code, 200)
+        etag = response.headers['Etag']
+
+        response = self.client.get('/events.json', data,
+                                   headers={'If-None-Match': etag})
+        self.assertEqual(response.code, 304)
+        self.assertEqual(response.body, '')
+
+        # different range, different ETag
+        response = self.client.get('/events.json', dict(data, include_tags='yes'),
+                                   headers={'If-None-Match': etag})
+        self.assertEqual(response.code, 200)
+
+        response = self.client.post('/event/move/', {'id': event_id,
+                                                     'all_day': 'true',
+                                                     'days': '1',
+                                                     'minutes': 0})
+        self.assertEqual(response.code, 200)
+
+        response = self.client.get('/events.json', data,
+                                   headers={'If-None-Match': etag})
+        self.assertEqual(response.code, 200)
+        self.assertNotEqual(response.headers['Etag'], etag)
+
     def test_user_settings(self):
         response = self.client.get('/user/settings/')
         self.assertEqual(response.code, 200)
@@ -756,6 +796,13 @@ class ApplicationTestCase(BaseHTTPTestCase):
         struct = json.loads(response.body)
         self.assertEqual(struct, dict(error='taken'))
 
+        # only the whole email address counts
+        data = {'validate_email': 'eter@test.com'}
+        response = self.client.get('/user/signup/', data)
+        self.assertEqual(response.code, 200)
+        struct = json.loads(response.body)
+        self.assertEqual(struct, dict(ok=True))
+
         data = dict(email="peterbe@gmail.com",
                     password="secret",
                     first_name="Peter",
@@ -772,6 +819,94 @@ class ApplicationTestCase(BaseHTTPTestCase):
         guid = base64.b64decode(user_cookie.split('|')[0])
         self.assertEqual(user.guid, guid)
 
+    def test_email_lookups_are_delayed(self):
+        limiter = self._app.attempt_limiter
+        limiter.clear()
+        limiter.base_delay = 0.01
+        user = self.db.User()
+        user.email = u"peter@fry-it.com"
+        user.set_password(u"secret")
+        user.save()
+
+        # looking up the same email, or one that's taken, isn't counted
+        for i in range(limiter.free_attempts + 2):
+            for email in ('new@example.com', 'Peter@Fry-IT.com'):
+                response = self.client.get('/user/signup/',
+                                           {'validate_email': email})
+                self.assertEqual(response.code, 200)
+        ip_key, = [x for x in self._app.redis.keys(limiter.KEY % 'lookup:*')
+                   if '@' not in x]
+        ip = ip_key[len(limiter.KEY % 'lookup:'):]
+        self.assertEqual(int(self._app.redis.get(ip_key)), 1)
+
+        for i in range(limiter.free_attempts + 1):
+            response = self.client.get('/user/signup/',
+                                       {'validate_email': 'x%s@example.com' % i})
+            self.assertEqual(response.code, 200)
+        self.assertEqual(int(self._app.redis.get(ip_key)),
+                         limiter.free_attempts + 2)
+        self.assertTrue(limiter.record_lookup(ip, 'y@example.com',
+                                              False))
+
+        # until the client logs in
+        data = dict(email=u"peter@fry-it.com", password="secret")
+        response = self.client.post('/auth/login/', data, follow_redirects=False)
+        self.assertEqual(response.code, 302)
+        self.assertEqual(self._app.redis.get(ip_key), None)
+
+    def test_login_upgrades_password_work_factor(self):
+        user = self.db.User()
+        user.email = u"peter@fry-it.com"
+        user.password = encrypt_password(u"secret", log_rounds=4)
+        user.save()
+
+        data = dict(email=user.email, password="wrong")
+        response = self.client.post('/auth/login/', data, follow_redirects=False)
+        self.assertEqual(response.code, 200)
+        self.assertTrue('Incorrect password' in response.body)
+        user = self.db.User.one({'_id': user._id})
+        self.assertEqual(get_log_rounds(user.password), 4)
+
+        data = dict(email=user.email, password="secret")
+        response = self.client.post('/auth/login/', data, follow_redirects=False)
+        self.assertEqual(response.code, 302)
+        user = self.db.User.one({'_id': user._id})
+        self.assertEqual(get_log_rounds(user.password),
+                         self._app.password_service.log_rounds)
+        self.assertTrue(user.check_password(u"secret"))
+
+    def test_failed_logins_are_delayed(self):
+        limiter = self._app.attempt_limiter
+        self.assertEqual(limiter.get_delay(limiter.free_attempts), 0)
+        self.assertEqual(limiter.get_delay(limiter.free_attempts + 1),
+                         limiter.base_delay)
+        self.assertEqual(limiter.get_delay(limiter.free_attempts + 2),
+                         limiter.base_delay * 2)
+        self.assertEqual(limiter.get_delay(1000), limiter.max_delay)
+        limiter.base_delay = 0.01
+
+        user = self.db.User()
+        user.email = u"peter@fry-it.com"
+        user.set_password(u"secret")
+        user.save()
+
+        for i in range(limiter.free_attempts + 1):
+            data = dict(email=u"Peter@Fry-IT.com", password="wrong")
+            response = self.client.post('/auth/login/', data)
+            self.assertTrue('Incorrect password' in response.body)
+
+        email_key = limiter.KEY % 'email:peter@fry-it.com'
+        ip_key, = self._app.redis.keys(limiter.KEY % 'ip:*')
+        self.assertEqual(int(self._app.redis.get(email_key)),
+                         limiter.free_attempts + 1)
+
+        data = dict(email=u"peter@fry-it.com", password="secret")
+        response = self.client.post('/auth/login/', data, follow_redirects=False)
+        self.assertEqual(response.code, 302)
+        self.assertEqual(self._app.redis.get(email_key), None)
+        self.assertEqual(int(self._app.redis.get(ip_key)),
+                         limiter.free_attempts + 1)
+
     def test_change_account(self):
         user = self.db.User()
         user.email = u"peter@fry-it.com"
@@ -1102,6 +1237,58 @@ class ApplicationTestCase(BaseHTTPTestCase):
         self.assertEqual(struct['premium'], True)
 
 
+    def test_total_no_events_counter(self):
+        redis = self._app.redis
+        redis.set(TOTAL_NO_EVENTS_KEY, 10)
+
+        today = datetime.date.today()
+        data = {'title': "Foo",
+                'date': mktime(today.timetuple()),
+                'all_day': 'yes'}
+        response = self.client.post('/events/', data)
+        self.assertEqual(response.code, 200)
+        event_id = json.loads(response.body)['event']['id']
+        self.assertEqual(int(redis.get(TOTAL_NO_EVENTS_KEY)), 11)
+
+        # posting the exact same event again doesn't create a new one
+        response = self.client.post('/events/', data)
+        self.assertEqual(response.code, 200)
+        self.assertEqual(int(redis.get(TOTAL_NO_EVENTS_KEY)), 11)
+
+        response = self.client.post('/event/delete/', {'id': event_id})
+        self.assertEqual(response.code, 200)
+        self.assertEqual(int(redis.get(TOTAL_NO_EVENTS_KEY)), 10)
+
+        response = self.client.post('/event/undodelete/', {'id': event_id})
+        self.assertEqual(response.code, 200)
+        self.assertEqual(int(redis.get(TOTAL_NO_EVENTS_KEY)), 11)
+
+        self._app.reconcile_counters()
+        self.assertEqual(int(redis.get(TOTAL_NO_EVENTS_KEY)), 1)
+
+        # only one process reconciles at a time
+        redis.set(TOTAL_NO_EVENTS_KEY, 5)
+        redis.setnx(RECONCILE_LOCK_KEY, 1)
+        try:
+            self._app.reconcile_counters()
+        finally:
+            redis.delete(RECONCILE_LOCK_KEY)
+        self.assertEqual(int(redis.get(TOTAL_NO_EVENTS_KEY)), 5)
+        self._app.reconcile_counters()
+        self.assertEqual(int(redis.get(TOTAL_NO_EVENTS_KEY)), 1)
+
+        # a missing counter isn't started from nothing but left to the
+        # reconciler
+        redis.delete(TOTAL_NO_EVENTS_KEY)
+        response = self.client.post('/event/delete/', {'id': event_id})
+        self.assertEqual(response.code, 200)
+        self.assertEqual(redis.get(TOTAL_NO_EVENTS_KEY), None)
+        response = self.client.get('/')
+        self.assertEqual(response.code, 200)
+        self.assertEqual(redis.get(TOTAL_NO_EVENTS_KEY), None)
+        self._app.reconcile_counters()
+        self.assertEqual(int(redis.get(TOTAL_NO_EVENTS_KEY)), 0)
+
     def test_undo_delete_event(self):
         """you can delete an event and then get it back by following the undo link"""
         today = datetime.date.today()
@@ -1209,6 +1396,113 @@ class ApplicationTestCase(BaseHTTPTestCase):
         self.assertTrue(self.db.Share.one(dict(tags=[u'tAG'])))
 
 
+    def test_tag_index(self):
+        today = datetime.date.today()
+        data = {'title': "Foo @Tag @other",
+                'date': mktime(today.timetuple()),
+                'all_day': 'yes'}
+        response = self.client.post('/events/', data)
+        self.assertEqual(response.code, 200)
+        first_id = json.loads(response.body)['event']['id']
+        user = self.db.User.one()
+
+        redis = self._app.redis
+        count_key = 'tags_count:%s' % user._id
+        case_key = 'tags_case:%s' % user._id
+        tags_key = 'all_available_tags:%s' % user._id
+        self.assertEqual(redis.hget(count_key, 'tag'), '1')
+        self.assertEqual(redis.hget(case_key, 'tag'), 'Tag')
+
+        data['title'] = "Bar @tAG"
+        response = self.client.post('/events/', data)
+        self.assertEqual(response.code, 200)
+        self.assertEqual(redis.hget(count_key, 'tag'), '2')
+        self.assertEqual(redis.hget(case_key, 'tag'), 'tAG')
+        self.assertEqual(self.db.Event.find({'tags': u'tAG'}).count(), 2)
+        self.assertEqual(redis.smembers(tags_key), set(['tAG', 'other']))
+
+        data = {'id': first_id, 'title': "Foo @tAG"}
+        response = self.client.post('/event/edit/', data)
+        self.assertEqual(response.code, 200)
+        self.assertEqual(redis.hget(count_key, 'tag'), '2')
+        self.assertEqual(redis.hget(count_key, 'other'), None)
+        self.assertEqual(redis.smembers(tags_key), set(['tAG']))
+
+        response = self.client.post('/event/delete/', dict(id=first_id))
+        self.assertEqual(response.code, 200)
+        self.assertEqual(redis.hget(count_key, 'tag'), '1')
+
+        # rebuilding it gives the same result
+        redis.delete(case_key)
+        data = {'title': "Again @tag",
+                'date': mktime(today.timetuple()),
+                'all_day': 'yes'}
+        response = self.client.post('/events/', data)
+        self.assertEqual(response.code, 200)
+        self.assertEqual(redis.hget(count_key, 'tag'), '2')
+        self.assertEqual(redis.hget(case_key, 'tag'), 'tag')
+        self.assertEqual(self.db.Event.find({'tags': u'tag'}).count(), 2)
+
+        url = '/events.json'
+        response = self.client.get(url, dict(start=0, end=mktime(today.timetuple()) + 1,
+                                             include_tags='all'))
+        self.assertEqual(json.loads(response.body)['tags'], ['@tag'])
+
+        # editing an event to spell a tag differently makes that the
+        # canonical case and the others are renamed next time it's used
+        mixed_key = 'tags_mixed:%s' % user._id
+        data = {'title': "Mixed @Mixed",
+                'date': mktime(today.timetuple()),
+                'all_day': 'yes'}
+        for i in range(2):
+            response = self.client.post('/events/', data)
+            self.assertEqual(response.code, 200)
+            event_id = json.loads(response.body)['event']['id']
+        data = {'id': event_id, 'title': "Mixed @mixed"}
+        response = self.client.post('/event/edit/', data)
+        self.assertEqual(response.code, 200)
+        self.assertEqual(redis.hget(case_key, 'mixed'), 'mixed')
+        self.assertEqual(redis.smembers(mixed_key), set(['mixed']))
+        self.assertTrue('mixed' in redis.smembers(tags_key))
+        self.assertTrue('Mixed' not in redis.smembers(tags_key))
+
+        data = {'title': "Again @MIXED",
+                'date': mktime(today.timetuple()),
+                'all_day': 'yes'}
+        response = self.client.post('/events/', data)
+        self.assertEqual(response.code, 200)
+        self.assertEqual(self.db.Event.find({'tags': u'MIXED'}).count(), 3)
+        self.assertEqual(redis.smembers(mixed_key), set())
+
+        # building the index on a GET doesn't change any events
+        event = self.db.Event.one({'tags': u'MIXED'})
+        event.tags = [u'mIxEd']
+        event.save()
+        redis.delete(case_key)
+        response = self.client.get(url, dict(start=0, end=mktime(today.timetuple()) + 1,
+                                             include_tags='all'))
+        self.assertEqual(response.code, 200)
+        self.assertEqual(self.db.Event.find({'tags': u'mIxEd'}).count(), 1)
+        self.assertEqual(redis.hget(case_key, 'mixed'), 'MIXED')
+        self.assertEqual(redis.smembers(mixed_key), set(['mixed']))
+
+        # every spelling is renamed even if an event has more than one
+        data = {'title': "Two @Dup",
+                'date': mktime(today.timetuple()),
+                'all_day': 'yes'}
+        response = self.client.post('/events/', data)
+        self.assertEqual(response.code, 200)
+        event = self.db.Event.one({'tags': u'Dup'})
+        event.tags = [u'Dup', u'dup']
+        event.save()
+        data['title'] = "Again @DUP"
+        response = self.client.post('/events/', data)
+        self.assertEqual(response.code, 200)
+        self.assertEqual(self.db.Event.find({'tags': {'$in': [u'Dup', u'dup']}})
+                         .count(), 0)
+        self.assertEqual(self.db.Event.one({'_id': event._id}).tags,
+                         [u'DUP', u'DUP'])
+
     def test_feature_requests(self):
         user = self.db.User()
         user.email = u'test@com.com'
@@ -1898,6 +2192,67 @@ class ApplicationTestCase(BaseHTTPTestCase):
 
 
 
+class UserCacheTestCase(BaseHTTPTestCase):
+
+    def get_app(self):
+        return app.Application(database_name='test',
+                               xsrf_cookies=False,
+                               optimize_static_content=False,
+                               cache_users=True)
+
+    def test_changing_account_invalidates_cached_user(self):
+        user = self.db.User()
+        user.email = u"peter@fry-it.com"
+        user.first_name = u"Ptr"
+        user.set_password('secret')
+        user.save()
+
+        data = dict(email=user.email, password="secret")
+        response = self.client.post('/auth/login/', data, follow_redirects=False)
+        self.assertEqual(response.code, 302)
+
+        response = self.client.get('/auth/logged_in.json')
+        self.assertEqual(json.loads(response.body)['user_name'], 'Ptr')
+        response = self.client.get('/auth/logged_in.json')
+        self.assertEqual(json.loads(response.body)['user_name'], 'Ptr')
+
+        # only for admins
+        response = self.client.get('/cache/stats.json')
+        self.assertEqual(response.code, 403)
+        self._app.settings['admin_emails'] = [user.email]
+        response = self.client.get('/cache/stats.json')
+        self.assertEqual(response.code, 200)
+        struct = json.loads(response.body)
+        self.assertTrue(struct['user_cache']['local_hits'] >= 1)
+
+        data = {'email': 'peter@fry-it.com', 'first_name': 'Peter'}
+        response = self.client.post('/user/account/', data,
+                                    follow_redirects=False)
+        self.assertEqual(response.code, 302)
+
+        response = self.client.get('/auth/logged_in.json')
+        self.assertEqual(json.loads(response.body)['user_name'], 'Peter')
+
+        # premium is set outside the app
+        self.db.User.collection.update({'_id': user._id},
+                                       {'$set': {'premium': True}})
+        invalidate_user(self._app.redis, user.guid)
+        # the in-process tier keeps it for a while
+        self._app.user_cache.local.clear()
+        response = self.client.get('/auth/logged_in.json')
+        self.assertEqual(json.loads(response.body)['premium'], True)
+
+        # saving the account doesn't undo changes the cached user hasn't got
+        self.db.User.collection.update({'_id': user._id},
+                                       {'$set': {'premium': False}})
+        data['first_name'] = 'Pete'
+        response = self.client.post('/user/account/', data,
+                                    follow_redirects=False)
+        self.assertEqual(response.code, 302)
+        user = self.db.User.one({'_id': user._id})
+        self.assertEqual(user.first_name, u'Pete')
+        self.assertEqual(user.premium, False)
+
 
 import mock_data
 def mocked_get_authenticated_user(self, callback):
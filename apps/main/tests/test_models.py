@@ -21,6 +21,16 @@ class ModelsTestCase(BaseModelsTestCase):
         self.assertFalse(inst.check_password('Secret'))
         self.assertTrue(inst.check_password('secret'))
 
+    def test_user_email_lower(self):
+        user = self.db.User()
+        user.save()
+        self.assertEqual(user.email_lower, None)
+
+        user.email = u" Peter@Test.com"
+        user.save()
+        self.assertEqual(self.db.User.one({'email_lower': u'peter@test.com'})._id,
+                         user._id)
+
     def test_create_event(self):
         user = self.db.users.User()
         user.save()
@@ -38,6 +48,30 @@ class ModelsTestCase(BaseModelsTestCase):
 
         assert self.db.events.Event.find({"user.$id":event.user._id}).count() == 1
 
+    def test_find_event_rows(self):
+        from apps.main.event_rows import find_event_rows, STATS_FIELDS
+        user = self.db.users.User()
+        user.save()
+        event = self.db.events.Event()
+        event.user = user
+        event.title = u"Test @tag"
+        event.tags = [u"tag"]
+        event.description = u"Long"
+        event.all_day = True
+        event.start = datetime.datetime.today()
+        event.end = datetime.datetime.today()
+        event.save()
+
+        row, = find_event_rows(self.db.events.Event.collection,
+                               {'user.$id': user._id}, STATS_FIELDS)
+        self.assertEqual(row['_id'], event._id)
+        self.assertEqual(row['tags'], [u"tag"])
+        self.assertEqual(row['start'], event.start)
+        # not in the projection
+        self.assertEqual(row['description'], None)
+        self.assertEqual(row.get('description', u''), u'')
+        self.assertRaises(KeyError, lambda: row['junk'])
+
     def test_create_event_with_blank_title(self):
         user = self.db.users.User()
         user.save()
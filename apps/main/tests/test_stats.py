@@ -0,0 +1,330 @@
+import datetime
+from base import BaseModelsTestCase
+from apps.main.stats import python_time_spent, mapreduce_time_spent
+
+class StatsTestCase(BaseModelsTestCase):
+
+    def _add_event(self, user, start, end, all_day, tags):
+        event = self.db.events.Event()
+        event.user = user
+        event.title = u"Event"
+        event.all_day = all_day
+        event.start = start
+        event.end = end
+        event.tags = tags
+        event.save()
+        return event
+
+    def _rounded(self, spent):
+        return dict((tag, round(value, 1)) for (tag, value) in spent.items())
+
+    def test_backends_agree(self):
+        user = self.db.users.User()
+        user.save()
+        other = self.db.users.User()
+        other.save()
+
+        first = datetime.datetime(2010, 10, 1)
+        for i in range(40):
+            start = first + datetime.timedelta(days=i % 20, hours=i % 13,
+                                               minutes=i * 7)
+            if i % 3:
+                end = start + datetime.timedelta(minutes=3 + i * 17)
+                all_day = False
+            else:
+                start = datetime.datetime(start.year, start.month, start.day)
+                end = start + datetime.timedelta(days=i % 4)
+                all_day = True
+            tags = [[], [u'foo'], [u'foo', u'Bar'], [u'bar']][i % 4]
+            self._add_event(user, start, end, all_day, tags)
+            self._add_event(other, start, end, all_day, [u'other'])
+
+        collection = self.db.events.Event.collection
+        searches = [{'user.$id': user._id},
+                    {'user.$id': user._id,
+                     'start': {'$gte': first + datetime.timedelta(days=5)},
+                     'end': {'$lt': first + datetime.timedelta(days=15)}},
+                    {'user.$id': user._id,
+                     'start': {'$gte': first + datetime.timedelta(days=50)}},
+                   ]
+        for search in searches:
+            days_python, hours_python = python_time_spent(collection, search)
+            days_mr, hours_mr = mapreduce_time_spent(collection, search)
+            self.assertEqual(dict(days_mr), dict(days_python))
+            self.assertEqual(self._rounded(hours_mr),
+                             self._rounded(hours_python))
+
+        days_spent, hours_spent = mapreduce_time_spent(collection,
+                                                       searches[0])
+        self.assertTrue(u'' in days_spent)
+        self.assertTrue(u'' in hours_spent)
+        self.assertTrue(u'foo' in hours_spent)
+        self.assertTrue(u'other' not in hours_spent)
+
+    def test_daily_rollups(self):
+        import redis
+        from apps.main.rollups import DailyRollups
+        user = self.db.users.User()
+        user.save()
+        rollups = DailyRollups(self.db, redis.client.Redis())
+        collection = self.db.events.Event.collection
+
+        first = datetime.datetime(2010, 10, 1)
+        events = []
+        for i in range(30):
+            start = first + datetime.timedelta(days=i % 10, hours=i % 24,
+                                               minutes=i * 11)
+            if i % 3:
+                end = start + datetime.timedelta(minutes=20 + i * 13)
+                all_day = False
+            else:
+                start = datetime.datetime(start.year, start.month, start.day)
+                end = start + datetime.timedelta(days=i % 4)
+                all_day = True
+            tags = [[], [u'foo'], [u'foo', u'bar']][i % 3]
+            events.append(self._add_event(user, start, end, all_day, tags))
+        rollups.rebuild(user._id)
+
+        # changes after the rollups have been built
+        other = self.db.users.User()
+        other.save()
+        event = events[1]
+        event.chown(other, save=True)
+        rollups.remove(user._id, event)
+        event = events[2]
+        previous = dict(event)
+        event.end += datetime.timedelta(hours=1)
+        event.tags = [u'bar']
+        event.save()
+        rollups.change(user._id, previous, event)
+        event = self._add_event(user, first + datetime.timedelta(hours=23),
+                                first + datetime.timedelta(hours=25),
+                                False, [u'late'])
+        rollups.add(user._id, event)
+
+        ranges = [(None, None),
+                  (first, first + datetime.timedelta(days=5)),
+                  (first + datetime.timedelta(hours=13),
+                   first + datetime.timedelta(days=1)),
+                  (first + datetime.timedelta(days=2), None),
+                  (None, first + datetime.timedelta(days=3, hours=4))]
+        def check():
+            for start, end in ranges:
+                search = {'user.$id': user._id}
+                if start:
+                    search['start'] = {'$gte': start}
+                if end:
+                    search['end'] = {'$lt': end}
+                days_python, hours_python = python_time_spent(collection,
+                                                              search)
+                days_rollups, hours_rollups = rollups.time_spent(user._id,
+                                                                 start, end)
+                self.assertEqual(dict(days_rollups), dict(days_python))
+                self.assertEqual(self._rounded(hours_rollups),
+                                 self._rounded(dict((tag, hours)
+                                                    for (tag, hours)
+                                                    in hours_python.items()
+                                                    if hours)))
+        check()
+
+        # the case of a tag is corrected on the events
+        event = events[4]
+        previous = dict(event)
+        event.tags = [u'Foo']
+        event.save()
+        rollups.change(user._id, previous, event)
+        collection.update({'user.$id': user._id, 'tags': {'$in': [u'foo', u'Foo']}},
+                          {'$set': {'tags.$': u'FOO'}}, multi=True)
+        rollups.rename_tag(user._id, u'FOO')
+        self.assertFalse(rollups.collection.find({'user': user._id,
+                                                  'tag': {'$in': [u'foo', u'Foo']}})
+                         .count())
+        check()
+
+        # deleting the event that ends last on a day
+        day = first + datetime.timedelta(days=20)
+        short = self._add_event(user, day + datetime.timedelta(hours=9),
+                                day + datetime.timedelta(hours=10),
+                                False, [u'x'])
+        rollups.add(user._id, short)
+        long = self._add_event(user, day + datetime.timedelta(hours=9),
+                               day + datetime.timedelta(hours=30),
+                               False, [u'x'])
+        rollups.add(user._id, long)
+        long.chown(other, save=True)
+        rollups.remove(user._id, long)
+        rollup, = rollups.collection.find({'user': user._id, 'day': day})
+        self.assertEqual(rollup['latest_end'], short.end)
+        self.assertEqual(rollup['tenths'], 10)
+        short.chown(other, save=True)
+        rollups.remove(user._id, short)
+        self.assertFalse(rollups.collection.find({'user': user._id,
+                                                  'day': day}).count())
+        check()
+
+    def test_lump_time_spent(self):
+        from apps.main.stats import get_interval_edges, lump_time_spent
+        from apps.main.event_rows import EventRow
+        start = datetime.datetime(2011, 1, 31)
+        end = datetime.datetime(2011, 4, 15)
+
+        edges = get_interval_edges(start, end, '1 week')
+        self.assertEqual(len(edges), 12)
+        self.assertEqual(edges[1], datetime.datetime(2011, 2, 7))
+        self.assertTrue(edges[-2] < end <= edges[-1])
+        self.assertEqual(get_interval_edges(start, end, '1 month'),
+                         [start,
+                          datetime.datetime(2011, 2, 28),
+                          datetime.datetime(2011, 3, 31),
+                          datetime.datetime(2011, 4, 30)])
+        self.assertEqual(get_interval_edges(start, end, '1 quarter'),
+                         [start, datetime.datetime(2011, 4, 30)])
+        self.assertEqual(len(get_interval_edges(start, end, '2 days')), 38)
+        self.assertEqual(get_interval_edges(end, start, '1 day'), [end])
+        self.assertRaises(ValueError, get_interval_edges, start, end, '1 year')
+        self.assertRaises(ValueError, get_interval_edges, start, end, '0 days')
+
+        def event(start, hours, tags, all_day=False):
+            if all_day:
+                end = start + datetime.timedelta(days=hours)
+            else:
+                end = start + datetime.timedelta(hours=hours)
+            return EventRow(dict(start=start, end=end, all_day=all_day,
+                                 tags=tags))
+        events = [event(datetime.datetime(2011, 2, 1, 10), 2, [u'a']),
+                  event(datetime.datetime(2011, 2, 2, 10), 1.5, [u'a', u'b']),
+                  event(datetime.datetime(2011, 3, 1, 10), 1, []),
+                  # doesn't end in the same interval
+                  event(datetime.datetime(2011, 2, 27), 2, [u'a'], True),
+                  # before the first interval
+                  event(datetime.datetime(2011, 1, 1, 10), 1, [u'a'])]
+        lumps = lump_time_spent(events,
+                                get_interval_edges(start, end, '1 month'))
+        self.assertEqual(lumps, [{u'a': 3.5, u'b': 1.5}, {'': 1.0}, {}])
+
+    def test_site_stats(self):
+        import redis
+        from apps.main.sitestats import SiteStats
+        site_stats = SiteStats(self.db, redis.client.Redis())
+        site_stats.redis.delete(SiteStats.KEY % 'users',
+                                SiteStats.KEY % 'events')
+
+        today = datetime.datetime.today()
+        today = datetime.datetime(today.year, today.month, today.day)
+        first = today - datetime.timedelta(days=10)
+        for i in range(10):
+            user = self.db.users.User()
+            user.add_date = first + datetime.timedelta(days=i, hours=i)
+            if i % 2:
+                user.email = u'user%s@example.com' % i
+            user.save()
+            event = self._add_event(user, today, today, True, [])
+            event.add_date = user.add_date
+            event.save()
+
+        edges = [first, first + datetime.timedelta(days=3),
+                 first + datetime.timedelta(days=6),
+                 today + datetime.timedelta(days=1)]
+        self.assertEqual(site_stats.get_interval_counts('users', edges),
+                         [(1, 2), (2, 1), (2, 2)])
+        self.assertEqual(site_stats.get_interval_counts('events', edges),
+                         [(3,), (3,), (4,)])
+
+        # days that are over are only counted once but today is counted
+        # every time
+        for add_date in (first, today):
+            user = self.db.users.User()
+            user.add_date = add_date
+            user.save()
+        self.assertEqual(site_stats.get_interval_counts('users', edges),
+                         [(1, 2), (2, 1), (2, 3)])
+        self.assertEqual(site_stats.get_interval_counts('users',
+                                                        [first, today]),
+                         [(5, 5)])
+
+    def test_count_events_per_user(self):
+        from apps.main.sitestats import count_events_per_user
+        today = datetime.datetime.today()
+        users = []
+        for i in range(3):
+            user = self.db.users.User()
+            user.save()
+            for j in range(i):
+                self._add_event(user, today, today, True, [])
+            users.append(user)
+        self._add_event(users[2], today - datetime.timedelta(days=2),
+                        today, True, [])
+        counts = count_events_per_user(self.db)
+        self.assertEqual(counts, {users[1]._id: 1, users[2]._id: 3})
+        counts = count_events_per_user(
+          self.db, {'start': {'$lt': today - datetime.timedelta(days=1)}})
+        self.assertEqual(counts, {users[2]._id: 1})
+        self.assertFalse([x for x in self.db.collection_names()
+                          if x.startswith('tmp_')])
+
+    def test_report_queue(self):
+        import redis
+        from apps.main.reports import ReportQueue
+        queue = ReportQueue(redis.client.Redis())
+        queue.redis.delete(ReportQueue.QUEUE_KEY)
+        params = dict(bins=[0, 1, 5], anonymous=True)
+        job_id = queue._job_id('stats_no_events', params)
+        queue.redis.delete(ReportQueue.DATA_KEY % job_id,
+                           ReportQueue.QUEUED_KEY % job_id)
+
+        for i in range(3):
+            user = self.db.users.User()
+            user.save()
+            for j in range(i * 2):
+                self._add_event(user, datetime.datetime.today(),
+                                datetime.datetime.today(), True, [])
+
+        # nothing yet so it's queued, but only once
+        self.assertEqual(queue.get('stats_no_events', params), None)
+        self.assertEqual(queue.get('stats_no_events', params), None)
+        self.assertEqual(queue.redis.llen(ReportQueue.QUEUE_KEY), 1)
+
+        job = queue.work(self.db, timeout=1)
+        self.assertEqual(job['name'], 'stats_no_events')
+        self.assertEqual(queue.work(self.db, timeout=1), None)
+        data = queue.get('stats_no_events', params)
+        self.assertEqual(data['numbers'], [[1], [0], [2]])
+        self.assertEqual([x['label'] for x in data['labels']],
+                         ['0', '1', '1 - 4'])
+        self.assertEqual(queue.redis.llen(ReportQueue.QUEUE_KEY), 0)
+
+    def test_powerusers_top10(self):
+        from apps.main.reports import powerusers_top10
+        now = datetime.datetime.now()
+        day = datetime.timedelta(days=1)
+        since = now - 3 * day
+        users = []
+        for email in (u'a@example.com', None, u'c@example.com',
+                      u'd@example.com'):
+            user = self.db.users.User()
+            user.email = email
+            user.save()
+            users.append(user)
+        a, b, c, d = users
+        for i in range(6):
+            self._add_event(a, now, now, True, [])
+            self._add_event(a, now - 2 * day, now - 2 * day, True, [])
+        # on the first day but before `since`
+        midnight = datetime.datetime(since.year, since.month, since.day)
+        self._add_event(a, midnight, midnight, True, [])
+        for i in range(15):
+            self._add_event(b, now, now, True, [])
+        for i in range(11):
+            self._add_event(c, now - day, now - day, True, [])
+        for i in range(5):
+            self._add_event(d, now, now, True, [])
+        # too long ago
+        for i in range(20):
+            self._add_event(d, now - 5 * day, now - 5 * day, True, [])
+
+        top = powerusers_top10(self.db, None, 3)
+        self.assertEqual([(x['user'], x['count']) for x in top],
+                         [(str(a._id), 12), (str(c._id), 11)])
+        self.assertEqual(top[0]['stats']['counts'], [1, 6, 0, 6])
+        self.assertEqual(top[1]['stats']['counts'], [0, 0, 11, 0])
+        self.assertEqual(top[1]['stats']['max'], 11.0)
@@ -78,6 +78,34 @@ class UtilsTestCase(unittest.TestCase):
         self.assertTrue('<animals>' in xml)
         self.assertEqual(xml.count('<animal>'), 2)
         
+    def test_iter_dict_to_xml(self):
+        from utils.datatoxml import dict_to_xml, iter_dict_to_xml, \
+          list_to_xml, etree_dict_to_xml, etree_list_to_xml
+        events = [{'title': u"B\xe4r & <tags>", 'allDay': True,
+                   'start': 1285041600.0, 'description': u"A\r\nB"},
+                  {'title': u'', 'external_url': None}]
+        data = {'events': events, 'tags': [u'@b\xe4r'], 'sharers': [],
+                'hidden_shares': [{'key': 'abc', 'className': 'share-1'}]}
+        self.assertEqual(''.join(iter_dict_to_xml(data)),
+                         etree_dict_to_xml(data))
+        self.assertEqual(dict_to_xml(data), etree_dict_to_xml(data))
+        self.assertEqual(dict_to_xml({}), etree_dict_to_xml({}))
+        self.assertEqual(list_to_xml(events, 'event'),
+                         etree_list_to_xml(events, 'event'))
+        self.assertEqual(list_to_xml([], 'event'),
+                         etree_list_to_xml([], 'event'))
+
+        # lists can be generators that add more keys to the dict
+        streamed = {}
+        def generate():
+            for event in events:
+                yield event
+            streamed['version'] = 1
+        streamed['events'] = generate()
+        xml = ''.join(iter_dict_to_xml(streamed, first=('events',)))
+        self.assertEqual(xml.count('<event>'), 2)
+        self.assertTrue('<version>1</version>' in xml)
+
     def test_random_string(self):
         from utils import random_string
         
@@ -147,3 +175,38 @@ class UtilsTestCase(unittest.TestCase):
         
         
         
+
+    def test_encode_events_data(self):
+        import simplejson as json
+        from time import mktime
+        from bson.objectid import ObjectId
+        from apps.main.event_rows import EventRow
+        from apps.main.serializers import encode_events_data, EpochCache
+
+        epoch = EpochCache()
+        for dt in (datetime.datetime(2010, 1, 1, 13, 45, 10),
+                   datetime.datetime(2010, 7, 1, 0, 0, 59, 1000)):
+            self.assertEqual(epoch(dt), mktime(dt.timetuple()))
+        self.assertEqual(epoch(datetime.date(2010, 1, 1)),
+                         mktime(datetime.date(2010, 1, 1).timetuple()))
+
+        start = datetime.datetime(2010, 1, 1, 13, 30)
+        end = datetime.datetime(2010, 1, 1, 14, 30)
+        _id = ObjectId()
+        event = EventRow(dict(_id=_id, title=u"B\xe4r </script>", start=start,
+                              end=end, all_day=False, description=u"",
+                              external_url=u"http://x.com"))
+        data = dict(events=[(event, None),
+                            (event, dict(className='share-1', editable=False,
+                                         color='#fff'))],
+                    tags=[u'@b\xe4r'])
+        body = encode_events_data(data)
+        self.assertTrue('</' not in body)
+        expect = dict(title=u"B\xe4r </script>", start=mktime(start.timetuple()),
+                      end=mktime(end.timetuple()), allDay=False, id=str(_id),
+                      external_url=u"http://x.com")
+        self.assertEqual(json.loads(body),
+                         dict(events=[expect,
+                                      dict(expect, className='share-1',
+                                           editable=False, color='#fff')],
+                              tags=[u'@b\xe4r']))
@@ -0,0 +1,69 @@
+import os
+from bson import BSON
+from utils.lrucache import LRUCache
+
+
+class UserCache(object):
+    """Cache of raw user documents by their guid.
+
+    There are two tiers. First an in-process LRU and then Redis which is
+    shared by all processes. The in-process tier only gets invalidated in the
+    process that made the change so its TTL is kept short. Everything that
+    changes a user (account details, password, premium) must call
+    invalidate(), or invalidate_user() if it's not running in the app like
+    ./bin/set_premium.py. The Redis TTL is kept short too in case something
+    forgets.
+
+    Cached users can be a little stale so never change and save one. Get
+    it from the database first.
+    """
+
+    REDIS_KEY = 'user_by_guid:%s'
+
+    def __init__(self, redis, max_size=1000, ttl=30, redis_ttl=60 * 5):
+        self.redis = redis
+        self.local = LRUCache(max_size=max_size, ttl=ttl)
+        self.redis_ttl = redis_ttl
+        self.local_hits = self.redis_hits = self.misses = 0
+        self.invalidations = 0
+
+    def get(self, guid):
+        """return a copy of the raw user document or None"""
+        doc = self.local.get(guid)
+        if doc is not None:
+            self.local_hits += 1
+            return dict(doc)
+
+        data = self.redis.get(self.REDIS_KEY % guid)
+        if data is not None:
+            self.redis_hits += 1
+            doc = BSON(data).decode()
+            self.local.set(guid, doc)
+            return dict(doc)
+
+        self.misses += 1
+
+    def set(self, guid, doc):
+        doc = dict(doc)
+        self.local.set(guid, doc)
+        self.redis.setex(self.REDIS_KEY % guid, BSON.encode(doc),
+                         self.redis_ttl)
+
+    def invalidate(self, guid):
+        self.invalidations += 1
+        self.local.delete(guid)
+        invalidate_user(self.redis, guid)
+
+    def get_stats(self):
+        return dict(pid=os.getpid(),
+                    local_hits=self.local_hits,
+                    redis_hits=self.redis_hits,
+                    misses=self.misses,
+                    invalidations=self.invalidations,
+                    local_size=len(self.local))
+
+
+def invalidate_user(redis, guid):
+    """forget the cached user in all processes. Those that have it in their
+    in-process tier keep it for at most its TTL."""
+    redis.delete(UserCache.REDIS_KEY % guid)
@@ -0,0 +1,65 @@
+import time
+from hashlib import sha1
+
+
+class EventsVersions(object):
+    """Version numbers of everything that goes into an events feed. There's
+    one per user, bumped every time any of their events is created, edited,
+    moved, resized, deleted or restored (or the user itself is changed),
+    and one per share, bumped when the share is edited.
+
+    An ETag made from the versions of the user and the shares in a feed
+    changes if and only if the feed might have, so it can be worked out
+    without querying any events.
+
+    A version starts from the time in milliseconds when it's first needed so
+    that if Redis ever loses them the new versions are still greater than
+    any version a client might have seen.
+    """
+
+    USER_KEY = 'events_version:user:%s'
+    SHARE_KEY = 'events_version:share:%s'
+
+    def __init__(self, redis):
+        self.redis = redis
+
+    def _initial(self):
+        return int(time.time() * 1000)
+
+    def _bump(self, key):
+        pipe = self.redis.pipeline()
+        pipe.setnx(key, self._initial())
+        pipe.incr(key)
+        return pipe.execute()[1]
+
+    def bump_user(self, user_id):
+        return self._bump(self.USER_KEY % user_id)
+
+    def bump_share(self, share_id):
+        return self._bump(self.SHARE_KEY % share_id)
+
+    def get_versions(self, keys):
+        if not keys:
+            return []
+        versions = self.redis.mget(keys)
+        if None in versions:
+            pipe = self.redis.pipeline()
+            for key, version in zip(keys, versions):
+                if version is None:
+                    pipe.setnx(key, self._initial())
+            pipe.mget(keys)
+            versions = pipe.execute()[-1]
+        return [int(x) for x in versions]
+
+    def get_etag(self, user_id, shares, *extra):
+        """return a strong ETag for the events of the user (which can be
+        None) and the list of share documents. Anything else the response
+        depends on, like the URL, goes in `extra`."""
+        keys = []
+        if user_id:
+            keys.append(self.USER_KEY % user_id)
+        for share in shares:
+            keys.append(self.USER_KEY % share['user'])
+            keys.append(self.SHARE_KEY % share['_id'])
+        versions = self.get_versions(keys)
+        return '"%s"' % sha1(repr((user_id, versions, extra))).hexdigest()
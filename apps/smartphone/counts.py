@@ -0,0 +1,51 @@
+import calendar
+import datetime
+from time import mktime
+from collections import defaultdict
+
+
+class EventCounts(object):
+    """The number of events per month and day, by when they start, and when
+    the latest event of each month was added. Worked out in one pass over
+    the events matching the search instead of a count() per month or day.
+    """
+
+    def __init__(self, collection, search):
+        self.months = defaultdict(int)
+        self.days = defaultdict(int)
+        self.latest = {}
+        for event in collection.find(search, fields=['start', 'add_date']):
+            start = event['start']
+            month = (start.year, start.month)
+            self.months[month] += 1
+            self.days[(start.year, start.month, start.day)] += 1
+            if month not in self.latest or event['add_date'] > self.latest[month]:
+                self.latest[month] = event['add_date']
+
+    def months_until_now(self):
+        """return (year, month) for every month from the one of the first
+        event up to and including this month"""
+        today = datetime.date.today()
+        if self.months:
+            year, month = min(self.months)
+        else:
+            year, month = today.year, today.month
+        months = []
+        while (year, month) <= (today.year, today.month):
+            months.append((year, month))
+            year, month = year + month // 12, month % 12 + 1
+        return months
+
+    def day_counts(self, year, month):
+        """return the number of events of every day of the month"""
+        __, no_days = calendar.monthrange(year, month)
+        return [self.days.get((year, month, day), 0)
+                for day in range(1, no_days + 1)]
+
+    def timestamp(self, months):
+        """return when the latest event of any of the months was added as
+        seconds since the epoch, or 0 if none of them have any events"""
+        latest = [self.latest[x] for x in months if x in self.latest]
+        if not latest:
+            return 0
+        return mktime(max(latest).timetuple())
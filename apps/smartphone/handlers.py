@@ -6,9 +6,10 @@ from bson.objectid import ObjectId, InvalidId
 import tornado.web
 from tornado_utils.routes import route, route_redirect
 from apps.main.handlers import BaseHandler, AuthLoginHandler, \
-  CredentialsError, EventsHandler, EventHandler
-from apps.main.models import Event
+  EventsHandler, EventHandler
+from apps.main.event_rows import find_event_rows, DAY_FIELDS
 from apps.eventlog import log_event, actions, contexts
+from counts import EventCounts
 from utils import niceboolean, title_to_tags
 
 class XSRFIgnore(object):
@@ -27,16 +28,21 @@ class SmartphoneHandler(BaseHandler):
 
 @route('/smartphone/auth/login/$')
 class SmartphoneAuthLoginHandler(XSRFIgnore, AuthLoginHandler):
+    @tornado.web.asynchronous
     def post(self):
         # if this works it will set a cookie. Is that needed???
         # if not, consider rewriting AuthLoginHandler so that it can
         # check but not set a cookie or something
-        try:
-            user = self.check_credentials(self.get_argument('email'),
-                                          self.get_argument('password'))
-        except CredentialsError, msg:
-            return self.write_json(dict(error="Error: %s" % msg))
-        self.write_json(dict(guid=self.create_signed_value('guid', user.guid)))
+        self.check_credentials(self.get_argument('email'),
+                               self.get_argument('password'),
+                               self._on_credentials)
+
+    def _on_credentials(self, user, error):
+        if error:
+            self.write_json(dict(error="Error: %s" % error))
+        else:
+            self.write_json(dict(guid=self.create_signed_value('guid', user.guid)))
+        self.finish()
 
 
 @route('/smartphone/openid/$')
@@ -57,7 +63,7 @@ class SmartphoneAPIMixin(object):
         if guid.count('|') == 2:
             guid = self.get_secure_cookie('guid', value=guid)
         if guid:
-            return self.db.User.one({'guid': guid})
+            return self.get_user_by_guid(guid)
 
     def must_get_user(self):
         """hack to wrap get_user() and raise a 401 or 403"""
@@ -107,67 +113,32 @@ class APIMonthsHandler(APIBaseHandler, SmartphoneAPIMixin):
     def get(self):
         user = self.must_get_user()
         timestamp_only = niceboolean(self.get_argument('timestamp_only', False))
-        _search = {'user.$id':user._id}
-        for event in self.db.Event.collection\
-          .find(_search).sort('start', 1).limit(1):
-            first_date = event['start']
-            break
-        else:
-            # No events
-            first_date = datetime.date.today()
-            first_date = datetime.datetime(
-              first_date.year, first_date.month, 1, 0, 0, 0)
-
-        #for event in self.db[Event.__collection__].find(_search).sort('start', -1).limit(1):
-        #    last_date = event['start']
-        #    break
-        #else:
-        last_date = datetime.date.today()
-        last_date = datetime.datetime(
-              last_date.year, last_date.month, 1, 0, 0, 0)
-
-        today = datetime.date.today()
-
-        months = []
-        date = first_date
-        timestamp = 0
-        while date <= last_date:
-            first_of_date = datetime.datetime(
-              date.year, date.month, 1, 0, 0, 0)
-
-            next_date = first_of_date + relativedelta.relativedelta(months=1)
-
-            for event in self.db.Event.collection\
-              .find(dict(_search,
-                         start={'$gte': first_of_date, '$lt':next_date}))\
-              .limit(1).sort('add_date', -1):
-                tmp_timestamp = mktime(event['add_date'].timetuple())
-                if tmp_timestamp > timestamp:
-                    timestamp = tmp_timestamp
-                    break
-
-            if not timestamp_only:
-                # becomes 28 for February for example
-                # Haven't tested for all years :)
-                count_events = self.db.Event.collection\
-                  .find(dict(_search,
-                             start={'$gte': first_of_date, '$lt':next_date}))\
-                             .count()
-                month_name = first_of_date.strftime('%B')
-                #if first_of_date.year == today.year and first_of_date.month == today.month:
-                #    month_name += " (today)"
-                months.append(dict(month_name=month_name,
-                                   year=first_of_date.year,
-                                   month=first_of_date.month,
-                                   count=count_events,
-                                   #no_days=no_days,
-                                   ))
-            date = next_date
-
         if timestamp_only:
-            self.write_json(dict(timestamp=timestamp))
-        else:
-            self.write_json(dict(months=months, timestamp=timestamp))
+            # the phone polls this so only read the latest event
+            today = datetime.date.today()
+            next_month = datetime.datetime(today.year, today.month, 1) + \
+              relativedelta.relativedelta(months=1)
+            timestamp = 0
+            for event in self.db.Event.collection\
+              .find({'user.$id':user._id, 'start': {'$lt': next_month}},
+                    fields=['add_date'])\
+              .sort('add_date', -1).limit(1):
+                timestamp = mktime(event['add_date'].timetuple())
+            return self.write_json(dict(timestamp=timestamp))
+
+        counts = EventCounts(self.db.Event.collection, {'user.$id':user._id})
+        months = counts.months_until_now()
+        self.write_json(dict(months=[self._describe_month(counts, *x)
+                                     for x in months],
+                             timestamp=counts.timestamp(months)))
+
+    def _describe_month(self, counts, year, month):
+        first_of_date = datetime.datetime(year, month, 1, 0, 0, 0)
+        return dict(month_name=first_of_date.strftime('%B'),
+                    year=year,
+                    month=month,
+                    count=counts.months.get((year, month), 0),
+                    )
 
 @route('/smartphone/api/month\.json$')
 class APIMonthHandler(APIBaseHandler, SmartphoneAPIMixin):
@@ -177,40 +148,42 @@ class APIMonthHandler(APIBaseHandler, SmartphoneAPIMixin):
         year = int(self.get_argument('year'))
         month = int(self.get_argument('month'))
         timestamp_only = niceboolean(self.get_argument('timestamp_only', False))
-        _search = {'user.$id':user._id}
         first_day = datetime.datetime(year, month, 1, 0, 0, 0)
-        date = first_day
-        #no_days = 0
-        day_counts = []
-        if timestamp_only:
-            while date.month == first_day.month:
-                date += datetime.timedelta(days=1)
-        else:
-            while date.month == first_day.month:
-                count_events = self.db[Event.__collection__]\
-                  .find(dict(_search,
-                             start={'$gte': date, '$lt':date + datetime.timedelta(days=1)}))\
-                             .count()
-                day_counts.append(count_events)
-                date += datetime.timedelta(days=1)
-
-        timestamp = 0
-        for event in self.db.Event.collection\
-          .find(dict(_search,
-                     start={'$gte': first_day, '$lt':date}
-                     )).limit(1).sort('add_date', -1):
-            timestamp = mktime(event['add_date'].timetuple())
-            break
+        next_month = first_day + relativedelta.relativedelta(months=1)
+        counts = EventCounts(self.db.Event.collection,
+                             {'user.$id':user._id,
+                              'start': {'$gte': first_day, '$lt': next_month}})
+        timestamp = counts.timestamp([(year, month)])
 
         if timestamp_only:
             self.write_json(dict(timestamp=timestamp))
         else:
             self.write_json(dict(month_name=first_day.strftime('%B'),
-                                 day_counts=day_counts,
+                                 day_counts=counts.day_counts(year, month),
                                  first_day=first_day.strftime('%A'),
                                  timestamp=timestamp))
 
 
+@route('/smartphone/api/overview\.json$')
+class APIOverviewHandler(APIMonthsHandler):
+    """what months.json and month.json of every month return in one go"""
+
+    def get(self):
+        user = self.must_get_user()
+        counts = EventCounts(self.db.Event.collection, {'user.$id':user._id})
+        months = counts.months_until_now()
+        descriptions = []
+        for year, month in months:
+            description = self._describe_month(counts, year, month)
+            description.update(
+              day_counts=counts.day_counts(year, month),
+              first_day=datetime.datetime(year, month, 1).strftime('%A'),
+              timestamp=counts.timestamp([(year, month)]))
+            descriptions.append(description)
+        self.write_json(dict(months=descriptions,
+                             timestamp=counts.timestamp(months)))
+
+
 @route('/smartphone/api/day\.json$')
 class APIDayHandler(APIBaseHandler, EventsHandler, SmartphoneAPIMixin):
 
@@ -226,7 +199,8 @@ class APIDayHandler(APIBaseHandler, EventsHandler, SmartphoneAPIMixin):
         timestamp = 0
         for event in self.db.Event.collection\
                   .find(dict(_search,
-                             start={'$gte': date, '$lt':date + datetime.timedelta(days=1)}))\
+                             start={'$gte': date, '$lt':date + datetime.timedelta(days=1)}),
+                        fields=['modify_date'])\
                   .limit(1).sort('modify_date', -1):
             # the reason we're after the modify_date is because we ultimately
             # need to know the latest something was changed in this day.
@@ -236,9 +210,10 @@ class APIDayHandler(APIBaseHandler, EventsHandler, SmartphoneAPIMixin):
         if not timestamp_only:
             events = []
             days_spent = hours_spent = None
-            for each in self.db.Event.collection\
-                  .find(dict(_search,
-                             start={'$gte': date, '$lt':date + datetime.timedelta(days=1)})):
+            for each in find_event_rows(self.db.Event.collection,
+                  dict(_search,
+                       start={'$gte': date, '$lt':date + datetime.timedelta(days=1)}),
+                  DAY_FIELDS):
                 if days_spent is None:
                     days_spent = hours_spent = 0.0
 
@@ -362,6 +337,7 @@ class APIEventHandler(APIBaseHandler, EventsHandler, SmartphoneAPIMixin):
         external_url = self.get_argument('external_url', u'').strip()
         description = self.get_argument('description', u'').strip()
 
+        previous = dict(event)
         if event.all_day:
             _before = 1 + (event.end - event.start).days
             if _before != duration:
@@ -385,6 +361,7 @@ class APIEventHandler(APIBaseHandler, EventsHandler, SmartphoneAPIMixin):
         event.description = description
         event.tags = title_to_tags(title)
         event.save()
+        self.on_event_edited(event, user, previous)
 
         log_event(self.db, user, event, actions.ACTION_EDIT,
                   contexts.CONTEXT_SMARTPHONE)
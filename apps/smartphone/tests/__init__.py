@@ -0,0 +1,2 @@
+from test_counts import *
+from test_handlers import *
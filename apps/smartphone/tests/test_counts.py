@@ -0,0 +1,70 @@
+import datetime
+from time import mktime
+from apps.main.tests.base import BaseModelsTestCase
+from apps.smartphone.counts import EventCounts
+
+class EventCountsTestCase(BaseModelsTestCase):
+
+    def _add_event(self, user, start, add_date):
+        event = self.db.events.Event()
+        event.user = user
+        event.title = u"Event"
+        event.all_day = True
+        event.start = start
+        event.end = start
+        event.add_date = add_date
+        event.save()
+        return event
+
+    def _counts(self, user):
+        return EventCounts(self.db.events, {'user.$id': user._id})
+
+    def test_months_until_now(self):
+        user = self.db.users.User()
+        user.save()
+        today = datetime.date.today()
+
+        counts = self._counts(user)
+        self.assertEqual(counts.months_until_now(),
+                         [(today.year, today.month)])
+        self.assertEqual(counts.timestamp(counts.months_until_now()), 0)
+
+        # from December last year over into January
+        december = datetime.datetime(today.year - 1, 12, 24)
+        self._add_event(user, december, december)
+        months = self._counts(user).months_until_now()
+        self.assertEqual(months[:2], [(today.year - 1, 12), (today.year, 1)])
+        self.assertEqual(months[-1], (today.year, today.month))
+        self.assertEqual(len(months), today.month + 1)
+
+    def test_day_counts_and_timestamp(self):
+        user = self.db.users.User()
+        user.save()
+        other = self.db.users.User()
+        other.save()
+
+        added = datetime.datetime(2011, 3, 1, 10, 0, 0)
+        self._add_event(user, datetime.datetime(2011, 2, 1), added)
+        self._add_event(user, datetime.datetime(2011, 2, 28), added)
+        latest = self._add_event(user, datetime.datetime(2011, 2, 28),
+                                 added + datetime.timedelta(hours=1))
+        self._add_event(user, datetime.datetime(2011, 4, 3),
+                        added - datetime.timedelta(days=1))
+        self._add_event(other, datetime.datetime(2011, 2, 2),
+                        added + datetime.timedelta(days=1))
+
+        counts = self._counts(user)
+        self.assertEqual(counts.months[(2011, 2)], 3)
+        day_counts = counts.day_counts(2011, 2)
+        self.assertEqual(len(day_counts), 28)
+        self.assertEqual(day_counts[0], 1)
+        self.assertEqual(day_counts[1], 0)
+        self.assertEqual(day_counts[27], 2)
+        self.assertEqual(sum(counts.day_counts(2011, 3)), 0)
+        self.assertEqual(len(counts.day_counts(2011, 3)), 31)
+
+        self.assertEqual(counts.timestamp([(2011, 3)]), 0)
+        self.assertEqual(counts.timestamp([(2011, 4)]),
+                         mktime((added - datetime.timedelta(days=1)).timetuple()))
+        self.assertEqual(counts.timestamp(counts.months_until_now()),
+                         mktime(latest.add_date.timetuple()))
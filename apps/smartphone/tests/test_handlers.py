@@ -0,0 +1,72 @@
+import datetime
+import simplejson as json
+from time import mktime
+from apps.main.tests.base import BaseHTTPTestCase
+
+class SmartphoneAPITestCase(BaseHTTPTestCase):
+
+    def _add_event(self, user, start, add_date):
+        event = self.get_db().Event()
+        event.user = user
+        event.title = u"Event"
+        event.all_day = True
+        event.start = start
+        event.end = start
+        event.add_date = add_date
+        event.save()
+        return event
+
+    def test_months_and_overview(self):
+        db = self.get_db()
+        peter = db.User()
+        peter.save()
+        data = dict(guid=peter.guid)
+
+        response = self.get('/smartphone/api/overview.json', dict(guid='xxx'))
+        self.assertEqual(response.code, 403)
+
+        response = self.get('/smartphone/api/months.json',
+                            dict(data, timestamp_only=1))
+        self.assertEqual(response.code, 200)
+        self.assertEqual(json.loads(response.body), dict(timestamp=0))
+
+        today = datetime.date.today()
+        first = datetime.datetime(today.year, today.month, 1)
+        last_month = first - datetime.timedelta(days=1)
+        self._add_event(peter, last_month, last_month)
+        latest = self._add_event(peter, first, first)
+        # starting after this month so it doesn't count
+        self._add_event(peter, first + datetime.timedelta(days=40),
+                        first + datetime.timedelta(hours=1))
+        timestamp = mktime(latest.add_date.timetuple())
+
+        response = self.get('/smartphone/api/months.json',
+                            dict(data, timestamp_only=1))
+        self.assertEqual(json.loads(response.body), dict(timestamp=timestamp))
+
+        response = self.get('/smartphone/api/months.json', data)
+        struct = json.loads(response.body)
+        self.assertEqual(struct['timestamp'], timestamp)
+        self.assertEqual([(x['year'], x['month'], x['count'])
+                          for x in struct['months']],
+                         [(last_month.year, last_month.month, 1),
+                          (today.year, today.month, 1)])
+
+        response = self.get('/smartphone/api/overview.json', data)
+        self.assertEqual(response.code, 200)
+        struct = json.loads(response.body)
+        self.assertEqual(struct['timestamp'], timestamp)
+        self.assertEqual(len(struct['months']), 2)
+        this_month = struct['months'][-1]
+        self.assertEqual(this_month['count'], 1)
+        self.assertEqual(this_month['timestamp'], timestamp)
+        self.assertEqual(this_month['first_day'], first.strftime('%A'))
+        self.assertEqual(this_month['day_counts'][0], 1)
+        self.assertEqual(sum(this_month['day_counts']), 1)
+
+        # the same as month.json says about the month
+        response = self.get('/smartphone/api/month.json',
+                            dict(data, year=today.year, month=today.month))
+        struct = json.loads(response.body)
+        self.assertEqual(struct['day_counts'], this_month['day_counts'])
+        self.assertEqual(struct['timestamp'], this_month['timestamp'])
@@ -7,10 +7,13 @@ TEST_MODULES = [
     'apps.main.tests.test_api',
     'apps.main.tests.test_models',
     'apps.main.tests.test_utils',
+    'apps.main.tests.test_stats',
     'apps.emailreminders.tests.test_models',
     'apps.emailreminders.tests.test_handlers',
     'apps.emailreminders.tests.test_utils',
     'apps.eventlog.tests.test_handlers',
+    'apps.smartphone.tests.test_counts',
+    'apps.smartphone.tests.test_handlers',
 ]
 
 def all():
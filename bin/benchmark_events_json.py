@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+"""Compare encoding events the old way (transform_fullcalendar_event() +
+serialize_dict() + json_encode()) with apps.main.serializers.
+
+Usage: ./bin/benchmark_events_json.py [number of events ...]
+"""
+import datetime
+import random
+import time
+import here
+
+import simplejson as json
+from bson.objectid import ObjectId
+from tornado.escape import json_encode
+from apps.main.handlers import BaseHandler
+from apps.main.event_rows import EventRow
+from apps.main.serializers import encode_events_data
+
+
+class OldPath(object):
+    transform_fullcalendar_event = \
+      BaseHandler.__dict__['transform_fullcalendar_event']
+    serialize_dict = BaseHandler.__dict__['serialize_dict']
+
+
+def make_events(count):
+    events = []
+    first = datetime.datetime(2010, 1, 1)
+    for i in range(count):
+        start = first + datetime.timedelta(days=random.randint(0, 365),
+                                           minutes=random.randint(0, 60 * 23))
+        all_day = not i % 3
+        if all_day:
+            start = datetime.datetime(start.year, start.month, start.day)
+            end = start + datetime.timedelta(days=random.randint(0, 2))
+        else:
+            end = start + datetime.timedelta(minutes=random.randint(30, 120))
+        extra = None
+        if not i % 4:
+            extra = dict(className='share-%s' % ObjectId(), editable=False,
+                         color='#5C8D87')
+        events.append((EventRow(dict(_id=ObjectId(),
+                                     title=u"Event \xe4 number %s @tag" % i,
+                                     start=start,
+                                     end=end,
+                                     all_day=all_day,
+                                     tags=[u'tag'],
+                                     description=i % 2 and u"Some </script>" or u'',
+                                     external_url=u'')),
+                       extra))
+    return events
+
+
+def old_path(data):
+    handler = OldPath()
+    data = dict(data)
+    data['events'] = [handler.transform_fullcalendar_event(event, True,
+                                                           **(extra or {}))
+                      for event, extra in data['events']]
+    return json_encode(data)
+
+
+def new_path(data):
+    return encode_events_data(data)
+
+
+def run(*args):
+    counts = [int(x) for x in args] or [1000, 10000, 100000]
+    for count in counts:
+        data = dict(events=make_events(count), tags=[u'@tag'])
+        timings = []
+        for func in (old_path, new_path):
+            t0 = time.time()
+            result = func(data)
+            timings.append((time.time() - t0, result))
+        (old_time, old_result), (new_time, new_result) = timings
+        assert json.loads(old_result) == json.loads(new_result)
+        print "%7d events: old %.3fs  new %.3fs  (%.1fx faster)" % (
+          count, old_time, new_time, old_time / new_time)
+    return 0
+
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(run(*sys.argv[1:]))
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+"""Compare building an etree tree (utils.datatoxml.etree_dict_to_xml()) with
+streaming the XML (utils.datatoxml.iter_dict_to_xml()) for event lists.
+
+Every run happens in a forked process so that the peak memory of one
+doesn't hide the other's. The memory is how much the peak RSS went up.
+
+Usage: ./bin/benchmark_xml.py [number of events ...]
+"""
+import datetime
+import marshal
+import os
+import random
+import resource
+import time
+import here
+
+from utils.datatoxml import etree_dict_to_xml, iter_dict_to_xml
+
+
+def make_events(count):
+    events = []
+    first = datetime.datetime(2010, 1, 1)
+    for i in range(count):
+        start = first + datetime.timedelta(days=random.randint(0, 365),
+                                           minutes=random.randint(0, 60 * 23))
+        event = dict(title=u"Event \xe4 number %s @tag" % i,
+                     start=time.mktime(start.timetuple()),
+                     end=time.mktime(start.timetuple()) + 3600,
+                     allDay=not i % 3,
+                     id='%024x' % i)
+        if i % 2:
+            event['description'] = u"Some <b>description</b> & more"
+        events.append(event)
+    return events
+
+
+def old_path(data):
+    return len(etree_dict_to_xml(data))
+
+
+def new_path(data):
+    size = 0
+    for chunk in iter_dict_to_xml(data, first=('events',)):
+        size += len(chunk)
+    return size
+
+
+def measure(func, data):
+    """return (seconds, peak RSS increase in KB, size) of func(data) run in
+    a child process"""
+    read, write = os.pipe()
+    pid = os.fork()
+    if not pid:
+        os.close(read)
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        t0 = time.time()
+        size = func(data)
+        seconds = time.time() - t0
+        after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        os.write(write, marshal.dumps((seconds, after - before, size)))
+        os._exit(0)
+    os.close(write)
+    result = ''
+    while True:
+        chunk = os.read(read, 1024)
+        if not chunk:
+            break
+        result += chunk
+    os.close(read)
+    os.waitpid(pid, 0)
+    return marshal.loads(result)
+
+
+def run(*args):
+    counts = [int(x) for x in args] or [1000, 10000, 100000]
+    for count in counts:
+        data = dict(events=make_events(count), tags=[u'@tag'])
+        old_time, old_memory, old_size = measure(old_path, data)
+        new_time, new_memory, new_size = measure(new_path, data)
+        assert old_size == new_size
+        print "%7d events: old %.3fs %6dKB  new %.3fs %6dKB" % (
+          count, old_time, old_memory, new_time, new_memory)
+    return 0
+
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(run(*sys.argv[1:]))
@@ -1,5 +1,55 @@
 #!/usr/bin/env python
+"""Build the indexes declared in apps/<app>/indexes.py and check that every
+query shape listed there is served by an index and not a collection scan.
+
+Indexes are built in the background so on a big collection a fresh index
+might not be used until the build has finished; run with --check-only
+later on to just do the checks.
+"""
+import os
 import here
 
-from apps.eventlog.indexes import run as eventlog_run
-eventlog_run()
+from settings import APPS, DATABASE_NAME
+from apps.main.models import connection
+
+def get_registries():
+    for app in APPS:
+        if os.path.isfile(here.path('apps', app, 'indexes.py')):
+            yield __import__('apps.%s.indexes' % app, fromlist=['indexes'])
+
+def is_collection_scan(explanation):
+    if 'cursor' in explanation:
+        # MongoDB < 3.0
+        return explanation['cursor'].startswith('BasicCursor')
+    return 'COLLSCAN' in repr(explanation['queryPlanner']['winningPlan'])
+
+def ensure_indexes(db, registry):
+    for model, key, options in registry.INDEXES:
+        collection = db[model.__collection__]
+        name = collection.ensure_index(key, background=True, **options)
+        print "%s: %s" % (collection.name, name)
+
+def check_query_shapes(db, registry):
+    scans = []
+    for model, spec, sort in registry.get_query_shapes():
+        cursor = db[model.__collection__].find(spec)
+        if sort:
+            cursor = cursor.sort(sort)
+        if is_collection_scan(cursor.explain()):
+            scans.append((model.__collection__, spec, sort))
+    return scans
+
+def run(*args):
+    db = connection[DATABASE_NAME]
+    scans = []
+    for registry in get_registries():
+        if '--check-only' not in args:
+            ensure_indexes(db, registry)
+        scans.extend(check_query_shapes(db, registry))
+    for collection_name, spec, sort in scans:
+        print "COLLECTION SCAN: %s find(%r) sort(%r)" % (collection_name, spec, sort)
+    return scans and 1 or 0
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(run(*sys.argv[1:]))
@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+"""Rebuild the daily_rollups of some or all users from their events.
+
+Rollups are otherwise built the first time a user's stats are needed and
+kept up to date as events change, so this is only needed if they've gone
+wrong or to build them all up front.
+
+Usage: ./bin/rebuild_daily_rollups.py [user id ...]
+"""
+import here
+
+import redis
+from bson.objectid import ObjectId
+from settings import DATABASE_NAME, REDIS_HOST, REDIS_PORT
+from apps.main.models import connection
+from apps.main.rollups import DailyRollups
+
+def run(*args):
+    db = connection[DATABASE_NAME]
+    rollups = DailyRollups(db, redis.client.Redis(REDIS_HOST, REDIS_PORT))
+    if args:
+        user_ids = [ObjectId(x) for x in args]
+    else:
+        user_ids = [x['_id'] for x in db.User.collection.find(fields=['_id'])]
+    for i, user_id in enumerate(user_ids):
+        rollups.rebuild(user_id)
+        if not (i + 1) % 1000:
+            print "%d of %d users" % (i + 1, len(user_ids))
+    print "Rebuilt the daily rollups of %d users" % len(user_ids)
+    return 0
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(run(*sys.argv[1:]))
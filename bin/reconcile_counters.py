@@ -0,0 +1,29 @@
+#!/usr/bin/env python
+"""Correct any drift in the counters that are maintained as events are
+added and deleted (see apps/main/counters.py). Meant to be run from cron,
+say every 10 minutes. It does nothing if another reconcile is running.
+
+Usage: ./bin/reconcile_counters.py
+"""
+import here
+
+import redis
+from settings import DATABASE_NAME, REDIS_HOST, REDIS_PORT
+from apps.main.models import connection, get_or_create_undoer
+from apps.main.counters import reconcile_total_no_events
+
+def run():
+    db = connection[DATABASE_NAME]
+    undoer = get_or_create_undoer(db)
+    total = reconcile_total_no_events(db,
+                                      redis.client.Redis(REDIS_HOST, REDIS_PORT),
+                                      undoer._id)
+    if total is None:
+        print "Already being reconciled"
+    else:
+        print "Total number of events", total
+    return 0
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(run())
@@ -0,0 +1,29 @@
+#!/usr/bin/env python
+"""Work out the reports queued by the admin statistics and power users pages
+(see apps/main/reports.py). Runs until it's killed. More than one can run
+at the same time.
+
+Usage: ./bin/run_report_worker.py
+"""
+import here
+
+import logging
+import redis
+from settings import DATABASE_NAME, REDIS_HOST, REDIS_PORT
+from apps.main.models import connection
+from apps.main.reports import ReportQueue
+
+def run():
+    db = connection[DATABASE_NAME]
+    queue = ReportQueue(redis.client.Redis(REDIS_HOST, REDIS_PORT))
+    while True:
+        try:
+            job = queue.work(db)
+        except Exception:
+            logging.error("Report failed", exc_info=True)
+            continue
+        print "Worked out %s %r" % (job['name'], job['params'])
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(run())
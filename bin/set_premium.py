@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+"""Make a user premium, or not premium any more, and forget any cached copy
+of the user so the change is seen straight away (see apps/main/user_cache.py).
+
+Usage: ./bin/set_premium.py [--off] email
+"""
+import here
+
+import redis
+from settings import DATABASE_NAME, REDIS_HOST, REDIS_PORT
+from apps.main.models import connection
+from apps.main.user_cache import invalidate_user
+
+def run(*args):
+    args = list(args)
+    premium = '--off' not in args
+    if not premium:
+        args.remove('--off')
+    if len(args) != 1:
+        print __doc__
+        return 1
+    db = connection[DATABASE_NAME]
+    user = db.User.one({'email_lower': args[0].strip().lower()})
+    if not user:
+        print "No user with that email address"
+        return 1
+    db.User.collection.update({'_id': user._id},
+                              {'$set': {'premium': premium}})
+    invalidate_user(redis.client.Redis(REDIS_HOST, REDIS_PORT), user.guid)
+    print "%s is%s premium" % (user.email, '' if premium else ' not')
+    return 0
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(run(*sys.argv[1:]))
@@ -1,7 +1,10 @@
 #!/usr/bin/env python
 import datetime
 from mongokit import Connection
-from apps.main.models import User, Event
+import redis
+from apps.main.models import User, Event, get_or_create_undoer
+from apps.main.counters import reconcile_total_no_events
+import settings
 
 def get_db():
     con = Connection()
@@ -10,7 +13,7 @@ def get_db():
 
 def main(verbose=True):
     db = get_db()
-    undoer = db.User.one({'guid': u"UNDOER"})
+    undoer = get_or_create_undoer(db)
     search = {'user.$id': undoer._id}
     minute_ago = datetime.datetime.now()
     minute_ago -= datetime.timedelta(minutes=1)
@@ -19,8 +22,14 @@ def main(verbose=True):
         print "Removing", db.Event.find(search).count(), "events"
         
     db[Event.__collection__].remove(search)
-    
-    
+
+    # Deleted events were already taken off the total when they were
+    # deleted. This is just a good time to correct any drift.
+    _redis = redis.client.Redis(settings.REDIS_HOST, settings.REDIS_PORT)
+    total = reconcile_total_no_events(db, _redis, undoer._id)
+    if verbose:
+        print "Total number of events", total
+
 
 def run(*args):
     verbose = True
@@ -23,6 +23,24 @@ ADMIN_EMAILS = ['peterbe@gmail.com']
 EMAIL_REMINDER_SENDER = 'reminder+%(id)s@donecal.com'
 EMAIL_REMINDER_NOREPLY = 'noreplyplease@donecal.com'
 
+# bcrypt work factor for new passwords. Existing passwords made with a
+# different work factor are re-encrypted next time the user logs in.
+PASSWORD_LOG_ROUNDS = 10
+# number of threads that do the bcrypt work per process
+PASSWORD_WORKERS = 2
+
+# how /events/stats.json adds up the time spent per tag, 'rollups' (see
+# apps/main/rollups.py), 'mapreduce' or 'python' (see apps/main/stats.py)
+STATS_BACKEND = 'rollups'
+
+# if True the slow admin reports (see apps/main/reports.py) are worked out by
+# ./bin/run_report_worker.py, which then has to be running, and the pages
+# show the last ones it worked out. If False they're worked out while the
+# request waits, which blocks the whole process, so it's only meant for
+# development. In production set it to True in local_settings.py and run
+# the worker.
+BACKGROUND_REPORTS = False
+
 # commented out because it's on by default but driven by dont_embed_static_url option instead
 ## if you do this, for the static files, instead of getting something like
 ## '/static/foo.png?v=123556' we get '/static/v-123556/foo.png'
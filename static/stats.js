@@ -41,6 +41,20 @@ function resync(values) {
    });
 }
 
+// the reports are worked out in the background and until one is ready the
+// server answers {pending: true} so ask again in a little while
+function get_report(url, params, callback) {
+   $.getJSON(url, params, function(response) {
+      if (response.pending) {
+         setTimeout(function() {
+            get_report(url, params, callback);
+         }, 3000);
+      } else {
+         callback(response);
+      }
+   });
+}
+
 function daysDiff(d1, d2) {
     return  Math.floor((d2.getTime() - d1.getTime()) / 86400000);
 }
@@ -74,7 +88,7 @@ function plot_users(cumulative, interval, date_format_string) {
                 {label:'New (no email)', lineWidth:4}
                ];
    }
-   $.getJSON('/stats/users.json', {
+   get_report('/stats/users.json', {
       interval: interval,
       cumulative: cumulative,
       start: startDate.datepicker('getDate').getTime(),
@@ -124,7 +138,7 @@ function plot_events(cumulative, interval, date_format_string) {
                 {label:'New', lineWidth:4}
                ];
    }
-   $.getJSON('/stats/events.json', {
+   get_report('/stats/events.json', {
       interval: interval,
       cumulative: cumulative,
       start: startDate.datepicker('getDate').getTime(),
@@ -162,7 +176,7 @@ function plot_events(cumulative, interval, date_format_string) {
 
 function update_numbers() {
    $('#numbers td').remove();
-   $.getJSON('/stats/numbers.json', {
+   get_report('/stats/numbers.json', {
       start: startDate.datepicker('getDate').getTime(),
 	end: endDate.datepicker('getDate').getTime()},
              function(response) {
@@ -179,7 +193,7 @@ function update_numbers() {
 
 function plot_usersettings() {
    $('#plot-usersettings').html('');
-   $.getJSON('/stats/usersettings.json', {
+   get_report('/stats/usersettings.json', {
       start: startDate.datepicker('getDate').getTime(),
       end: endDate.datepicker('getDate').getTime()
    }, function(response) {
@@ -235,7 +249,7 @@ function plot_no_events(anonymous) {
 
    $('#plot-' + report_id).html('');
 
-   $.getJSON('/stats/' + report_id + '.json', {
+   get_report('/stats/' + report_id + '.json', {
       start: startDate.datepicker('getDate').getTime(),
       end: endDate.datepicker('getDate').getTime()
    }, function(response) {
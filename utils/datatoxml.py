@@ -28,30 +28,127 @@ except ImportError:
                     
                     
 def dict_to_xml(dict_, root_node_tagname="Result"):
+    return ''.join(iter_dict_to_xml(dict_, root_node_tagname))
+
+def list_to_xml(list_, key, root_node_tagname="Result"):
+    assert isinstance(list_, (list, tuple))
+    return ''.join(_iter_list(root_node_tagname, key, list_, 0))
+
+
+def iter_dict_to_xml(dict_, root_node_tagname="Result", first=()):
+    """yield the XML of the dict a bit at a time without building the tree.
+    Lists can be any iterables, like generators, so a long list is never in
+    memory all at once.
+
+    The keys in `first` are written before the others, which are only
+    looked at after that so consuming the first values can still add
+    keys to the dict. Apart from that the document is exactly what
+    etree_dict_to_xml() makes.
+    """
+    assert isinstance(dict_, dict)
+    if not dict_:
+        yield '<%s/>\n' % root_node_tagname
+        return
+    yield '<%s>\n' % root_node_tagname
+    for key in _iter_keys(dict_, first):
+        for chunk in _iter_item(key, dict_[key], 1):
+            yield chunk
+    yield '</%s>\n' % root_node_tagname
+
+def _iter_keys(dict_, first):
+    for key in first:
+        if key in dict_:
+            yield key
+    for key in dict_.keys():
+        if key not in first:
+            yield key
+
+_list_keys = {}
+
+def _list_key(key):
+    try:
+        return _list_keys[key]
+    except KeyError:
+        pass
+    list_key = re.sub('ies$', '', key)
+    if list_key == key:
+        list_key = re.sub('s$', '', key)
+    if list_key == key:
+        list_key += '_item'
+    _list_keys[key] = list_key
+    return list_key
+
+def _iter_item(key, value, level):
+    if isinstance(value, dict):
+        indent = '  ' * level
+        if not value:
+            yield '%s<%s/>\n' % (indent, key)
+            return
+        yield '%s<%s>\n' % (indent, key)
+        for k, v in value.items():
+            for chunk in _iter_item(k, v, level + 1):
+                yield chunk
+        yield '%s</%s>\n' % (indent, key)
+    elif isinstance(value, list) or hasattr(value, 'next'):
+        for chunk in _iter_list(key, _list_key(key), value, level):
+            yield chunk
+    else:
+        yield _value(key, value, level)
+
+def _iter_list(key, list_key, value, level):
+    indent = '  ' * level
+    opened = False
+    for v in value:
+        if not opened:
+            yield '%s<%s>\n' % (indent, key)
+            opened = True
+        if isinstance(v, dict):
+            for chunk in _iter_item(list_key, v, level + 1):
+                yield chunk
+        else:
+            yield _value(list_key, v, level + 1)
+    if opened:
+        yield '%s</%s>\n' % (indent, key)
+    else:
+        yield '%s<%s/>\n' % (indent, key)
+
+def _value(key, value, level):
+    indent = '  ' * level
+    if value is None:
+        return '%s<%s/>\n' % (indent, key)
+    if isinstance(value, bool):
+        value = value and 'true' or 'false'
+    return '%s<%s>%s</%s>\n' % (indent, key, _escape(unicode(value)), key)
+
+def _escape(text):
+    # the same as lxml's ASCII output
+    text = text.replace('&', '&amp;').replace('<', '&lt;')\
+      .replace('>', '&gt;').replace('\r', '&#13;')
+    return text.encode('ascii', 'xmlcharrefreplace')
+
+
+# The old way of doing it by building an etree tree. Only kept to check
+# and benchmark the above against.
+
+def etree_dict_to_xml(dict_, root_node_tagname="Result"):
     root = etree.Element(root_node_tagname)
     assert isinstance(dict_, dict)
     _append_dict(root, dict_)
     return etree.tostring(root, pretty_print=True)
 
-def list_to_xml(list_, key, root_node_tagname="Result"):
+def etree_list_to_xml(list_, key, root_node_tagname="Result"):
     root = etree.Element(root_node_tagname)
     assert isinstance(list_, (list, tuple))
     _append_list(root, key, list_)
     return etree.tostring(root, pretty_print=True)
-            
+
 def _append_dict(root, data):
     for key, value in data.items():
         element = etree.SubElement(root, key)
         if isinstance(value, dict):
             _append_dict(element, value)
         elif isinstance(value, list):
-            list_key = re.sub('ies$', '', key)
-            if list_key == key:
-                list_key = re.sub('s$', '', key)
-            if list_key == key:
-                list_key += '_item'
-
-            _append_list(element, list_key, value)
+            _append_list(element, _list_key(key), value)
         else:
             _append_value(element, value)
 
@@ -62,11 +159,9 @@ def _append_list(element, key, value):
             _append_dict(sub_element, v)
         else:
             _append_value(sub_element, v)
-                
+
 def _append_value(element, value):
     if value is not None:
         if isinstance(value, bool):
             value = value and 'true' or 'false'
-        #element.set('type', str(type(value)))
         element.text = unicode(value)
-    
@@ -0,0 +1,41 @@
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """A small in-process least-recently-used cache where every item also
+    expires after `ttl` seconds.
+
+    It's not thread safe but Tornado runs everything on one thread anyway.
+    """
+
+    def __init__(self, max_size=1000, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        try:
+            value, expires = self._data.pop(key)
+        except KeyError:
+            return default
+        if expires < time.time():
+            return default
+        # put it back last, i.e. as the most recently used
+        self._data[key] = (value, expires)
+        return value
+
+    def set(self, key, value):
+        self._data.pop(key, None)
+        self._data[key] = (value, time.time() + self.ttl)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def delete(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
@@ -28,11 +28,26 @@ def datetime_to_date(dt):
     return datetime.date(dt.year, dt.month, dt.day)
 
 def encrypt_password(raw_password, log_rounds=10):
+    if isinstance(raw_password, unicode):
+        raw_password = raw_password.encode('utf8')
     salt = bcrypt.gensalt(log_rounds=log_rounds)
     hsh = bcrypt.hashpw(raw_password, salt)
     algo = 'bcrypt'
     return u'%s$bcrypt$%s' % (algo, hsh)
 
+def check_encrypted_password(raw_password, encrypted):
+    if '$bcrypt$' not in encrypted:
+        raise NotImplementedError("No checking clear text passwords")
+    hashed = encrypted.split('$bcrypt$')[-1].encode('utf8')
+    if isinstance(raw_password, unicode):
+        raw_password = raw_password.encode('utf8')
+    return hashed == bcrypt.hashpw(raw_password, hashed)
+
+def get_log_rounds(encrypted):
+    """return the work factor an encrypted password was made with"""
+    # the bcrypt hash looks like '$2a$10$<salt and hash>'
+    return int(encrypted.split('$bcrypt$')[-1].split('$')[2])
+
 
 def niceboolean(value):
     if type(value) is bool: